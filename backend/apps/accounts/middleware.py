@@ -1,18 +1,95 @@
+import hashlib
+import time
+
+import jwt
 from channels.db import database_sync_to_async
+from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
 from rest_framework_simplejwt.tokens import AccessToken
 from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from rest_framework_simplejwt.settings import api_settings
 from urllib.parse import parse_qs
-from apps.accounts.models import User
+from apps.accounts.models import SNAPSHOT_FIELD_NAMES, User
+
+# Verified tokens are remembered (by jti, with a digest of the whole token)
+# until they expire, and users as a compact snapshot invalidated on changes, so
+# reconnecting with a token that was already accepted needs no DB query.
+TOKEN_CACHE_PREFIX = 'accounts:ws-token'
+USER_CACHE_PREFIX = 'accounts:user'
+USER_SNAPSHOT_TTL = getattr(settings, 'ACCOUNTS_USER_SNAPSHOT_TTL', 300)
+SNAPSHOT_FIELDS = [
+    field.attname for field in User._meta.concrete_fields
+    if field.attname in SNAPSHOT_FIELD_NAMES
+]
+
+
+def token_cache_key(jti):
+    return f'{TOKEN_CACHE_PREFIX}:{jti}'
+
+
+def user_snapshot_key(user_id):
+    return f'{USER_CACHE_PREFIX}:{user_id}'
+
+
+def user_from_snapshot(values):
+    """
+    User instance from snapshot values. The other fields are deferred, so
+    reading one loads it and save() only writes the snapshot fields.
+    """
+    return User.from_db('default', SNAPSHOT_FIELDS, values)
+
+
+def _cached_user(token_string, digest):
+    """The user for a token verified before, or None on any cache miss."""
+    try:
+        claims = jwt.decode(token_string, options={'verify_signature': False})
+        jti, user_id = claims[api_settings.JTI_CLAIM], claims[api_settings.USER_ID_CLAIM]
+        expires_at = claims['exp']
+    except (jwt.InvalidTokenError, KeyError):
+        return None
+    if expires_at <= time.time():
+        return None
+
+    token_key, user_key = token_cache_key(jti), user_snapshot_key(user_id)
+    found = cache.get_many([token_key, user_key])
+    if found.get(token_key) != digest:
+        return None
+    if user_key in found:
+        return found[user_key]
+    return _load_snapshot(user_id)
+
+
+def _load_snapshot(user_id):
+    values = User.objects.filter(pk=user_id).values_list(*SNAPSHOT_FIELDS).first()
+    if values is not None:
+        cache.set(user_snapshot_key(user_id), values, timeout=USER_SNAPSHOT_TTL)
+    return values
+
 
 @database_sync_to_async
 def get_user_from_token(token_string):
-    try:
-        access_token = AccessToken(token_string)
-        user_id = access_token['user_id']
-        return User.objects.get(id=user_id)
-    except (InvalidToken, TokenError, User.DoesNotExist):
+    digest = hashlib.sha256(token_string.encode()).hexdigest()
+    values = _cached_user(token_string, digest)
+
+    if values is None:
+        try:
+            access_token = AccessToken(token_string)
+            user_id = access_token[api_settings.USER_ID_CLAIM]
+            jti = access_token[api_settings.JTI_CLAIM]
+        except (InvalidToken, TokenError, KeyError):
+            return AnonymousUser()
+        lifetime = int(access_token['exp'] - time.time())
+        if lifetime > 0:
+            cache.set(token_cache_key(jti), digest, timeout=lifetime)
+        values = cache.get(user_snapshot_key(user_id)) or _load_snapshot(user_id)
+        if values is None:
+            return AnonymousUser()
+
+    user = user_from_snapshot(values)
+    if not user.is_active:
         return AnonymousUser()
+    return user
 
 class JwtAuthMiddleware:
     """
@@ -1,7 +1,32 @@
-from django.contrib.auth.models import AbstractUser
+from django.contrib.auth.models import AbstractUser, UserManager as AuthUserManager
 from django.db import models
+from django.dispatch import Signal
 import uuid
 
+# Fields cached in the WebSocket auth snapshot (see middleware)
+SNAPSHOT_FIELD_NAMES = frozenset(['id', 'username', 'email', 'phone', 'avatar_url',
+                                  'is_active', 'is_staff', 'is_superuser'])
+
+# Sent with `user_ids` after a bulk update() of snapshot fields, which
+# skips post_save
+users_updated = Signal()
+
+
+class UserQuerySet(models.QuerySet):
+    def update(self, **kwargs):
+        """update(), plus users_updated when it changes snapshot fields (e.g. bulk deactivation)"""
+        if not SNAPSHOT_FIELD_NAMES.intersection(kwargs):
+            return super().update(**kwargs)
+        user_ids = list(self.values_list('pk', flat=True))
+        updated = super().update(**kwargs)
+        users_updated.send(sender=self.model, user_ids=user_ids)
+        return updated
+
+
+class UserManager(AuthUserManager.from_queryset(UserQuerySet)):
+    pass
+
+
 class User(AbstractUser):
     """
     Custom User model with additional fields for messaging.
@@ -15,6 +40,8 @@ class User(AbstractUser):
     
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+
+    objects = UserManager()
     
     class Meta:
         db_table = 'users'
@@ -0,0 +1,19 @@
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .middleware import user_snapshot_key
+from .models import User, users_updated
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_user_snapshot(sender, instance, **kwargs):
+    """Drop the cached WebSocket auth snapshot whenever a user changes."""
+    cache.delete(user_snapshot_key(instance.pk))
+
+
+@receiver(users_updated, sender=User)
+def invalidate_user_snapshots(sender, user_ids, **kwargs):
+    """Same for bulk updates (queryset.update() does not send post_save)."""
+    cache.delete_many([user_snapshot_key(user_id) for user_id in user_ids])
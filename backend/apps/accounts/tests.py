@@ -1,3 +1,57 @@
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
 from django.test import TestCase
+from rest_framework_simplejwt.tokens import AccessToken
 
-# Create your tests here.
+from .middleware import get_user_from_token
+from .models import User
+
+authenticate = get_user_from_token.func
+
+
+class WebSocketAuthCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(
+            username='alice', email='alice@example.com', phone='+1555', password='pass1234'
+        )
+        self.token = str(AccessToken.for_user(self.user))
+
+    def test_reconnect_with_verified_token_skips_db(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(authenticate(self.token).pk, self.user.pk)
+        with self.assertNumQueries(0):
+            user = authenticate(self.token)
+        self.assertEqual(user.username, 'alice')
+        self.assertTrue(user.is_authenticated)
+
+    def test_user_update_invalidates_snapshot(self):
+        authenticate(self.token)
+        self.user.username = 'alice2'
+        self.user.save()
+        with self.assertNumQueries(1):
+            self.assertEqual(authenticate(self.token).username, 'alice2')
+
+        self.user.is_active = False
+        self.user.save()
+        self.assertIsInstance(authenticate(self.token), AnonymousUser)
+
+    def test_bulk_deactivation_invalidates_snapshot(self):
+        authenticate(self.token)
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        self.assertIsInstance(authenticate(self.token), AnonymousUser)
+
+    def test_cache_hit_requires_the_same_token(self):
+        authenticate(self.token)
+        header, payload, signature = self.token.split('.')
+        forged = f'{header}.{payload}.{signature[:-4]}AAAA'
+        self.assertIsInstance(authenticate(forged), AnonymousUser)
+
+    def test_snapshot_saves_only_its_own_fields(self):
+        authenticate(self.token)
+        user = authenticate(self.token)
+        user.avatar_url = 'https://example.com/a.png'
+        user.save()
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.avatar_url, 'https://example.com/a.png')
+        self.assertTrue(self.user.check_password('pass1234'))
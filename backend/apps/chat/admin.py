@@ -10,7 +10,7 @@ class ChatAdmin(admin.ModelAdmin):
 
 @admin.register(ChatParticipant)
 class ChatParticipantAdmin(admin.ModelAdmin):
-    list_display = ['chat', 'user', 'role', 'joined_at']
+    list_display = ['chat', 'user', 'role', 'unread_count', 'joined_at']
     list_filter = ['role', 'joined_at']
     search_fields = ['user__username', 'chat__id']
 
@@ -0,0 +1,184 @@
+"""
+Fan-out of channel-layer events from REST views.
+
+Views describe what to send in a Broadcast and call send(). Nothing goes
+out before the current transaction commits (straight away outside one),
+and then the events are delivered off the request thread:
+
+- on the event loop registered with Broadcaster.bind_loop(), which the
+  chat consumer does with the server's loop under ASGI;
+- otherwise (WSGI, management commands) on a loop thread owned by the
+  Broadcaster.
+
+The response never waits for them, so its latency does not grow with the
+number of recipients. Logged events are appended to the recipients' replay
+streams in one thread hop per broadcast, one broadcast at a time, so event
+ids follow the order broadcasts were delivered in. Each recipient then has
+one sender task that sends its events one after another in that order,
+across broadcasts; different recipients are sent to concurrently (at most
+BROADCAST_CONCURRENCY sends at a time).
+"""
+import asyncio
+import logging
+import threading
+from collections import OrderedDict, deque
+
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+
+from . import events
+
+logger = logging.getLogger(__name__)
+
+BROADCAST_CONCURRENCY = getattr(settings, 'CHAT_BROADCAST_CONCURRENCY', 100)
+
+
+class Broadcast:
+    """Events for users' groups, sent together once the transaction commits."""
+
+    def __init__(self):
+        self._items = []  # (user id, handler, message, logged)
+
+    def __len__(self):
+        return len(self._items)
+
+    def to_users(self, user_ids, handler, message):
+        """A client frame for each user, logged for replay."""
+        for user_id in user_ids:
+            self._items.append((str(user_id), handler, message, True))
+
+    def to_user(self, user_id, handler, message):
+        self.to_users([user_id], handler, message)
+
+    def chat_groups(self, user_ids, chat_id, joined):
+        """
+        Tell the users' live connections to join or leave a chat's group after
+        a membership change. This is a control event and is never sent to clients.
+        """
+        for user_id in user_ids:
+            self._items.append((str(user_id), 'chat_membership', {
+                'chat_id': str(chat_id), 'joined': joined,
+            }, False))
+
+    def send(self):
+        items, self._items = self._items, []
+        if items:
+            transaction.on_commit(lambda: broadcaster.submit(items))
+
+
+def _log(items):
+    """Channel-layer events per user, logging client frames for replay."""
+    per_user = OrderedDict()
+    for user_id, handler, message, logged in items:
+        if logged:
+            event = events.encode(handler, events.append(events.user_stream(user_id), message))
+        else:
+            event = {'type': handler, **message}
+        per_user.setdefault(user_id, []).append(event)
+    return per_user
+
+
+class _LoopState:
+    """Per-loop delivery state: the logging lock, send slots and per-user queues"""
+
+    def __init__(self, loop, concurrency):
+        self.loop = loop
+        self.log_lock = asyncio.Lock()
+        self.slots = asyncio.Semaphore(concurrency)
+        self.queues = {}   # user id -> deque of channel-layer events
+        self.senders = {}  # user id -> task draining its queue
+
+
+class Broadcaster:
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._server_loop = None
+        self._state = None
+
+    def bind_loop(self, loop):
+        """Deliver on `loop` (the ASGI server's, where the consumers and channel layer live) while it runs."""
+        self._server_loop = loop
+
+    def submit(self, items):
+        """Schedule delivery of (user id, handler, message, logged) items without waiting."""
+        loop = self._server_loop
+        if loop is None or loop.is_closed() or not loop.is_running():
+            loop = self._own_loop()
+        future = asyncio.run_coroutine_threadsafe(self._deliver(items), loop)
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def drain(self, timeout=None):
+        """Wait for everything submitted so far to be delivered (tests, benchmarks)."""
+        with self._lock:
+            pending = list(self._pending)
+        for future in pending:
+            try:
+                future.result(timeout)
+            except Exception:
+                pass
+
+    def _done(self, future):
+        with self._lock:
+            self._pending.discard(future)
+
+    def _own_loop(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(
+                    target=self._loop.run_forever, name='chat-broadcast', daemon=True
+                )
+                self._thread.start()
+            return self._loop
+
+    def _loop_state(self):
+        loop = asyncio.get_running_loop()
+        if self._state is None or self._state.loop is not loop:
+            self._state = _LoopState(loop, self.concurrency)
+        return self._state
+
+    async def _deliver(self, items):
+        """Log the items and queue them behind each recipient's earlier events."""
+        channel_layer = get_channel_layer()
+        state = self._loop_state()
+        senders = []
+        async with state.log_lock:
+            # Not thread-sensitive: the cache is thread-safe, and this must not
+            # queue behind sync views on the server's shared thread
+            per_user = await sync_to_async(_log, thread_sensitive=False)(items)
+            for user_id, user_events in per_user.items():
+                state.queues.setdefault(user_id, deque()).extend(user_events)
+                if user_id not in state.senders:
+                    state.senders[user_id] = asyncio.ensure_future(
+                        self._send_queued(state, channel_layer, user_id)
+                    )
+                senders.append(state.senders[user_id])
+        await asyncio.gather(*senders, return_exceptions=True)
+
+    async def _send_queued(self, state, channel_layer, user_id):
+        """Sender task of one recipient: send its queued events in order, then exit."""
+        queue = state.queues[user_id]
+        try:
+            while queue:
+                event = queue.popleft()
+                async with state.slots:
+                    try:
+                        await channel_layer.group_send(events.user_stream(user_id), event)
+                    except Exception:
+                        # One failing send must not stop the recipient's later events
+                        logger.exception('Broadcast to user %s failed', user_id)
+        finally:
+            del state.senders[user_id]
+            del state.queues[user_id]
+
+
+broadcaster = Broadcaster(concurrency=BROADCAST_CONCURRENCY)
@@ -0,0 +1,43 @@
+from django.conf import settings
+from django.core.checks import Error, Tags, Warning, register
+
+LOCAL_MEMORY_CACHE = 'django.core.cache.backends.locmem.LocMemCache'
+
+
+def _local_default_cache():
+    """The default cache's settings if it is local memory, else None"""
+    config = settings.CACHES.get('default', {})
+    return config if config.get('BACKEND') == LOCAL_MEMORY_CACHE else None
+
+
+@register(Tags.caches)
+def check_event_log_cache(app_configs, **kwargs):
+    """A local-memory default cache must hold at least one full replay log."""
+    from .events import EVENT_LOG_SIZE
+
+    config = _local_default_cache()
+    if config is None:
+        return []
+    # LocMemCache's own default
+    max_entries = int(config.get('OPTIONS', {}).get('MAX_ENTRIES', 300))
+    if max_entries > EVENT_LOG_SIZE:
+        return []
+    return [Error(
+        f'The default cache holds {max_entries} entries, fewer than one replay log '
+        f'(CHAT_EVENT_LOG_SIZE = {EVENT_LOG_SIZE}).',
+        hint="Raise its OPTIONS['MAX_ENTRIES'], or set REDIS_URL.",
+        id='chat.E001',
+    )]
+
+
+@register(Tags.caches, deploy=True)
+def check_shared_cache(app_configs, **kwargs):
+    """Replay logs and presence have to be shared by every server process."""
+    if _local_default_cache() is None:
+        return []
+    return [Warning(
+        'The default cache is local memory, so replay logs and presence are not '
+        'shared between server processes.',
+        hint='Set REDIS_URL.',
+        id='chat.W001',
+    )]
@@ -1,12 +1,27 @@
+import asyncio
 import json
+import logging
 import uuid
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
-from django.utils import timezone
+from django.conf import settings
+from django.db import IntegrityError
 from asgiref.sync import sync_to_async
 from .models import Chat, Message, ChatParticipant
+from . import events, ingest, outbound, receipts, services, typing_indicators, wire
+from .broadcast import broadcaster
+from .dedup import recent_sends
+from .membership import load_chat_members, membership_cache
+from .presence import PRESENCE_DEBOUNCE, announce as announce_presence, presence
+from .ratelimit import RATE_LIMIT_CLOSE_CODE, rate_limiter
 from apps.accounts.models import User
 
+OUTBOUND_BATCH_WINDOW = getattr(settings, 'CHAT_OUTBOUND_BATCH_MS', 10) / 1000
+OUTBOUND_BATCH_MAX = getattr(settings, 'CHAT_OUTBOUND_BATCH_MAX', 50)
+CLIENT_REQUEST_ID_LENGTH = Message._meta.get_field('client_request_id').max_length
+
+logger = logging.getLogger(__name__)
+
 
 class ChatConsumer(AsyncWebsocketConsumer):
     """
@@ -29,7 +44,28 @@ class ChatConsumer(AsyncWebsocketConsumer):
         if not self.user or not self.user.is_authenticated:
             await self.close()
             return
+
+        # REST broadcasts are delivered on this (the server's) loop
+        broadcaster.bind_loop(asyncio.get_running_loop())
         
+        # Inbound token buckets (see ratelimit)
+        self.rate_limit = rate_limiter.attach(str(self.user.id))
+
+        # JSON unless the client offered the MessagePack subprotocol
+        self.codec = wire.negotiate(self.scope.get('subprotocols'))
+        self.batching = params.get('batch') == '1'
+        # Every frame goes through a bounded queue drained by a writer task;
+        # clients that ack what they receive (?ack=1) also bound what is in flight
+        self.outbound = outbound.OutboundQueue(acks=params.get('ack') == '1')
+        self.outbound_ready = asyncio.Event()
+        self.outbound_full = asyncio.Event()
+        self.outbound_room = asyncio.Event()
+        self.outbound_room.set()
+        self.outbound_idle = asyncio.Event()
+        self.outbound_idle.set()
+        self.resyncing = False
+        self.writer = asyncio.ensure_future(self.write_outbound())
+
         # Store user's channel name
         self.user_id = str(self.user.id)
         self.user_group_name = f"user_{self.user_id}"
@@ -39,11 +75,39 @@ class ChatConsumer(AsyncWebsocketConsumer):
             self.user_group_name,
             self.channel_name
         )
+
+        # Join the group of every chat the user is in, so a chat broadcast
+        # is a single group_send. Kept in sync by chat_membership events.
+        self.chat_ids = set(await self.get_user_chat_ids())
+        for chat_id in self.chat_ids:
+            await self.channel_layer.group_add(events.chat_stream(chat_id), self.channel_name)
+        # Chat stream positions at join time; anything after arrives live
+        self.joined_heads = await sync_to_async(events.heads)(
+            [events.chat_stream(chat_id) for chat_id in self.chat_ids]
+        )
         
-        # Mark user as online
-        await self.set_user_online(True)
+        self.presence_pending = {}
+        self.presence_sent = {}
+        self.presence_flush = None
+        self.presence_announce = None
         
-        await self.accept()
+        await self.accept(subprotocol=self.codec.subprotocol)
+        # Whatever was sent to the user's chats so far now reaches them
+        receipts.delivery.reconnected(self.user_id)
+        # Count the connection; the user is online while any of theirs is open.
+        # Contacts are told in the background, not during the handshake.
+        if await presence.connect(self.user_id):
+            self.presence_announce = asyncio.ensure_future(
+                announce_presence(self.channel_layer, self.user_id, set(self.chat_ids), True)
+            )
+
+        # Resume: replay what was sent to the user while they were away.
+        # Live events already queue up behind this since we joined the groups above.
+        # Chat streams are resumed with a `resume` frame (see handle_resume).
+        self.last_event_id = 0
+        last_event_id = params.get('last_event_id')
+        if last_event_id is not None:
+            await self.replay_events(last_event_id)
     
     async def disconnect(self, close_code):
         """
@@ -51,24 +115,53 @@ class ChatConsumer(AsyncWebsocketConsumer):
         """
         # Only update status if we have an authenticated user
         if hasattr(self, 'user') and self.user and self.user.is_authenticated:
-            # Mark user as offline
-            await self.set_user_online(False)
+            # An online announcement still in flight must not land after the offline one
+            if getattr(self, 'presence_announce', None):
+                self.presence_announce.cancel()
+            # Offline once their last connection closes
+            if await presence.disconnect(self.user_id):
+                await announce_presence(self.channel_layer, self.user_id, getattr(self, 'chat_ids', ()), False)
+            if getattr(self, 'presence_flush', None):
+                self.presence_flush.cancel()
+            if getattr(self, 'writer', None):
+                self.writer.cancel()
+            if getattr(self, 'rate_limit', None):
+                rate_limiter.detach(self.rate_limit)
             
             # Leave user's personal group
             await self.channel_layer.group_discard(
                 self.user_group_name,
                 self.channel_name
             )
+            for chat_id in getattr(self, 'chat_ids', ()):
+                await self.channel_layer.group_discard(events.chat_stream(chat_id), self.channel_name)
     
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         """
         Handle incoming WebSocket messages.
         """
+        # Charged before decoding, so frames that fail to decode are limited too
+        retry_after = rate_limiter.check_frame(self.rate_limit)
+        if retry_after:
+            await self.reject_rate_limited(None, None, retry_after)
+            return
+        try:
+            data = self.codec.decode(text_data, bytes_data)
+        except wire.InvalidFrame:
+            data = None
+        if not isinstance(data, dict):
+            await self.reject_invalid_frame()
+            return
+
         try:
-            data = json.loads(text_data)
             event_type = data.get('type')
             request_id = data.get('request_id')
             payload = data.get('payload', {})
+
+            retry_after = rate_limiter.check(self.rate_limit, event_type)
+            if retry_after:
+                await self.reject_rate_limited(event_type, request_id, retry_after)
+                return
             
             # Route message based on type
             if event_type == 'message.send':
@@ -79,27 +172,35 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 await self.handle_typing_stop(payload)
             elif event_type == 'message.read':
                 await self.handle_message_read(payload)
+            elif event_type == 'resume':
+                await self.handle_resume(payload)
+            elif event_type == 'ack':
+                self.handle_ack(payload)
             elif event_type == 'ping':
-                await self.send(text_data=json.dumps({'type': 'pong'}))
+                await presence.heartbeat(self.user_id)
+                await self.send_frame({'type': 'pong'})
         
-        except json.JSONDecodeError:
-            await self.send_error("Invalid JSON")
-        except Exception as e:
-            await self.send_error(str(e))
+        except (TypeError, ValueError):
+            # Malformed payload fields, such as a chat_id that is not a UUID
+            await self.send_error('Invalid request')
+        except Exception:
+            # The details stay in the server log, not in the reply
+            logger.exception('Could not handle a %r frame', data.get('type'))
+            await self.send_error('Could not process the request')
     
+    def handle_ack(self, payload):
+        """The client's count of frames received, which shrinks the backlog (see outbound)"""
+        self.outbound.ack(payload.get('received'))
+        if self.outbound.has_room():
+            self.outbound_room.set()
+
     async def handle_message_send(self, payload, request_id):
         """
         Handle sending a new message.
         """
-        chat_id = payload.get('chat_id')
+        chat_id = self.parse_chat_id(payload)
         message_type = payload.get('message_type', 'text')
         
-        # Verify user is participant
-        is_participant = await self.is_chat_participant(chat_id, self.user_id)
-        if not is_participant:
-            await self.send_error("Not a participant in this chat")
-            return
-        
         # Create message in database
         message_data = {
             'chat_id': chat_id,
@@ -115,177 +216,412 @@ class ChatConsumer(AsyncWebsocketConsumer):
             message_data['file_size'] = payload.get('file_size')
             message_data['mime_type'] = payload.get('mime_type')
         
-        message = await self.create_message(message_data)
-        
-        # Get all participants
-        participant_ids = await self.get_chat_participants(chat_id)
-        
-        # Broadcast to all participants
-        message_payload = {
-            'type': 'message.new',
-            'payload': await self.serialize_message(message)
-        }
-        
-        for participant_id in participant_ids:
-            await self.channel_layer.group_send(
-                f"user_{participant_id}",
-                {
-                    'type': 'chat_message',
-                    'message': message_payload
-                }
+        # Frames resent after a reconnect carry the same request_id: ack them
+        # again from the recent-sends cache instead of storing a duplicate
+        client_request_id = self.parse_request_id(request_id)
+        if client_request_id:
+            sent = recent_sends.get(self.user_id, client_request_id)
+            if sent is not None:
+                await self.send_ack(request_id, sent)
+                return
+            message_data['client_request_id'] = client_request_id
+
+        if ingest.BATCHING_ENABLED:
+            # Write-behind: stored with other pending messages in one batch
+            if not await self.is_chat_participant(chat_id, self.user_id):
+                await self.send_error("Not a participant in this chat")
+                return
+            try:
+                message = await ingest.ingestor.submit(message_data)
+            except IntegrityError:
+                message = await database_sync_to_async(self.find_sent_message)(client_request_id)
+                if message is None:
+                    raise
+                created = False
+            else:
+                created = True
+            message_payload = {'type': 'message.new', 'payload': self.serialize_message(message)}
+            if created:
+                message_payload = await sync_to_async(events.append)(
+                    events.chat_stream(chat_id), message_payload
+                )
+        else:
+            # Membership check, insert, payload and replay-log entry in a single thread hop
+            result = await self.create_message(chat_id, message_data)
+            if result is None:
+                await self.send_error("Not a participant in this chat")
+                return
+            message_payload, created = result
+
+        if client_request_id:
+            recent_sends.set(self.user_id, client_request_id, message_payload['payload'])
+        if created:
+            # Broadcast to all participants (already logged for replay)
+            # seq and sender_id let receivers record the delivery without decoding it
+            await events.asend_to_chat(
+                self.channel_layer, chat_id, 'chat_message', message_payload, log=False,
+                chat=chat_id, seq=message_payload['payload']['seq'],
+                sender_id=self.user_id,
             )
+        await self.send_ack(request_id, message_payload['payload'])
+
+    async def send_ack(self, request_id, message):
+        """Confirm a stored message to the sender, correlated by request_id"""
+        await self.send_frame({
+            'type': 'message.ack',
+            'request_id': request_id,
+            'payload': {
+                'message_id': message['message_id'],
+                'chat_id': message['chat_id'],
+                'seq': message['seq'],
+                'timestamp': message['timestamp'],
+            }
+        })
     
     async def handle_typing_start(self, payload):
         """
-        Handle typing indicator start.
+        Handle typing indicator start (coalesced, see typing_indicators).
         """
-        chat_id = payload.get('chat_id')
-        participant_ids = await self.get_chat_participants(chat_id)
-        
-        for participant_id in participant_ids:
-            if participant_id != self.user_id:
-                await self.channel_layer.group_send(
-                    f"user_{participant_id}",
-                    {
-                        'type': 'typing_indicator',
-                        'message': {
-                            'type': 'typing.start',
-                            'payload': {
-                                'chat_id': chat_id,
-                                'user_id': self.user_id
-                            }
-                        }
-                    }
-                )
+        chat_id = self.parse_chat_id(payload)
+        if not await self.is_chat_participant(chat_id, self.user_id):
+            return
+        typing_indicators.tracker.start(self.channel_layer, chat_id, self.user_id)
     
     async def handle_typing_stop(self, payload):
         """
         Handle typing indicator stop.
         """
-        chat_id = payload.get('chat_id')
-        participant_ids = await self.get_chat_participants(chat_id)
-        
-        for participant_id in participant_ids:
-            if participant_id != self.user_id:
-                await self.channel_layer.group_send(
-                    f"user_{participant_id}",
-                    {
-                        'type': 'typing_indicator',
-                        'message': {
-                            'type': 'typing.stop',
-                            'payload': {
-                                'chat_id': chat_id,
-                                'user_id': self.user_id
-                            }
-                        }
-                    }
-                )
+        chat_id = self.parse_chat_id(payload)
+        if not await self.is_chat_participant(chat_id, self.user_id):
+            return
+        typing_indicators.tracker.stop(self.channel_layer, chat_id, self.user_id)
     
     async def handle_message_read(self, payload):
         """
-        Handle message read receipt.
+        Handle a read receipt: the user has read the chat up to `message_id`.
         """
-        message_id = payload.get('message_id')
-        chat_id = payload.get('chat_id')
-        
-        # Update message status
-        await self.mark_message_as_read(message_id)
-        
-        # Get message sender
-        sender_id = await self.get_message_sender(message_id)
-        
-        # Notify sender
-        await self.channel_layer.group_send(
-            f"user_{sender_id}",
-            {
-                'type': 'message_status',
-                'message': {
-                    'type': 'message.read',
-                    'payload': {
-                        'message_id': message_id,
-                        'read_at': timezone.now().isoformat()
-                    }
-                }
-            }
-        )
+        chat_id = self.parse_chat_id(payload)
+        read = await self.mark_read_up_to(chat_id, payload.get('message_id'))
+        if read is None:
+            return
+        receipt, sender_ids = read
+
+        # One range receipt per sender whose messages were read
+        for sender_id in sender_ids:
+            await events.asend_to_user(self.channel_layer, sender_id, 'message_status', receipt)
+
+    async def replay_events(self, last_event_id):
+        """
+        Send events missed since `last_event_id`, or ask the client to
+        resync over REST if they have already fallen out of the log.
+        """
+        stream = events.user_stream(self.user_id)
+        try:
+            last_event_id = int(last_event_id)
+            missed = await sync_to_async(events.replay)(stream, last_event_id)
+        except ValueError:
+            missed = None
+
+        if missed is None:
+            self.last_event_id = await sync_to_async(events.head)(stream)
+            await self.send_frame({
+                'type': 'sync.required',
+                'payload': {'last_event_id': self.last_event_id}
+            })
+            return
+
+        for message in missed:
+            await self.wait_for_room()
+            await self.send_frame(message)
+        self.last_event_id = missed[-1]['event_id'] if missed else last_event_id
+
+    async def handle_resume(self, payload):
+        """
+        Replay chat streams: payload is {'streams': {'chat_<id>': last_event_id}}.
+        Only events from before this connection joined the chat's group are
+        replayed; later ones were delivered live.
+        """
+        for stream, last_event_id in (payload.get('streams') or {}).items():
+            if stream not in self.joined_heads:
+                continue
+            try:
+                missed = await sync_to_async(events.replay)(
+                    stream, int(last_event_id), upto=self.joined_heads[stream]
+                )
+            except (TypeError, ValueError):
+                missed = None
+
+            if missed is None:
+                await self.send_frame({
+                    'type': 'sync.required',
+                    'payload': {'stream': stream, 'last_event_id': self.joined_heads[stream]}
+                })
+                continue
+            for message in missed:
+                await self.wait_for_room()
+                await self.send_frame(message)
+
+    def is_replayed(self, event):
+        """True for live user-stream events that were already sent during replay."""
+        event_id = event.get('event_id')
+        if event_id is None or event.get('stream') != self.user_group_name:
+            return False
+        return event_id <= self.last_event_id
     
-    # Channel layer handlers
+    # Channel layer handlers: frames arrive encoded once by the sender (events.encode)
     async def chat_message(self, event):
         """Send message to WebSocket"""
-        await self.send(text_data=json.dumps(event['message']))
+        if self.is_replayed(event):
+            return
+        queued = await self.deliver(self.codec.forward(event['text']))
+        # Someone else's new message has reached this user (see receipts)
+        if queued and 'seq' in event and event['sender_id'] != self.user_id:
+            receipts.delivery.delivered(event['chat'], self.user_id, event['seq'])
     
     async def typing_indicator(self, event):
-        """Send typing indicator to WebSocket"""
-        await self.send(text_data=json.dumps(event['message']))
+        """Send a coalesced typing update to WebSocket, leaving out the user's own typing"""
+        if self.user_id not in event['users']:
+            await self.deliver(self.codec.forward(event['text']), ephemeral=True)
+            return
+        message = json.loads(event['text'])
+        payload = message['payload']
+        typing = [u for u in payload['typing'] if u != self.user_id]
+        stopped = [u for u in payload['stopped'] if u != self.user_id]
+        if typing or stopped:
+            message['payload'] = {**payload, 'typing': typing, 'stopped': stopped}
+            await self.send_frame(message, ephemeral=True)
+
+    async def chat_membership(self, event):
+        """Join or leave a chat's group after the user was added or removed"""
+        chat_id = event['chat_id']
+        group = events.chat_stream(chat_id)
+        # The change may have been made by another process: drop this
+        # process's cached members so a removed user's sends are refused
+        membership_cache.invalidate(chat_id)
+        if event['joined'] and chat_id not in self.chat_ids:
+            self.chat_ids.add(chat_id)
+            await self.channel_layer.group_add(group, self.channel_name)
+            self.joined_heads[group] = await sync_to_async(events.head)(group)
+        elif not event['joined'] and chat_id in self.chat_ids:
+            self.chat_ids.discard(chat_id)
+            await self.channel_layer.group_discard(group, self.channel_name)
+            self.joined_heads.pop(group, None)
     
+    async def presence_update(self, event):
+        """Collect a contact's presence change; sent debounced by flush_presence"""
+        payload = event['message']['payload']
+        if payload['user_id'] == self.user_id:
+            # Our own change, through a chat group we are in
+            return
+        self.presence_pending[payload['user_id']] = payload
+        if self.presence_flush is None:
+            self.presence_flush = asyncio.ensure_future(self.flush_presence())
+
+    async def flush_presence(self):
+        """
+        One presence.update frame per debounce window with each contact's
+        latest state, leaving out contacts that flapped back to what this
+        connection was last told.
+        """
+        await asyncio.sleep(PRESENCE_DEBOUNCE)
+        pending, self.presence_pending = self.presence_pending, {}
+        self.presence_flush = None
+        changes = [
+            payload for user_id, payload in pending.items()
+            if self.presence_sent.get(user_id) != payload['is_online']
+        ]
+        if not changes:
+            return
+        sent = await self.send_frame({
+            'type': 'presence.update',
+            'payload': {'users': changes}
+        }, ephemeral=True)
+        if sent:
+            for payload in changes:
+                self.presence_sent[payload['user_id']] = payload['is_online']
+
     async def message_status(self, event):
         """Send message status update to WebSocket"""
-        await self.send(text_data=json.dumps(event['message']))
+        if self.is_replayed(event):
+            return
+        await self.deliver(self.codec.forward(event['text']))
     
+    def parse_request_id(self, request_id):
+        """request_id usable as a dedup key, or None if missing or too long"""
+        if isinstance(request_id, str) and 0 < len(request_id) <= CLIENT_REQUEST_ID_LENGTH:
+            return request_id
+        return None
+
+    def parse_chat_id(self, payload):
+        """Canonical chat id string, so group and cache keys always match"""
+        return str(uuid.UUID(str(payload.get('chat_id'))))
+
+    async def send_frame(self, message, ephemeral=False):
+        """Send a message to this connection in its negotiated wire format"""
+        return await self.deliver(self.codec.encode(message), ephemeral)
+
+    async def deliver(self, frame, ephemeral=False):
+        """
+        Queue an encoded frame for the writer task; returns whether it was
+        queued. An overloaded connection (see outbound.OutboundQueue) is
+        closed so the client resyncs.
+        """
+        if self.resyncing:
+            return False
+        result = self.outbound.push(frame, ephemeral)
+        if result == outbound.OVERLOADED:
+            await self.close_for_resync()
+            return False
+        if result == outbound.DROPPED:
+            return False
+        if not self.outbound.has_room():
+            self.outbound_room.clear()
+        if self.batching and len(self.outbound) >= OUTBOUND_BATCH_MAX:
+            self.outbound_full.set()
+        self.outbound_idle.clear()
+        self.outbound_ready.set()
+        return True
+
+    async def wait_for_room(self):
+        """Let bulk senders (replay) wait for the queue instead of overloading it"""
+        await self.outbound_room.wait()
+
+    async def write_outbound(self):
+        """
+        Writer task: send queued frames in order. Clients that opted into
+        batching (?batch=1) get the frames queued within OUTBOUND_BATCH_WINDOW,
+        or up to OUTBOUND_BATCH_MAX of them, as one `batch` frame.
+        Under Daphne send() returns once the frame is buffered, so this does
+        not wait for a slow socket; client acks track that (see outbound).
+        """
+        while True:
+            await self.outbound_ready.wait()
+            if self.batching and len(self.outbound) < OUTBOUND_BATCH_MAX:
+                try:
+                    await asyncio.wait_for(self.outbound_full.wait(), OUTBOUND_BATCH_WINDOW)
+                except asyncio.TimeoutError:
+                    pass
+            self.outbound_ready.clear()
+            self.outbound_full.clear()
+            while len(self.outbound):
+                frames = self.outbound.pop(OUTBOUND_BATCH_MAX if self.batching else 1)
+                # One WebSocket frame, a batch counting as one
+                self.outbound.sent()
+                if self.outbound.has_room():
+                    self.outbound_room.set()
+                if len(frames) == 1:
+                    await self.send(**frames[0])
+                else:
+                    await self.send(**self.codec.batch(frames))
+            if self.outbound.has_room():
+                self.outbound_room.set()
+            self.outbound_idle.set()
+
+    async def close_after_flush(self, code):
+        """Close once what is already queued has been written (waiting at most a second)"""
+        try:
+            await asyncio.wait_for(self.outbound_idle.wait(), 1)
+        except asyncio.TimeoutError:
+            pass
+        await self.close(code=code)
+
+    async def close_for_resync(self):
+        """Drop what is queued and close; the client resyncs over REST before reconnecting"""
+        self.resyncing = True
+        self.outbound.clear()
+        outbound.metrics.resync_closes += 1
+        await self.close(code=outbound.RESYNC_CLOSE_CODE)
+
+    async def reject_rate_limited(self, event_type, request_id, retry_after):
+        """Tell the client when to retry, or disconnect it if it keeps going"""
+        if not rate_limiter.reject(self.rate_limit):
+            await self.send_frame({
+                'type': 'error',
+                'payload': {'message': 'Too many requests', 'code': 'rate_limited'}
+            })
+            await self.close_after_flush(RATE_LIMIT_CLOSE_CODE)
+            return
+        await self.send_frame({
+            'type': 'error',
+            'request_id': request_id,
+            'payload': {
+                'message': 'Rate limit exceeded',
+                'code': 'rate_limited',
+                'event': event_type,
+                'retry_after': round(retry_after, 3),
+            }
+        })
+
+    async def reject_invalid_frame(self):
+        """Undecodable frames count as abuse, like rate limited ones"""
+        if not rate_limiter.reject(self.rate_limit):
+            await self.send_frame({
+                'type': 'error',
+                'payload': {'message': 'Too many invalid frames', 'code': 'invalid_frame'}
+            })
+            await self.close_after_flush(RATE_LIMIT_CLOSE_CODE)
+            return
+        await self.send_frame({
+            'type': 'error',
+            'payload': {'message': 'Invalid frame', 'code': 'invalid_frame'}
+        })
+
     async def send_error(self, error_message):
         """Send error to client"""
-        await self.send(text_data=json.dumps({
+        await self.send_frame({
             'type': 'error',
             'payload': {'message': error_message}
-        }))
+        })
     
     # Database operations
     @database_sync_to_async
-    def set_user_online(self, is_online):
-        """Set user online status"""
-        self.user.is_online = is_online
-        if not is_online:
-            self.user.last_seen_at = timezone.now()
-        self.user.save()
-    
-    @database_sync_to_async
-    def is_chat_participant(self, chat_id, user_id):
+    def get_user_chat_ids(self):
+        """IDs of all chats the user is in"""
+        return [
+            str(chat_id) for chat_id in
+            ChatParticipant.objects.filter(user_id=self.user_id).values_list('chat_id', flat=True)
+        ]
+
+    async def is_chat_participant(self, chat_id, user_id):
         """Check if user is participant in chat"""
-        return ChatParticipant.objects.filter(
-            chat_id=chat_id, user_id=user_id
-        ).exists()
+        return str(user_id) in await self.get_chat_participants(chat_id)
     
     @database_sync_to_async
-    def create_message(self, data):
-        """Create a new message"""
-        return Message.objects.create(**data)
+    def create_message(self, chat_id, data):
+        """Membership check, insert, payload and replay-log entry (see services.send_message)"""
+        return services.send_message(self.user, chat_id, data)
+
+    def find_sent_message(self, client_request_id):
+        """The message this user already sent with a request_id, if any"""
+        return services.find_sent_message(self.user_id, client_request_id)
     
-    @database_sync_to_async
-    def get_chat_participants(self, chat_id):
-        """Get all participant IDs for a chat"""
-        return list(
-            ChatParticipant.objects.filter(chat_id=chat_id)
-            .values_list('user_id', flat=True)
-        )
+    async def get_chat_participants(self, chat_id):
+        """Get all participant IDs for a chat (cached per process, DB only on a miss)"""
+        members = membership_cache.get(chat_id)
+        if members is None:
+            members = await database_sync_to_async(load_chat_members)(chat_id)
+        return members
     
-    @database_sync_to_async
     def serialize_message(self, message):
-        """Serialize message to dict"""
-        return {
-            'message_id': str(message.id),
-            'chat_id': str(message.chat_id),
-            'sender_id': str(message.sender_id),
-            'sender_username': message.sender.username,  # Add sender username
-            'message_type': message.message_type,
-            'content': message.content,
-            'file_id': str(message.file_id) if message.file_id else None,
-            'file_name': message.file_name,
-            'file_size': message.file_size,
-            'mime_type': message.mime_type,
-            'status': message.status,
-            'timestamp': message.created_at.isoformat()
-        }
+        """Serialize a message sent by the connected user (no queries needed)"""
+        return services.message_payload(message, self.user.username)
     
     @database_sync_to_async
-    def mark_message_as_read(self, message_id):
-        """Mark message as read"""
-        message = Message.objects.get(id=message_id)
-        message.status = 'read'
-        message.read_at = timezone.now()
-        message.save()
-        return message
-    
-    @database_sync_to_async
-    def get_message_sender(self, message_id):
-        """Get sender ID of a message"""
-        return str(Message.objects.get(id=message_id).sender_id)
+    def mark_read_up_to(self, chat_id, message_id):
+        """
+        Mark the chat read up to a message (see services.read_up_to).
+        Returns (receipt, sender ids), or None if the user is not in the chat
+        or the message is not in it.
+        """
+        participant = ChatParticipant.objects.filter(chat_id=chat_id, user_id=self.user_id).first()
+        if participant is None:
+            return None
+        try:
+            mark = Message.objects.only('id', 'chat_id', 'seq', 'created_at').get(
+                pk=message_id, chat_id=chat_id
+            )
+        except Message.DoesNotExist:
+            return None
+        from_seq = participant.last_read_seq
+        _updated, sender_ids = services.read_up_to(participant, mark)
+        return services.read_receipt(participant, mark, from_seq), sender_ids
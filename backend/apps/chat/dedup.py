@@ -0,0 +1,33 @@
+from django.conf import settings
+
+from .lru import TTLCache
+
+
+class RecentSends:
+    """
+    Process-wide LRU cache of (sender id, request_id) -> serialized message
+    for messages sent recently over WebSocket.
+
+    A client resending a frame after a reconnect is answered from here with
+    another ack, without touching the database or broadcasting again. Misses
+    (another process, or an expired entry) fall back to the unique
+    (sender, client_request_id) index on Message.
+    """
+
+    def __init__(self, max_size, ttl):
+        self._entries = TTLCache(max_size, ttl)
+
+    def get(self, sender_id, request_id):
+        return self._entries.get((str(sender_id), request_id))
+
+    def set(self, sender_id, request_id, message):
+        self._entries.set((str(sender_id), request_id), message)
+
+    def clear(self):
+        self._entries.clear()
+
+
+recent_sends = RecentSends(
+    max_size=getattr(settings, 'CHAT_SEND_DEDUP_CACHE_SIZE', 10000),
+    ttl=getattr(settings, 'CHAT_SEND_DEDUP_CACHE_TTL', 300),
+)
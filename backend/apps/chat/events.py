@@ -0,0 +1,115 @@
+"""
+Replay log and fan-out helpers for channel-layer groups.
+
+Events go either to a user's group (`user_<id>`: chat.*, participant.*,
+read receipts) or to a chat's group (`chat_<id>`: message.new, typing),
+which every connection of every member joins. Each group is also a replay
+stream: a ring buffer in the cache made of a monotonically increasing head
+counter plus EVENT_LOG_SIZE slots that expire after EVENT_LOG_TTL seconds.
+The default cache has to be shared between server processes and hold at
+least one full log (checked at startup, see checks).
+Logged events carry their `stream` and `event_id`, so a reconnecting client
+can pass the last id it saw per stream and get the missed events replayed.
+
+Frames are JSON-encoded once here, by the sender, and travel through the
+channel layer as `text` that every receiving connection forwards as-is.
+"""
+import json
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+
+EVENT_LOG_SIZE = getattr(settings, 'CHAT_EVENT_LOG_SIZE', 500)
+EVENT_LOG_TTL = getattr(settings, 'CHAT_EVENT_LOG_TTL', 300)
+KEY_PREFIX = 'chat:events'
+
+
+def _head_key(stream):
+    return f'{KEY_PREFIX}:{stream}:head'
+
+
+def _slot_key(stream, event_id):
+    return f'{KEY_PREFIX}:{stream}:{event_id % EVENT_LOG_SIZE}'
+
+
+def user_stream(user_id):
+    return f'user_{user_id}'
+
+
+def chat_stream(chat_id):
+    return f'chat_{chat_id}'
+
+
+def append(stream, message):
+    """
+    Store a message in the stream's replay log.
+    Returns a copy of the message carrying its `event_id`.
+    """
+    head_key = _head_key(stream)
+    cache.add(head_key, 0, timeout=None)
+    event_id = cache.incr(head_key)
+    message = {**message, 'stream': stream, 'event_id': event_id}
+    cache.set(_slot_key(stream, event_id), message, timeout=EVENT_LOG_TTL)
+    return message
+
+
+def head(stream):
+    return cache.get(_head_key(stream), 0)
+
+
+def heads(streams):
+    """Current head of several streams in one cache round trip."""
+    found = cache.get_many([_head_key(stream) for stream in streams])
+    return {stream: found.get(_head_key(stream), 0) for stream in streams}
+
+
+def replay(stream, last_event_id, upto=None):
+    """
+    Return the events logged after `last_event_id` (up to `upto` if given),
+    oldest first. Returns None when some of them are no longer in the buffer
+    (overwritten or expired) and the client has to resync instead.
+    """
+    current = head(stream) if upto is None else upto
+    if last_event_id > current or current - last_event_id > EVENT_LOG_SIZE:
+        return None
+
+    ids = range(last_event_id + 1, current + 1)
+    slots = cache.get_many([_slot_key(stream, event_id) for event_id in ids])
+    events = []
+    for event_id in ids:
+        message = slots.get(_slot_key(stream, event_id))
+        if message is None or message['event_id'] != event_id:
+            return None
+        events.append(message)
+    return events
+
+
+def encode(handler, message, **meta):
+    """
+    Channel-layer event for a client frame: the frame encoded once as `text`,
+    plus the replay position and any `meta` receivers need to filter on
+    without decoding it.
+    """
+    event = {'type': handler, 'text': json.dumps(message), **meta}
+    if 'event_id' in message:
+        event['stream'] = message['stream']
+        event['event_id'] = message['event_id']
+    return event
+
+
+async def asend_to_user(channel_layer, user_id, handler, message):
+    """Log a message for replay and send it to the user's group (async code)."""
+    message = await sync_to_async(append)(user_stream(user_id), message)
+    await channel_layer.group_send(user_stream(user_id), encode(handler, message))
+
+
+async def asend_to_chat(channel_layer, chat_id, handler, message, log=True, **meta):
+    """
+    One group_send reaching every connection of every chat member.
+    Ephemeral events (typing) pass log=False to skip the replay log.
+    """
+    if log:
+        message = await sync_to_async(append)(chat_stream(chat_id), message)
+    await channel_layer.group_send(chat_stream(chat_id), encode(handler, message, **meta))
+
@@ -0,0 +1,83 @@
+import asyncio
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+from . import services
+from .workers import LoopWorker
+
+BATCHING_ENABLED = getattr(settings, 'CHAT_INGEST_BATCHING', False)
+
+
+class MessageIngestor:
+    """
+    Write-behind queue for incoming messages.
+
+    Consumers submit messages and wait; a worker task on the event loop
+    collects them for up to `flush_ms` milliseconds (or until `max_batch`
+    are waiting) and stores the whole batch with services.create_messages in
+    one transaction. Each submitter is resumed with its saved Message only
+    after the batch has committed.
+    """
+
+    def __init__(self, flush_ms, max_batch):
+        self.flush_interval = flush_ms / 1000
+        self.max_batch = max_batch
+        self._queue = None
+        self._full = None
+        self._worker = LoopWorker(self._run, setup=self._new_queue)
+
+    async def submit(self, data):
+        """Queue a message for the next batch; returns it once it is committed."""
+        self._worker.ensure()
+        future = self._worker.loop.create_future()
+        self._queue.put_nowait((data, future))
+        if self._queue.qsize() >= self.max_batch:
+            self._full.set()
+        return await future
+
+    def _new_queue(self):
+        # Queues and events belong to one event loop
+        self._queue = asyncio.Queue()
+        self._full = asyncio.Event()
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            if self._queue.qsize() + 1 < self.max_batch:
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._full.clear()
+            while len(batch) < self.max_batch and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            await self._flush(batch)
+
+    async def _flush(self, batch):
+        try:
+            messages = await database_sync_to_async(services.create_messages)(
+                [data for data, _future in batch]
+            )
+        except Exception:
+            # One bad message must not fail everyone else's: retry them one by one
+            for data, future in batch:
+                try:
+                    message = await database_sync_to_async(services.create_message)(**data)
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    if not future.done():
+                        future.set_result(message)
+            return
+
+        for (_data, future), message in zip(batch, messages):
+            if not future.done():
+                future.set_result(message)
+
+
+ingestor = MessageIngestor(
+    flush_ms=getattr(settings, 'CHAT_INGEST_FLUSH_MS', 5),
+    max_batch=getattr(settings, 'CHAT_INGEST_MAX_BATCH', 100),
+)
@@ -0,0 +1,84 @@
+import asyncio
+import time
+import uuid
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework_simplejwt.tokens import AccessToken
+
+from apps.accounts.middleware import JwtAuthMiddleware, get_user_from_token
+from apps.accounts.models import User
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure WebSocket connect authentication, first connects versus '
+        'reconnects with already verified tokens: time and queries per '
+        'authentication, and connects/sec through JwtAuthMiddleware. Creates '
+        'throwaway users and deletes them afterwards.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100,
+                            help='Distinct users/tokens (default: 100; two cache entries per user)')
+        parser.add_argument('--reconnects', type=int, default=5,
+                            help='Reconnect rounds after the first connect (default: 5)')
+
+    def handle(self, *args, **options):
+        tag = uuid.uuid4().hex[:8]
+        users = User.objects.bulk_create([
+            User(username=f'bench-{tag}-{i}', email=f'bench-{tag}-{i}@example.com',
+                 phone=f'bench-{tag}-{i}')
+            for i in range(options['users'])
+        ])
+        tokens = [str(AccessToken.for_user(user)) for user in users]
+
+        try:
+            cache.clear()
+            first = self.authenticate_all(tokens)
+            reconnect = self.authenticate_all(tokens)
+
+            cache.clear()
+            first_rate = asyncio.run(self.connect_all(tokens))
+            reconnect_rates = [asyncio.run(self.connect_all(tokens))
+                               for _ in range(options['reconnects'])]
+        finally:
+            User.objects.filter(pk__in=[user.pk for user in users]).delete()
+
+        reconnect_rate = sum(reconnect_rates) / len(reconnect_rates)
+        self.stdout.write('authentication (per connect):')
+        self.stdout.write(f'  first connect: {first[0]:>8.0f} us  {first[1]:.1f} queries')
+        self.stdout.write(f'  reconnect:     {reconnect[0]:>8.0f} us  {reconnect[1]:.1f} queries')
+        self.stdout.write('through JwtAuthMiddleware:')
+        self.stdout.write(f'  first connect: {first_rate:>8.0f} connects/s')
+        self.stdout.write(f'  reconnect:     {reconnect_rate:>8.0f} connects/s  '
+                          f'({reconnect_rate / first_rate:.1f}x)')
+
+    def authenticate_all(self, tokens):
+        """Microseconds and queries per token for the synchronous authentication step."""
+        authenticate = get_user_from_token.func
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            for token in tokens:
+                assert authenticate(token).is_authenticated
+            elapsed = time.perf_counter() - start
+        return elapsed / len(tokens) * 1e6, len(queries) / len(tokens)
+
+    async def connect_all(self, tokens):
+        authenticated = 0
+
+        async def app(scope, receive, send):
+            nonlocal authenticated
+            authenticated += scope['user'].is_authenticated
+
+        middleware = JwtAuthMiddleware(app)
+        start = time.perf_counter()
+        await asyncio.gather(*[
+            middleware({'type': 'websocket', 'query_string': f'token={token}'.encode()}, None, None)
+            for token in tokens
+        ])
+        elapsed = time.perf_counter() - start
+        assert authenticated == len(tokens)
+        return len(tokens) / elapsed
@@ -0,0 +1,86 @@
+import asyncio
+import json
+import statistics
+import time
+import uuid
+
+from channels.layers import InMemoryChannelLayer
+from django.core.management.base import BaseCommand
+
+from apps.chat import events
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare CPU time per chat fan-out when every receiving connection '
+        'JSON-encodes the frame itself versus forwarding a frame encoded once '
+        'by the sender.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='10,100,1000',
+                            help='Comma separated group sizes (default: 10,100,1000)')
+        parser.add_argument('--rounds', type=int, default=20,
+                            help='Broadcasts per size and mode (default: 20)')
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        asyncio.run(self.run(sizes, options['rounds']))
+
+    async def run(self, sizes, rounds):
+        self.stdout.write(f"{'members':>8} {'per-receiver ms':>16} {'encode-once ms':>15} {'speedup':>8}")
+        for size in sizes:
+            per_receiver = await self.measure(size, rounds, encode_once=False)
+            once = await self.measure(size, rounds, encode_once=True)
+            self.stdout.write(
+                f'{size:>8} {per_receiver:>16.3f} {once:>15.3f} {per_receiver / once:>7.1f}x'
+            )
+
+    def sample_message(self):
+        return {
+            'type': 'message.new',
+            'stream': f'chat_{uuid.uuid4()}',
+            'event_id': 1234,
+            'payload': {
+                'message_id': str(uuid.uuid4()),
+                'chat_id': str(uuid.uuid4()),
+                'seq': 1234,
+                'sender_id': str(uuid.uuid4()),
+                'sender_username': 'alice',
+                'message_type': 'text',
+                'content': 'Lorem ipsum dolor sit amet, consectetur adipiscing elit. ' * 3,
+                'file_id': None,
+                'file_name': None,
+                'file_size': None,
+                'mime_type': None,
+                'status': 'sent',
+                'timestamp': '2024-01-01T12:00:00.000000+00:00',
+            }
+        }
+
+    async def measure(self, size, rounds, encode_once):
+        """Median CPU ms from group_send until every member has its frame text."""
+        layer = InMemoryChannelLayer(capacity=rounds * 2 + 10)
+        group = f'chat_{uuid.uuid4()}'
+        channels = []
+        for _ in range(size):
+            channel = await layer.new_channel()
+            await layer.group_add(group, channel)
+            channels.append(channel)
+
+        message = self.sample_message()
+        timings = []
+        for _ in range(rounds):
+            start = time.process_time()
+            if encode_once:
+                await layer.group_send(group, events.encode('chat_message', message))
+                for channel in channels:
+                    text = (await layer.receive(channel))['text']
+            else:
+                await layer.group_send(group, {'type': 'chat_message', 'message': message})
+                for channel in channels:
+                    text = json.dumps((await layer.receive(channel))['message'])
+            timings.append((time.process_time() - start) * 1000)
+
+        await layer.flush()
+        return statistics.median(timings)
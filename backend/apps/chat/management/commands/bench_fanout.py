@@ -0,0 +1,70 @@
+import asyncio
+import statistics
+import time
+import uuid
+
+from channels.layers import InMemoryChannelLayer
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare chat broadcast latency: one group_send per participant '
+        '(user groups) versus a single group_send to the chat group.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='2,50,500',
+                            help='Comma separated chat sizes (default: 2,50,500)')
+        parser.add_argument('--rounds', type=int, default=20,
+                            help='Broadcasts per size and mode (default: 20)')
+        parser.add_argument('--rtt-ms', type=float, default=0.0,
+                            help='Simulated channel-layer round trip per group_send, '
+                                 'e.g. 0.2 for a local Redis (default: 0)')
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        self.rtt = options['rtt_ms'] / 1000
+        asyncio.run(self.run(sizes, options['rounds']))
+
+    async def group_send(self, layer, group, event):
+        if self.rtt:
+            await asyncio.sleep(self.rtt)
+        await layer.group_send(group, event)
+
+    async def run(self, sizes, rounds):
+        self.stdout.write(f"{'members':>8} {'per-user ms':>12} {'chat group ms':>14} {'speedup':>8}")
+        for size in sizes:
+            per_user = await self.measure(size, rounds, per_user=True)
+            per_chat = await self.measure(size, rounds, per_user=False)
+            self.stdout.write(
+                f'{size:>8} {per_user:>12.3f} {per_chat:>14.3f} {per_user / per_chat:>7.1f}x'
+            )
+
+    async def measure(self, size, rounds, per_user):
+        """Median time from first send until every member's channel has the event."""
+        layer = InMemoryChannelLayer(capacity=rounds * 2 + 10)
+        chat_group = f'chat_{uuid.uuid4()}'
+        members = []
+        for _ in range(size):
+            user_id = uuid.uuid4()
+            channel = await layer.new_channel()
+            await layer.group_add(f'user_{user_id}', channel)
+            await layer.group_add(chat_group, channel)
+            members.append((user_id, channel))
+
+        event = {'type': 'chat_message', 'message': {'type': 'message.new', 'payload': {}}}
+        timings = []
+        for _ in range(rounds):
+            start = time.perf_counter()
+            if per_user:
+                for user_id, _channel in members:
+                    await self.group_send(layer, f'user_{user_id}', event)
+            else:
+                await self.group_send(layer, chat_group, event)
+            for _user_id, channel in members:
+                await layer.receive(channel)
+            timings.append((time.perf_counter() - start) * 1000)
+
+        await layer.flush()
+        return statistics.median(timings)
@@ -0,0 +1,66 @@
+import asyncio
+import time
+import uuid
+
+from channels.db import database_sync_to_async
+from django.core.management.base import BaseCommand
+
+from apps.accounts.models import User
+from apps.chat import services
+from apps.chat.ingest import MessageIngestor
+from apps.chat.models import Chat, ChatParticipant
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure message ingestion throughput (messages/sec) with one '
+        'transaction per message versus write-behind batches. Uses a '
+        'throwaway chat in the configured database and deletes it afterwards.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=2000,
+                            help='Messages per mode (default: 2000)')
+        parser.add_argument('--senders', type=int, default=50,
+                            help='Concurrent senders (default: 50)')
+        parser.add_argument('--flush-ms', type=float, default=5,
+                            help='Batch flush window in ms (default: 5)')
+        parser.add_argument('--max-batch', type=int, default=100,
+                            help='Maximum messages per batch (default: 100)')
+
+    def handle(self, *args, **options):
+        tag = uuid.uuid4().hex[:8]
+        users = [
+            User.objects.create_user(username=f'bench-{tag}-{i}', email=f'bench-{tag}-{i}@example.com',
+                                     phone=f'bench-{tag}-{i}')
+            for i in range(2)
+        ]
+        chat = Chat.objects.create(type='group', name=f'bench-{tag}', created_by=users[0])
+        for user in users:
+            ChatParticipant.objects.create(chat=chat, user=user)
+
+        try:
+            ingestor = MessageIngestor(flush_ms=options['flush_ms'], max_batch=options['max_batch'])
+            direct = database_sync_to_async(services.create_message)
+
+            unbatched = asyncio.run(self.run(lambda data: direct(**data), chat, users, options))
+            batched = asyncio.run(self.run(ingestor.submit, chat, users, options))
+        finally:
+            chat.delete()
+            User.objects.filter(pk__in=[u.pk for u in users]).delete()
+
+        self.stdout.write(f'unbatched: {unbatched:>10.0f} msg/s')
+        self.stdout.write(f'batched:   {batched:>10.0f} msg/s  ({batched / unbatched:.1f}x)')
+
+    async def run(self, store, chat, users, options):
+        total, senders = options['messages'], options['senders']
+        per_sender = total // senders
+
+        async def sender(index):
+            user = users[index % len(users)]
+            for n in range(per_sender):
+                await store({'chat_id': chat.id, 'sender_id': user.id, 'content': f'{index}-{n}'})
+
+        start = time.perf_counter()
+        await asyncio.gather(*[sender(i) for i in range(senders)])
+        return per_sender * senders / (time.perf_counter() - start)
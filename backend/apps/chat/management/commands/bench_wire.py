@@ -0,0 +1,72 @@
+import time
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.chat import wire
+
+
+def sample_events():
+    chat_id, user_id = str(uuid.uuid4()), str(uuid.uuid4())
+    timestamp = '2024-01-01T12:00:00.123456+00:00'
+    return {
+        'message.new': {
+            'type': 'message.new', 'stream': f'chat_{chat_id}', 'event_id': 1234,
+            'payload': {
+                'message_id': str(uuid.uuid4()), 'chat_id': chat_id, 'seq': 1234,
+                'sender_id': user_id, 'sender_username': 'alice', 'message_type': 'text',
+                'content': 'See you at 6?', 'file_id': None, 'file_name': None,
+                'file_size': None, 'mime_type': None, 'status': 'sent', 'timestamp': timestamp,
+            },
+        },
+        'message.ack': {
+            'type': 'message.ack', 'request_id': 'req-lq3k2x-8f3k2j1a-42',
+            'payload': {'message_id': str(uuid.uuid4()), 'chat_id': chat_id, 'seq': 1234,
+                        'timestamp': timestamp},
+        },
+        'typing.update': {
+            'type': 'typing.update',
+            'payload': {'chat_id': chat_id, 'typing': [user_id], 'stopped': [], 'expires_in': 6},
+        },
+        'presence.update': {
+            'type': 'presence.update',
+            'payload': {'users': [{'user_id': user_id, 'is_online': False, 'last_seen_at': timestamp}]},
+        },
+    }
+
+
+class Command(BaseCommand):
+    help = 'Compare bytes and CPU per event for the JSON and MessagePack WebSocket wire formats.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=20000,
+                            help='Encodes and decodes per event and format (default: 20000)')
+
+    def handle(self, *args, **options):
+        if wire.MSGPACK is None:
+            raise CommandError('msgpack is not installed')
+        iterations = options['iterations']
+
+        self.stdout.write(
+            f"{'event':<16} {'json B':>7} {'msgpack B':>10} "
+            f"{'json enc us':>12} {'mp enc us':>10} {'mp fwd us':>10} {'json dec us':>12} {'mp dec us':>10}"
+        )
+        for name, message in sample_events().items():
+            text = wire.JSON.encode(message)['text_data']
+            binary = wire.MSGPACK.encode(message)['bytes_data']
+            json_enc = self.cpu_us(lambda: wire.JSON.encode(message), iterations)
+            mp_enc = self.cpu_us(lambda: wire.MSGPACK.encode(message), iterations)
+            # Fan-out: every further MessagePack receiver of an encoded-once frame
+            mp_fwd = self.cpu_us(lambda: wire.MSGPACK.forward(text), iterations)
+            json_dec = self.cpu_us(lambda: wire.JSON.decode(text_data=text), iterations)
+            mp_dec = self.cpu_us(lambda: wire.MSGPACK.decode(bytes_data=binary), iterations)
+            self.stdout.write(
+                f'{name:<16} {len(text.encode()):>7} {len(binary):>10} '
+                f'{json_enc:>12.2f} {mp_enc:>10.2f} {mp_fwd:>10.2f} {json_dec:>12.2f} {mp_dec:>10.2f}'
+            )
+
+    def cpu_us(self, func, iterations):
+        start = time.process_time()
+        for _ in range(iterations):
+            func()
+        return (time.process_time() - start) / iterations * 1e6
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from apps.chat.services import prune_tombstones
+
+
+class Command(BaseCommand):
+    help = (
+        'Delete delta sync tombstones older than CHAT_SYNC_RETENTION_DAYS. '
+        'Run periodically (e.g. daily from cron).'
+    )
+
+    def handle(self, *args, **options):
+        deleted = prune_tombstones()
+        self.stdout.write(f'Deleted {deleted} tombstones')
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from apps.chat.presence import sweep_expired
+
+
+class Command(BaseCommand):
+    help = (
+        'Mark users offline whose WebSocket connection counter has expired, '
+        'e.g. after a server process crashed. Run periodically (e.g. every '
+        'minute from cron), at an interval close to CHAT_PRESENCE_TTL_SECONDS.'
+    )
+
+    def handle(self, *args, **options):
+        swept = sweep_expired()
+        self.stdout.write(f'Marked {swept} users offline')
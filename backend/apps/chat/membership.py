@@ -0,0 +1,62 @@
+from django.conf import settings
+
+from .lru import TTLCache
+from .models import ChatParticipant
+
+
+class MembershipCache(TTLCache):
+    """
+    Process-wide LRU cache of chat id -> participant user ids.
+
+    Entries expire after `ttl` seconds and the least recently used ones are
+    evicted past `max_size`. ChatViewSet invalidates a chat whenever its
+    participants change, and so does every connection that receives the
+    change's chat_membership event, which covers the processes serving the
+    added and removed users. The TTL bounds staleness everywhere else.
+    """
+
+    def __init__(self, max_size, ttl):
+        super().__init__(max_size, ttl)
+        # Bumped on every invalidation so loads that raced with one are not cached
+        self._epoch = 0
+
+    def get(self, chat_id):
+        return super().get(str(chat_id))
+
+    def epoch(self):
+        return self._epoch
+
+    def set(self, chat_id, members, epoch=None):
+        with self.lock:
+            if epoch is not None and epoch != self._epoch:
+                return
+            super().set(str(chat_id), frozenset(members))
+
+    def invalidate(self, chat_id):
+        with self.lock:
+            self._epoch += 1
+            self.pop(str(chat_id))
+
+    def clear(self):
+        with self.lock:
+            self._epoch += 1
+            super().clear()
+
+
+membership_cache = MembershipCache(
+    max_size=getattr(settings, 'CHAT_MEMBERSHIP_CACHE_SIZE', 10000),
+    ttl=getattr(settings, 'CHAT_MEMBERSHIP_CACHE_TTL', 60),
+)
+
+
+def load_chat_members(chat_id):
+    """Participant user ids (as strings) for a chat, from the cache or the DB."""
+    members = membership_cache.get(chat_id)
+    if members is None:
+        epoch = membership_cache.epoch()
+        members = frozenset(
+            str(user_id) for user_id in
+            ChatParticipant.objects.filter(chat_id=chat_id).values_list('user_id', flat=True)
+        )
+        membership_cache.set(chat_id, members, epoch=epoch)
+    return members
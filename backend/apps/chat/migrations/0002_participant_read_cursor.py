@@ -0,0 +1,46 @@
+# Generated by Django 4.2.9 on 2026-10-16 20:29
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_unread_counts(apps, schema_editor):
+    """Seed the counters from the old global message status."""
+    ChatParticipant = apps.get_model('chat', 'ChatParticipant')
+    Message = apps.get_model('chat', 'Message')
+    for participant in ChatParticipant.objects.iterator():
+        unread = Message.objects.filter(
+            chat_id=participant.chat_id
+        ).exclude(
+            sender_id=participant.user_id
+        ).exclude(
+            status='read'
+        ).count()
+        if unread:
+            ChatParticipant.objects.filter(pk=participant.pk).update(unread_count=unread)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatparticipant',
+            name='last_read_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatparticipant',
+            name='last_read_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.message'),
+        ),
+        migrations.AddField(
+            model_name='chatparticipant',
+            name='unread_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_unread_counts, migrations.RunPython.noop),
+    ]
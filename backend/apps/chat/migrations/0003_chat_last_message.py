@@ -0,0 +1,71 @@
+# Generated by Django 4.2.9 on 2026-10-16 20:30
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def backfill_last_message(apps, schema_editor):
+    Chat = apps.get_model('chat', 'Chat')
+    Message = apps.get_model('chat', 'Message')
+    for chat in Chat.objects.iterator():
+        last = Message.objects.filter(chat_id=chat.id).order_by('-created_at').first()
+        if last is None:
+            Chat.objects.filter(pk=chat.pk).update(last_activity_at=chat.created_at)
+            continue
+        preview = last.content if last.message_type == 'text' else last.file_name
+        Chat.objects.filter(pk=chat.pk).update(
+            last_message_id=last.id,
+            last_message_sender_id=last.sender_id,
+            last_message_preview=(preview or '')[:140],
+            last_message_type=last.message_type,
+            last_message_at=last.created_at,
+            last_activity_at=last.created_at,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chat', '0002_participant_read_cursor'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='last_activity_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='last_message_id',
+            field=models.UUIDField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='last_message_preview',
+            field=models.CharField(blank=True, max_length=140, null=True),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='last_message_sender',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='last_message_type',
+            field=models.CharField(blank=True, max_length=10, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='chat',
+            index=models.Index(fields=['-last_activity_at'], name='chats_last_ac_2030c2_idx'),
+        ),
+        migrations.RunPython(backfill_last_message, migrations.RunPython.noop),
+    ]
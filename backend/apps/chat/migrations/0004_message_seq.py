@@ -0,0 +1,51 @@
+# Generated by Django 4.2.9 on 2026-10-16 20:41
+
+from django.db import migrations, models
+from django.db.models import Max, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def backfill_seq(apps, schema_editor):
+    """Number existing messages 1..n per chat in send order."""
+    Chat = apps.get_model('chat', 'Chat')
+    Message = apps.get_model('chat', 'Message')
+    # One set-based UPDATE for every chat: the ORM can't update from a
+    # window function, so this is SQL (UPDATE ... FROM, SQLite 3.33+ and PostgreSQL)
+    messages = schema_editor.quote_name(Message._meta.db_table)
+    schema_editor.execute(
+        f'UPDATE {messages} SET seq = numbered.seq FROM ('
+        f'SELECT id, ROW_NUMBER() OVER (PARTITION BY chat_id ORDER BY created_at, id) AS seq FROM {messages}'
+        f') AS numbered WHERE {messages}.id = numbered.id'
+    )
+    last_seq = Message.objects.filter(chat_id=OuterRef('pk')).values('chat_id').annotate(last=Max('seq')).values('last')
+    Chat.objects.update(last_seq=Coalesce(Subquery(last_seq), Value(0)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_chat_last_message'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='last_seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='seq',
+            field=models.PositiveBigIntegerField(null=True),
+        ),
+        migrations.RunPython(backfill_seq, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='message',
+            name='seq',
+            field=models.PositiveBigIntegerField(),
+        ),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(fields=('chat', 'seq'), name='messages_chat_seq_uniq'),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.2.9 on 2026-10-16 20:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_message_created_at_default'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='client_request_id',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(condition=models.Q(('client_request_id__isnull', False)), fields=('sender', 'client_request_id'), name='messages_sender_request_uniq'),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 4.2.9 on 2026-10-16 21:19
+
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery
+
+
+def backfill_cursors(apps, schema_editor):
+    """Start both receipt cursors at the existing read cursor."""
+    ChatParticipant = apps.get_model('chat', 'ChatParticipant')
+    Message = apps.get_model('chat', 'Message')
+    ChatParticipant.objects.filter(last_read_message__isnull=False).update(
+        last_read_seq=Subquery(Message.objects.filter(pk=OuterRef('last_read_message_id')).values('seq')[:1])
+    )
+    ChatParticipant.objects.update(last_delivered_seq=F('last_read_seq'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_message_client_request_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatparticipant',
+            name='last_delivered_seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='chatparticipant',
+            name='last_read_seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_cursors, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='chatparticipant',
+            index=models.Index(fields=['chat', 'last_delivered_seq'], name='chat_partic_chat_id_3ca20c_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chatparticipant',
+            index=models.Index(fields=['chat', 'last_read_seq'], name='chat_partic_chat_id_9dcd04_idx'),
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 4.2.9 on 2026-10-16 22:05
+
+from django.db import migrations
+
+# Frozen copies of search.FTS_TABLE and search.SEARCH_CONFIG
+FTS_TABLE = 'messages_search'
+SEARCH_CONFIG = 'simple'
+PG_INDEX = 'messages_content_search'
+
+
+def create_search_index(apps, schema_editor):
+    """FTS5 table filled from the existing messages on SQLite, GIN index on PostgreSQL."""
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute(
+            f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5("
+            f"content, message_id UNINDEXED, chat_id UNINDEXED, "
+            f"tokenize = 'unicode61 remove_diacritics 2')"
+        )
+        schema_editor.execute(
+            f"INSERT INTO {FTS_TABLE} (content, message_id, chat_id) "
+            f"SELECT content, id, chat_id FROM messages "
+            f"WHERE message_type = 'text' AND content IS NOT NULL AND content != ''"
+        )
+    elif vendor == 'postgresql':
+        from django.contrib.postgres.indexes import GinIndex
+        from django.contrib.postgres.search import SearchVector
+
+        # Built from the same expression search._search_postgres() filters on
+        Message = apps.get_model('chat', 'Message')
+        schema_editor.add_index(
+            Message, GinIndex(SearchVector('content', config=SEARCH_CONFIG), name=PG_INDEX)
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute(f"DROP TABLE IF EXISTS {FTS_TABLE}")
+    elif vendor == 'postgresql':
+        schema_editor.execute(f"DROP INDEX IF EXISTS {PG_INDEX}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_receipt_cursors'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
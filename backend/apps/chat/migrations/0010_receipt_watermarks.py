@@ -0,0 +1,43 @@
+# Generated by Django 4.2.9 on 2026-10-16 22:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0009_message_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='delivered_low_seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='delivered_slowest_id',
+            field=models.UUIDField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='delivered_slowest_seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='read_low_seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='read_slowest_id',
+            field=models.UUIDField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='read_slowest_seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
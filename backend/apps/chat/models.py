@@ -1,5 +1,6 @@
 from django.db import models
 from django.conf import settings
+from django.utils import timezone
 import uuid
 
 class Chat(models.Model):
@@ -10,6 +11,7 @@ class Chat(models.Model):
         ('private', 'Private'),
         ('group', 'Group'),
     ]
+    PREVIEW_LENGTH = 140
     
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     type = models.CharField(max_length=10, choices=CHAT_TYPE_CHOICES, default='private')
@@ -18,11 +20,32 @@ class Chat(models.Model):
                                     null=True, related_name='created_chats')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+
+    # Snapshot of the newest message, kept up to date on send
+    last_message_id = models.UUIDField(null=True, blank=True)
+    last_message_sender = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL,
+                                            null=True, blank=True, related_name='+')
+    last_message_preview = models.CharField(max_length=PREVIEW_LENGTH, null=True, blank=True)
+    last_message_type = models.CharField(max_length=10, null=True, blank=True)
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    last_activity_at = models.DateTimeField(default=timezone.now)
+    # Highest message sequence number allocated in this chat
+    last_seq = models.PositiveBigIntegerField(default=0)
+    # Receipt watermarks, where receipts.advance_status() last left off: the
+    # lowest cursor (every message up to it is done) and the slowest member
+    # with the second lowest cursor (their own messages are done up to it)
+    delivered_low_seq = models.PositiveBigIntegerField(default=0)
+    delivered_slowest_id = models.UUIDField(null=True, blank=True)
+    delivered_slowest_seq = models.PositiveBigIntegerField(default=0)
+    read_low_seq = models.PositiveBigIntegerField(default=0)
+    read_slowest_id = models.UUIDField(null=True, blank=True)
+    read_slowest_seq = models.PositiveBigIntegerField(default=0)
     
     class Meta:
         db_table = 'chats'
         indexes = [
             models.Index(fields=['type', 'created_at']),
+            models.Index(fields=['-last_activity_at']),
         ]
     
     def __str__(self):
@@ -44,12 +67,23 @@ class ChatParticipant(models.Model):
                              related_name='chat_memberships')
     role = models.CharField(max_length=10, choices=ROLE_CHOICES, default='member')
     joined_at = models.DateTimeField(auto_now_add=True)
+    # Read cursor: everything up to and including this message has been read
+    last_read_message = models.ForeignKey('Message', on_delete=models.SET_NULL, null=True,
+                                          blank=True, related_name='+')
+    last_read_at = models.DateTimeField(null=True, blank=True)
+    unread_count = models.PositiveIntegerField(default=0)
+    # Receipt cursors (see receipts): every message up to this seq has
+    # reached one of the member's connections / been read by the member
+    last_delivered_seq = models.PositiveBigIntegerField(default=0)
+    last_read_seq = models.PositiveBigIntegerField(default=0)
     
     class Meta:
         db_table = 'chat_participants'
         unique_together = ['chat', 'user']
         indexes = [
             models.Index(fields=['user', 'chat']),
+            models.Index(fields=['chat', 'last_delivered_seq']),
+            models.Index(fields=['chat', 'last_read_seq']),
         ]
     
     def __str__(self):
@@ -75,6 +109,10 @@ class Message(models.Model):
     chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='messages')
     sender = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, 
                                related_name='sent_messages')
+    seq = models.PositiveBigIntegerField()  # Gap-free per chat, allocated on insert
+    # The request_id of the WebSocket frame that created the message, so a
+    # frame the client resends after a reconnect is stored only once
+    client_request_id = models.CharField(max_length=64, null=True, blank=True)
     message_type = models.CharField(max_length=10, choices=MESSAGE_TYPE_CHOICES, default='text')
     content = models.TextField(null=True, blank=True)  # For text messages
     file_id = models.UUIDField(null=True, blank=True)  # Reference to File model
@@ -82,7 +120,10 @@ class Message(models.Model):
     file_size = models.BigIntegerField(null=True, blank=True)
     mime_type = models.CharField(max_length=100, null=True, blank=True)
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='sent')
-    created_at = models.DateTimeField(auto_now_add=True)
+    # Not auto_now_add so the send path can stamp the chat snapshot with the same time
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
+    # Bumped on every change (also by bulk .update() calls) for delta sync
+    updated_at = models.DateTimeField(auto_now=True)
     delivered_at = models.DateTimeField(null=True, blank=True)
     read_at = models.DateTimeField(null=True, blank=True)
     
@@ -92,7 +133,44 @@ class Message(models.Model):
         indexes = [
             models.Index(fields=['chat', '-created_at']),
             models.Index(fields=['sender', 'status']),
+            models.Index(fields=['chat', 'updated_at']),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['chat', 'seq'], name='messages_chat_seq_uniq'),
+            models.UniqueConstraint(
+                fields=['sender', 'client_request_id'],
+                condition=models.Q(client_request_id__isnull=False),
+                name='messages_sender_request_uniq',
+            ),
         ]
     
     def __str__(self):
         return f"Message {self.id} by {self.sender.username}"
+
+
+class SyncTombstone(models.Model):
+    """
+    Records removals for delta sync, one row per affected user, since the
+    removed rows themselves are gone.
+    """
+    KIND_CHOICES = [
+        ('chat.deleted', 'Chat deleted or user removed from it'),
+        ('participant.removed', 'Participant left or was removed'),
+    ]
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE,
+                             related_name='sync_tombstones')
+    kind = models.CharField(max_length=32, choices=KIND_CHOICES)
+    chat_id = models.UUIDField()
+    subject_id = models.UUIDField(null=True, blank=True)  # Removed user, if any
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'sync_tombstones'
+        indexes = [
+            models.Index(fields=['user', 'created_at']),
+            models.Index(fields=['created_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} {self.chat_id} for {self.user_id}"
@@ -0,0 +1,150 @@
+"""
+Bounded outbound queues for WebSocket connections.
+
+Every frame a ChatConsumer sends goes through its OutboundQueue and is
+written by a per-connection writer task. A connection's backlog is the
+frames accepted for the client and not known to have reached it: those
+still queued plus, for clients that acknowledge what they receive (see
+below), those written but not acked yet. Once it reaches
+OUTBOUND_HIGH_WATER:
+
+- ephemeral frames (typing, presence) are dropped, new ones and queued ones;
+- if the depth stays at or above the mark for OUTBOUND_OVERLOAD_SECONDS, or
+  reaches twice the mark, the connection is closed with RESYNC_CLOSE_CODE
+  and the client has to resync over REST before reconnecting.
+
+`metrics` tracks the live queues of this process (see snapshot()).
+
+ASGI gives the application no view of the transport: under Daphne
+`send()` returns as soon as the frame is in the server's write buffer, so
+written frames only tell us what left the writer, not what the client
+read. Clients that connect with ?ack=1 therefore report how many frames
+they have received on the connection, `{"type": "ack", "payload":
+{"received": n}}`, every few frames (well under the high-water mark) and
+when they go idle; what was written past
+that count is in flight, and a client that stops reading builds a
+backlog that sheds and closes it like any other. For clients without
+acks only the queue itself is bounded (a burst of fan-out arriving
+faster than the writer serves the connection).
+"""
+import time
+import weakref
+from collections import deque
+
+from django.conf import settings
+
+OUTBOUND_HIGH_WATER = getattr(settings, 'CHAT_OUTBOUND_HIGH_WATER', 200)
+OUTBOUND_OVERLOAD_SECONDS = getattr(settings, 'CHAT_OUTBOUND_OVERLOAD_SECONDS', 5)
+RESYNC_CLOSE_CODE = 4009
+
+# OutboundQueue.push() results
+QUEUED, DROPPED, OVERLOADED = 'queued', 'dropped', 'overloaded'
+
+DEPTH_BUCKETS = [(0, 0), (1, 9), (10, 99), (100, 999), (1000, None)]
+
+
+class OutboundMetrics:
+    """Queue depth distribution and shedding counters for this process."""
+
+    def __init__(self):
+        self._queues = weakref.WeakSet()
+        self.dropped_ephemeral = 0
+        self.resync_closes = 0
+
+    def register(self, queue):
+        self._queues.add(queue)
+
+    def snapshot(self):
+        queues = list(self._queues)
+        depths = [queue.backlog() for queue in queues]
+        distribution = {}
+        for low, high in DEPTH_BUCKETS:
+            label = str(low) if low == high else (f'{low}+' if high is None else f'{low}-{high}')
+            distribution[label] = sum(
+                1 for depth in depths if depth >= low and (high is None or depth <= high)
+            )
+        return {
+            'connections': len(depths),
+            'depth': distribution,
+            'max_depth': max(depths, default=0),
+            'over_high_water': sum(1 for queue in queues if not queue.has_room()),
+            'dropped_ephemeral': self.dropped_ephemeral,
+            'resync_closes': self.resync_closes,
+        }
+
+
+metrics = OutboundMetrics()
+
+
+class OutboundQueue:
+    """FIFO of encoded frames for one connection, with its backlog bounded by a high-water mark."""
+
+    def __init__(self, high_water=None, overload_seconds=None, acks=False, clock=time.monotonic):
+        self.high_water = high_water or OUTBOUND_HIGH_WATER
+        self.overload_seconds = overload_seconds or OUTBOUND_OVERLOAD_SECONDS
+        self.acks = acks
+        self.clock = clock
+        self._frames = deque()  # (frame, ephemeral)
+        self._over_since = None
+        self.written = 0  # frames handed to the server
+        self.acked = 0  # of those, the ones the client says it received
+        metrics.register(self)
+
+    def __len__(self):
+        return len(self._frames)
+
+    def backlog(self):
+        """Frames queued, plus those written but not acked by a client that acks."""
+        in_flight = self.written - self.acked if self.acks else 0
+        return len(self._frames) + in_flight
+
+    def sent(self, count=1):
+        """Count frames handed to the server by the writer."""
+        self.written += count
+
+    def ack(self, received):
+        """The client has received `received` frames on this connection so far."""
+        if isinstance(received, int) and not isinstance(received, bool):
+            self.acked = max(self.acked, min(received, self.written))
+
+    def push(self, frame, ephemeral=False):
+        """
+        Queue a frame. Returns QUEUED, DROPPED (an ephemeral frame over the
+        mark) or OVERLOADED (the connection has to be closed for a resync).
+        """
+        if self.backlog() >= self.high_water:
+            if ephemeral:
+                metrics.dropped_ephemeral += 1
+                return DROPPED
+            self._shed_ephemeral()
+
+        if self.backlog() >= self.high_water:
+            now = self.clock()
+            if self._over_since is None:
+                self._over_since = now
+            if (self.backlog() >= 2 * self.high_water
+                    or now - self._over_since >= self.overload_seconds):
+                return OVERLOADED
+        else:
+            self._over_since = None
+
+        self._frames.append((frame, ephemeral))
+        return QUEUED
+
+    def pop(self, count):
+        """Take up to `count` frames off the front."""
+        frames = []
+        while self._frames and len(frames) < count:
+            frames.append(self._frames.popleft()[0])
+        return frames
+
+    def has_room(self):
+        return self.backlog() < self.high_water
+
+    def clear(self):
+        self._frames.clear()
+
+    def _shed_ephemeral(self):
+        kept = deque(item for item in self._frames if not item[1])
+        metrics.dropped_ephemeral += len(self._frames) - len(kept)
+        self._frames = kept
@@ -0,0 +1,157 @@
+import base64
+
+from django.conf import settings
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+
+
+class MessageCursorPagination(BasePagination):
+    """
+    Keyset pagination for chat history.
+
+    Pages are read off the unique (chat, seq) index, newest-first, and
+    returned in chronological order. Cursors are opaque and point at a
+    message position, so they stay valid while new messages keep arriving.
+
+    Query params:
+        before    - cursor for older messages (scroll back)
+        after     - cursor for newer messages (catch up)
+        page_size - number of messages per page
+    """
+    before_query_param = 'before'
+    after_query_param = 'after'
+    page_size_query_param = 'page_size'
+    page_size = getattr(settings, 'CHAT_MESSAGES_PAGE_SIZE', 50)
+    max_page_size = getattr(settings, 'CHAT_MESSAGES_MAX_PAGE_SIZE', 200)
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = self.get_page_size(request)
+        before = self.decode_cursor(request.query_params.get(self.before_query_param))
+        after = self.decode_cursor(request.query_params.get(self.after_query_param))
+
+        if after is not None:
+            # Catching up: oldest first from the cursor onwards
+            queryset = queryset.filter(seq__gt=after).order_by('seq')
+            rows = list(queryset[:self.page_size + 1])
+            self.has_newer = len(rows) > self.page_size
+            self.has_older = True
+            page = rows[:self.page_size]
+        else:
+            if before is not None:
+                queryset = queryset.filter(seq__lt=before)
+            queryset = queryset.order_by('-seq')
+            rows = list(queryset[:self.page_size + 1])
+            self.has_older = len(rows) > self.page_size
+            self.has_newer = before is not None
+            page = rows[:self.page_size]
+            page.reverse()
+
+        self.page = page
+        self.request_after = request.query_params.get(self.after_query_param)
+        return page
+
+    def get_paginated_response(self, data):
+        return Response({
+            'results': data,
+            'before': self.get_before_cursor(),
+            'after': self.get_after_cursor(),
+            'has_older': self.has_older,
+            'has_newer': self.has_newer,
+        })
+
+    def get_before_cursor(self):
+        if not self.page or not self.has_older:
+            return None
+        return self.encode_cursor(self.page[0])
+
+    def get_after_cursor(self):
+        # Always hand back a cursor for the newest message seen so clients
+        # can poll for anything sent after this page.
+        if not self.page:
+            return self.request_after
+        return self.encode_cursor(self.page[-1])
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if size <= 0:
+            return self.page_size
+        return min(size, self.max_page_size)
+
+    def encode_cursor(self, message):
+        raw = f"s{message.seq}"
+        return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+    def decode_cursor(self, encoded):
+        if not encoded:
+            return None
+        try:
+            padded = encoded + '=' * (-len(encoded) % 4)
+            raw = base64.urlsafe_b64decode(padded.encode()).decode()
+            if not raw.startswith('s'):
+                raise ValueError(raw)
+            return int(raw[1:])
+        except (TypeError, ValueError, UnicodeDecodeError):
+            raise NotFound(self.invalid_cursor_message)
+
+
+class MessageSearchPagination(BasePagination):
+    """
+    Offset pagination for ranked search results, which have no stable
+    position to key on. Cursors are opaque like MessageCursorPagination's.
+
+    Query params:
+        cursor    - `next` cursor of the previous page
+        page_size - number of results per page
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    page_size = getattr(settings, 'CHAT_SEARCH_PAGE_SIZE', 20)
+    max_page_size = getattr(settings, 'CHAT_SEARCH_MAX_PAGE_SIZE', 100)
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_search(self, search, request):
+        """Page of `search(offset, limit)`, which returns (results, has_more)."""
+        self.page_size = self.get_page_size(request)
+        self.offset = self.decode_cursor(request.query_params.get(self.cursor_query_param))
+        page, self.has_more = search(self.offset, self.page_size)
+        return page
+
+    def get_paginated_response(self, data):
+        return Response({
+            'results': data,
+            'next': self.encode_cursor(self.offset + self.page_size) if self.has_more else None,
+            'has_more': self.has_more,
+        })
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if size <= 0:
+            return self.page_size
+        return min(size, self.max_page_size)
+
+    def encode_cursor(self, offset):
+        raw = f"o{offset}"
+        return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+    def decode_cursor(self, encoded):
+        if not encoded:
+            return 0
+        try:
+            padded = encoded + '=' * (-len(encoded) % 4)
+            raw = base64.urlsafe_b64decode(padded.encode()).decode()
+            if not raw.startswith('o'):
+                raise ValueError(raw)
+            offset = int(raw[1:])
+            if offset < 0:
+                raise ValueError(raw)
+            return offset
+        except (TypeError, ValueError, UnicodeDecodeError):
+            raise NotFound(self.invalid_cursor_message)
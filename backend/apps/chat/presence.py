@@ -0,0 +1,202 @@
+"""
+Online presence for WebSocket connections.
+
+Each user has a connection counter in the presence cache (the
+CHAT_PRESENCE_CACHE alias, which must never evict), so a user with several
+devices stays online until the last one disconnects. Only transitions
+(first connection, last disconnection) change presence. They are queued
+and written to the users table every PRESENCE_FLUSH_INTERVAL seconds in
+batched update() calls that touch only `is_online` and `last_seen_at`.
+
+Counters expire PRESENCE_TTL seconds after the last connect or heartbeat,
+so connections lost with a crashed server process stop counting. Nothing
+is written when a counter expires, though: sweep_expired() (run
+periodically by manage.py sweep_presence) marks users whose counter is
+gone as offline in the users table. With more than one server process,
+that cache must be a shared backend.
+
+Transitions are also pushed as `presence.update` events to the users who
+share a chat with the user, through the chat groups (see announce). The
+connecting consumer does this in the background after the handshake.
+Each receiving connection debounces them for PRESENCE_DEBOUNCE seconds,
+so a flapping connection costs a subscriber at most one frame per window.
+"""
+import asyncio
+
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Case, DateTimeField, Value, When
+from django.utils import timezone
+from django.utils.connection import ConnectionProxy
+
+from apps.accounts.models import User
+
+from . import events
+from .workers import LoopWorker, flush_periodically
+
+PRESENCE_FLUSH_INTERVAL = getattr(settings, 'CHAT_PRESENCE_FLUSH_SECONDS', 5)
+PRESENCE_TTL = getattr(settings, 'CHAT_PRESENCE_TTL_SECONDS', 120)
+PRESENCE_DEBOUNCE = getattr(settings, 'CHAT_PRESENCE_DEBOUNCE_MS', 1000) / 1000
+KEY_PREFIX = 'chat:presence'
+# Kept apart from the default cache, where replay logs could push counters out
+cache = ConnectionProxy(caches, getattr(settings, 'CHAT_PRESENCE_CACHE', 'default'))
+
+
+def _connections_key(user_id):
+    return f'{KEY_PREFIX}:{user_id}:connections'
+
+
+def connection_count(user_id):
+    return max(cache.get(_connections_key(user_id), 0), 0)
+
+
+def is_online(user_id):
+    return connection_count(user_id) > 0
+
+
+def _add_connection(user_id):
+    key = _connections_key(user_id)
+    cache.add(key, 0, timeout=PRESENCE_TTL)
+    count = cache.incr(key)
+    cache.touch(key, PRESENCE_TTL)
+    return count
+
+
+def _remove_connection(user_id):
+    key = _connections_key(user_id)
+    try:
+        count = cache.decr(key)
+    except ValueError:
+        # Counter already expired
+        return 0
+    if count < 0:
+        # More disconnects than connects after an expiry; undo without
+        # clobbering a concurrent connect
+        count = cache.incr(key, -count)
+    return count
+
+
+def _touch(user_id):
+    cache.touch(_connections_key(user_id), PRESENCE_TTL)
+
+
+def write_presence(changes):
+    """
+    Store presence changes, {user id: None (online) or last seen datetime},
+    in at most two UPDATE statements.
+    """
+    online = [user_id for user_id, seen in changes.items() if seen is None]
+    offline = {user_id: seen for user_id, seen in changes.items() if seen is not None}
+    if online:
+        User.objects.filter(pk__in=online).update(is_online=True)
+    if offline:
+        User.objects.filter(pk__in=offline).update(
+            is_online=False,
+            last_seen_at=Case(
+                *[When(pk=user_id, then=Value(seen)) for user_id, seen in offline.items()],
+                output_field=DateTimeField(),
+            ),
+        )
+
+
+def sweep_expired(batch_size=1000):
+    """
+    Mark users offline whose connection counter has expired (their server
+    process died without disconnecting them). last_seen_at is set to the
+    sweep time, at most PRESENCE_TTL plus the sweep interval late.
+    Returns the number of users marked offline.
+    """
+    swept = 0
+    last_pk = None
+    while True:
+        online = User.objects.filter(is_online=True).order_by('pk')
+        if last_pk is not None:
+            online = online.filter(pk__gt=last_pk)
+        user_ids = [str(pk) for pk in online.values_list('pk', flat=True)[:batch_size]]
+        if not user_ids:
+            return swept
+        last_pk = user_ids[-1]
+        counters = cache.get_many([_connections_key(user_id) for user_id in user_ids])
+        expired = [
+            user_id for user_id in user_ids
+            if counters.get(_connections_key(user_id), 0) <= 0
+        ]
+        if expired:
+            now = timezone.now()
+            write_presence({user_id: now for user_id in expired})
+            swept += len(expired)
+
+
+async def announce(channel_layer, user_id, chat_ids, is_online):
+    """
+    Push a presence change to the users who share a chat with the user (not
+    logged for replay): one group_send per chat group, sent concurrently.
+    Contacts in several of the chats get it more than once; their
+    connections merge repeats while debouncing.
+    """
+    event = {'type': 'presence_update', 'message': {
+        'type': 'presence.update',
+        'payload': {
+            'user_id': str(user_id),
+            'is_online': is_online,
+            'last_seen_at': None if is_online else timezone.now().isoformat(),
+        }
+    }}
+    await asyncio.gather(*[
+        channel_layer.group_send(events.chat_stream(chat_id), event) for chat_id in chat_ids
+    ])
+
+
+class PresenceService:
+    """
+    Connection counting plus write-behind of presence changes. A worker task
+    on the event loop flushes queued changes and exits when there are none.
+    """
+
+    def __init__(self, flush_interval):
+        self.flush_interval = flush_interval
+        self._pending = {}
+        self._worker = LoopWorker(lambda: flush_periodically(
+            self.flush_interval, lambda: self._pending, self.flush, 'Presence',
+        ))
+
+    async def connect(self, user_id):
+        """Count a new connection. Returns True if the user just came online."""
+        user_id = str(user_id)
+        if await sync_to_async(_add_connection)(user_id) != 1:
+            return False
+        self._queue(user_id, None)
+        return True
+
+    async def disconnect(self, user_id):
+        """Count a closed connection. Returns True if the user just went offline."""
+        user_id = str(user_id)
+        if await sync_to_async(_remove_connection)(user_id) > 0:
+            return False
+        self._queue(user_id, timezone.now())
+        return True
+
+    async def heartbeat(self, user_id):
+        """Keep the user's connection counter alive."""
+        await sync_to_async(_touch)(str(user_id))
+
+    def _queue(self, user_id, seen):
+        # Only the latest state per user is written
+        self._pending[user_id] = seen
+        self._worker.ensure()
+
+    async def flush(self):
+        changes, self._pending = self._pending, {}
+        if not changes:
+            return
+        try:
+            await database_sync_to_async(write_presence)(changes)
+        except Exception:
+            for user_id, seen in changes.items():
+                self._pending.setdefault(user_id, seen)
+            raise
+
+
+presence = PresenceService(flush_interval=PRESENCE_FLUSH_INTERVAL)
@@ -0,0 +1,137 @@
+"""
+In-memory token-bucket limits for inbound WebSocket frames.
+
+CHAT_WS_RATE_LIMITS maps an event type (or '*' for any other frame) to
+limits per scope, as (tokens per second, burst):
+
+    {'message.send': {'connection': (5, 20), 'user': (10, 40)}, ...}
+
+'connection' buckets belong to one socket; 'user' buckets are shared by all
+of a user's connections to this process. A frame is accepted only if every
+bucket that applies has a token. Every frame is also charged to the FRAME
+limits (or '*') before it is decoded, so frames that fail to decode are
+limited too. Rejections, and frames that cannot be decoded, drain an abuse
+bucket (CHAT_WS_ABUSE_LIMIT per CHAT_WS_ABUSE_WINDOW_SECONDS); a client
+that empties it gets disconnected.
+
+Everything is process-local and runs without I/O on the receive path.
+"""
+import threading
+import time
+
+from django.conf import settings
+
+# Limits for every inbound frame, checked before it is decoded
+FRAME = 'frame'
+DEFAULT_RATE_LIMITS = {
+    FRAME: {'connection': (30, 100)},
+    'message.send': {'connection': (5, 20), 'user': (10, 40)},
+    'message.read': {'connection': (10, 50), 'user': (20, 100)},
+    'typing.start': {'connection': (10, 20)},
+    'typing.stop': {'connection': (10, 20)},
+    'resume': {'connection': (0.2, 3)},
+    '*': {'connection': (20, 50)},
+}
+RATE_LIMITS = getattr(settings, 'CHAT_WS_RATE_LIMITS', DEFAULT_RATE_LIMITS)
+ABUSE_LIMIT = getattr(settings, 'CHAT_WS_ABUSE_LIMIT', 50)
+ABUSE_WINDOW = getattr(settings, 'CHAT_WS_ABUSE_WINDOW_SECONDS', 10)
+RATE_LIMIT_CLOSE_CODE = 4029
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def wait_time(self, now):
+        """Seconds until a token is available; 0 if one is available now."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class RateLimiter:
+    def __init__(self, limits, abuse_limit, abuse_window, clock=time.monotonic):
+        self.limits = limits
+        self.abuse_limit = abuse_limit
+        self.abuse_window = abuse_window
+        self.clock = clock
+        self._users = {}  # user id -> [connection count, {event type: bucket}]
+        self._lock = threading.Lock()
+
+    def attach(self, user_id):
+        """Register a connection; returns its state for check() and reject()."""
+        with self._lock:
+            entry = self._users.setdefault(user_id, [0, {}])
+            entry[0] += 1
+        return {
+            'user_id': user_id,
+            'buckets': {},
+            'abuse': TokenBucket(self.abuse_limit / self.abuse_window, self.abuse_limit, self.clock()),
+        }
+
+    def detach(self, connection):
+        user_id = connection['user_id']
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is not None:
+                entry[0] -= 1
+                if entry[0] <= 0:
+                    del self._users[user_id]
+
+    def _limits_for(self, event_type):
+        return self.limits.get(event_type) or self.limits.get('*') or {}
+
+    def _bucket(self, buckets, event_type, limit, now):
+        bucket = buckets.get(event_type)
+        if bucket is None:
+            bucket = buckets[event_type] = TokenBucket(*limit, now)
+        return bucket
+
+    def check(self, connection, event_type):
+        """
+        Take a token for a frame from every bucket that applies. Returns 0 if
+        the frame is allowed, otherwise the seconds to wait before retrying.
+        """
+        key = event_type if event_type in self.limits else '*'
+        return self._take(connection, key, self._limits_for(event_type))
+
+    def check_frame(self, connection):
+        """Same for a frame that is not decoded yet, against the FRAME limits."""
+        return self._take(connection, FRAME, self._limits_for(FRAME))
+
+    def _take(self, connection, key, limits):
+        now = self.clock()
+        buckets = []
+        if 'connection' in limits:
+            buckets.append(self._bucket(connection['buckets'], key, limits['connection'], now))
+        if 'user' in limits:
+            user_buckets = self._users.get(connection['user_id'], (0, {}))[1]
+            buckets.append(self._bucket(user_buckets, key, limits['user'], now))
+
+        retry_after = max([bucket.wait_time(now) for bucket in buckets], default=0)
+        if retry_after:
+            return retry_after
+        for bucket in buckets:
+            bucket.take()
+        return 0
+
+    def reject(self, connection):
+        """Count a rejected or undecodable frame. Returns False once the client should be disconnected."""
+        abuse = connection['abuse']
+        if abuse.wait_time(self.clock()):
+            return False
+        abuse.take()
+        return True
+
+
+rate_limiter = RateLimiter(RATE_LIMITS, ABUSE_LIMIT, ABUSE_WINDOW)
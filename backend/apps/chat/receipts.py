@@ -0,0 +1,223 @@
+"""
+Per-recipient delivery and read receipts.
+
+Each ChatParticipant has two cursors into the chat's message sequence:
+everything up to `last_delivered_seq` has reached one of the member's
+connections and everything up to `last_read_seq` has been read. A receipt
+is a monotonic UPDATE of one cursor however many messages it covers, and
+counts such as "read by 12/40" are COUNTs over the chat's participants by
+cursor (see with_receipt_counts), not rows per message and recipient.
+
+Message.status follows the slowest recipient: a message becomes
+'delivered' / 'read' once every other member's cursor has passed it (see
+advance_status), so a message row is written at most twice however big
+the chat is. Senders are told with a `messages.status` event.
+
+Deliveries are reported per connection, for every message.new it is sent
+and for all of the user's chats when it connects. DeliveryTracker queues
+them and writes them every DELIVERY_FLUSH_INTERVAL seconds, one UPDATE per
+(chat, seq) and reconnect batch, so a message fanned out to a 1,000-member
+group costs one cursor UPDATE per server process rather than 1,000.
+"""
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, Count, F, IntegerField, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from . import events
+from .broadcast import Broadcast
+from .models import Chat, ChatParticipant, Message
+from .workers import LoopWorker, flush_periodically
+
+DELIVERY_FLUSH_INTERVAL = getattr(settings, 'CHAT_DELIVERY_FLUSH_MS', 500) / 1000
+
+DELIVERED, READ = 'delivered', 'read'
+# Cursor, timestamp and statuses a message can move on from, per status
+STATUS_FIELDS = {
+    DELIVERED: ('last_delivered_seq', 'delivered_at', ['sent']),
+    READ: ('last_read_seq', 'read_at', ['sent', 'delivered']),
+}
+
+
+def advance_status(chat_id, status):
+    """
+    Move messages of a chat to `status` once every member other than their
+    sender has a cursor at or past them, with one UPDATE. Returns the
+    `messages.status` frames for the senders whose messages changed.
+
+    Only messages past the chat's watermarks for the status are looked at,
+    so the work is proportional to how far the cursors moved, not to the
+    chat's history, even while a member never reads.
+    """
+    cursor, stamp, before = STATUS_FIELDS[status]
+    with transaction.atomic():
+        # Serializes advances of the same chat, which read and move its watermarks
+        chat = Chat.objects.select_for_update().only(
+            'pk', f'{status}_low_seq', f'{status}_slowest_id', f'{status}_slowest_seq'
+        ).get(pk=chat_id)
+        # The two lowest cursors give each sender's lowest "other" cursor
+        lowest = list(
+            ChatParticipant.objects.filter(chat_id=chat_id).order_by(cursor).values_list('user_id', cursor)[:2]
+        )
+        if len(lowest) < 2:
+            return []
+        (slowest_id, low), (_, second) = lowest
+        if second == 0:
+            return []
+
+        done_low = getattr(chat, f'{status}_low_seq')
+        # The slowest member's own messages are done up to the previous second
+        # lowest cursor if they were the slowest then too, else up to done_low
+        done_slowest = done_low
+        if str(getattr(chat, f'{status}_slowest_id')) == str(slowest_id):
+            done_slowest = max(done_low, getattr(chat, f'{status}_slowest_seq'))
+        Chat.objects.filter(pk=chat_id).update(**{
+            f'{status}_low_seq': max(low, done_low),
+            f'{status}_slowest_id': slowest_id,
+            f'{status}_slowest_seq': max(second, done_slowest),
+        })
+
+        changed = Message.objects.filter(
+            Q(sender_id=slowest_id, seq__gt=done_slowest, seq__lte=second)
+            | (~Q(sender_id=slowest_id) & Q(seq__gt=done_low, seq__lte=low)),
+            chat_id=chat_id, status__in=before,
+        )
+        senders = list(changed.order_by().values_list('sender_id', flat=True).distinct())
+        if not senders:
+            return []
+
+        now = timezone.now()
+        updates = {'status': status, stamp: now, 'updated_at': now}
+        if status == READ:
+            updates['delivered_at'] = Coalesce('delivered_at', Value(now))
+        changed.update(**updates)
+
+    return [
+        (sender_id, {
+            'type': 'messages.status',
+            'payload': {
+                'chat_id': str(chat_id),
+                'status': status,
+                'up_to_seq': second if str(sender_id) == str(slowest_id) else low,
+            }
+        })
+        for sender_id in senders
+    ]
+
+
+def notify_status(frames):
+    """Queue messages.status frames from advance_status() for after the commit."""
+    broadcast = Broadcast()
+    for sender_id, frame in frames:
+        broadcast.to_user(sender_id, 'message_status', frame)
+    broadcast.send()
+
+
+def write_deliveries(deliveries, reconnected):
+    """
+    Store delivery cursors: {(chat id, user id): seq} for messages sent to
+    connections, and user ids whose every chat is delivered up to its
+    newest message. Returns the messages.status frames to send.
+
+    The cursors are committed before any chat is locked by advance_status(),
+    one transaction per chat: holding participant rows while waiting for a
+    chat row would invert the order create_messages() locks them in
+    (chat, then participants) and risk deadlocks.
+    """
+    chat_ids = set()
+    with transaction.atomic():
+        if reconnected:
+            behind = ChatParticipant.objects.filter(
+                user_id__in=reconnected, last_delivered_seq__lt=F('chat__last_seq')
+            )
+            chat_ids.update(str(chat_id) for chat_id in behind.values_list('chat_id', flat=True))
+            behind.update(last_delivered_seq=Subquery(
+                Chat.objects.filter(pk=OuterRef('chat_id')).values('last_seq')[:1]
+            ))
+
+        by_seq = {}
+        for (chat_id, user_id), seq in deliveries.items():
+            by_seq.setdefault((chat_id, seq), []).append(user_id)
+        for (chat_id, seq), user_ids in by_seq.items():
+            if ChatParticipant.objects.filter(
+                chat_id=chat_id, user_id__in=user_ids, last_delivered_seq__lt=seq
+            ).update(last_delivered_seq=seq):
+                chat_ids.add(chat_id)
+
+    frames = []
+    for chat_id in sorted(chat_ids):
+        frames += advance_status(chat_id, DELIVERED)
+    return frames
+
+
+def with_receipt_counts(messages, user):
+    """
+    Annotate `recipient_count`, `delivered_count` and `read_count` on the
+    user's own messages (None on everyone else's). Recipients are the
+    members other than the sender who were in the chat when it was sent.
+    """
+    recipients = ChatParticipant.objects.filter(
+        chat_id=OuterRef('chat_id'), joined_at__lte=OuterRef('created_at')
+    ).exclude(user_id=OuterRef('sender_id'))
+
+    def count(queryset):
+        total = queryset.order_by().values('chat_id').annotate(n=Count('pk')).values('n')[:1]
+        return Case(
+            When(sender_id=user.pk, then=Coalesce(Subquery(total), 0)),
+            default=None, output_field=IntegerField(),
+        )
+
+    return messages.annotate(
+        recipient_count=count(recipients),
+        delivered_count=count(recipients.filter(last_delivered_seq__gte=OuterRef('seq'))),
+        read_count=count(recipients.filter(last_read_seq__gte=OuterRef('seq'))),
+    )
+
+
+class DeliveryTracker:
+    """
+    Write-behind of delivery cursors. A worker task on the event loop
+    flushes what was queued and exits when there is nothing left.
+    """
+
+    def __init__(self, flush_interval):
+        self.flush_interval = flush_interval
+        self._deliveries = {}
+        self._reconnected = set()
+        self._worker = LoopWorker(lambda: flush_periodically(
+            self.flush_interval, lambda: self._deliveries or self._reconnected, self.flush, 'Delivery',
+        ))
+
+    def delivered(self, chat_id, user_id, seq):
+        """A message.new with `seq` was sent to one of the user's connections."""
+        key = (str(chat_id), str(user_id))
+        if seq > self._deliveries.get(key, 0):
+            self._deliveries[key] = seq
+            self._worker.ensure()
+
+    def reconnected(self, user_id):
+        """The user connected: everything in their chats so far is theirs."""
+        self._reconnected.add(str(user_id))
+        self._worker.ensure()
+
+    async def flush(self):
+        deliveries, self._deliveries = self._deliveries, {}
+        reconnected, self._reconnected = self._reconnected, set()
+        if not deliveries and not reconnected:
+            return
+        try:
+            frames = await database_sync_to_async(write_deliveries)(deliveries, reconnected)
+        except Exception:
+            for key, seq in deliveries.items():
+                self._deliveries[key] = max(seq, self._deliveries.get(key, 0))
+            self._reconnected |= reconnected
+            raise
+        channel_layer = get_channel_layer()
+        for sender_id, frame in frames:
+            await events.asend_to_user(channel_layer, sender_id, 'message_status', frame)
+
+
+delivery = DeliveryTracker(flush_interval=DELIVERY_FLUSH_INTERVAL)
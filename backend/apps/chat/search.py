@@ -0,0 +1,178 @@
+"""
+Full-text message search.
+
+Text messages are indexed per database backend:
+
+- SQLite: an FTS5 table, `messages_search`, with one row per message
+  (content, message id, chat id). Rows are added by the send path
+  (index_messages, called from services.create_messages) in the same
+  transaction as the messages themselves, and removed when their chat or
+  sender is deleted (unindex_chat / unindex_sender, see signals).
+- PostgreSQL: a GIN index on to_tsvector(SEARCH_CONFIG, content), which
+  the database keeps up to date itself.
+
+Both are created by migration 0009. Searches are scoped to the chats the
+user is currently in, ranked (bm25 / ts_rank) and return a highlighted
+fragment of each match, so a query only reads the index entries for its
+terms instead of scanning the messages table.
+
+Fragments are HTML: the message text is escaped and only the highlight
+tags are added (see highlight_html), so content is never markup.
+
+Hits are joined to their messages before a page is cut, so a search row
+whose message is gone never shortens a page.
+"""
+import re
+from html import escape
+
+from django.db import connection
+
+from .models import ChatParticipant, Message
+
+FTS_TABLE = 'messages_search'
+# Language-neutral: no stemming or stop words, chats mix languages
+SEARCH_CONFIG = 'simple'
+HIGHLIGHT_START, HIGHLIGHT_STOP = '<mark>', '</mark>'
+# What the database marks matches with: private-use characters, swapped for
+# the tags once the fragment is escaped
+MATCH_START, MATCH_STOP = '\ue000', '\ue001'
+SNIPPET_TOKENS = 16
+
+
+def search_terms(text):
+    """Words of a search box query; all of them must match."""
+    return re.findall(r'\w+', text or '')
+
+
+def highlight_html(fragment):
+    """A fragment marked with MATCH_START / MATCH_STOP as escaped HTML with highlight tags"""
+    return escape(fragment, quote=False).replace(MATCH_START, HIGHLIGHT_START).replace(MATCH_STOP, HIGHLIGHT_STOP)
+
+
+def index_messages(messages):
+    """Add new text messages to the search index (no-op where the database maintains it)."""
+    if connection.vendor != 'sqlite':
+        return
+    rows = [
+        (message.content, _hex(message.id), _hex(message.chat_id))
+        for message in messages
+        if message.message_type == 'text' and message.content
+    ]
+    # Multi-row INSERTs, batched like bulk_create to stay under SQLite's
+    # variable limit: a normal send is one statement
+    batch_size = connection.ops.bulk_batch_size(['content', 'message_id', 'chat_id'], rows)
+    with connection.cursor() as cursor:
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            cursor.execute(
+                f'INSERT INTO {FTS_TABLE} (content, message_id, chat_id) VALUES '
+                + ', '.join(['(%s, %s, %s)'] * len(batch)),
+                [value for row in batch for value in row],
+            )
+
+
+def unindex_chat(chat_id):
+    """Drop the search rows of a chat's messages, when it is deleted."""
+    _unindex('chat_id = %s', [_hex(chat_id)])
+
+
+def unindex_sender(user_id):
+    """Drop the search rows of a user's messages, before they are deleted with the user."""
+    _unindex(
+        f'message_id IN (SELECT id FROM {Message._meta.db_table} WHERE sender_id = %s)', [_hex(user_id)]
+    )
+
+
+def _unindex(where, params):
+    # The id columns are UNINDEXED, so this reads the whole table; it only
+    # runs when chats and users are deleted
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE {where}', params)
+
+
+def search_messages(user, text, chat_id=None, offset=0, limit=20):
+    """
+    Best matches for `text` in the user's chats (or one of them), best first.
+    Returns (messages, has_more); each message carries a `highlight`, an
+    escaped fragment with the matched terms wrapped in HIGHLIGHT_START /
+    HIGHLIGHT_STOP.
+    """
+    terms = search_terms(text)
+    if not terms:
+        return [], False
+    if connection.vendor == 'postgresql':
+        return _search_postgres(user, terms, chat_id, offset, limit)
+    return _search_sqlite(user, terms, chat_id, offset, limit)
+
+
+def _search_sqlite(user, terms, chat_id, offset, limit):
+    # Every term quoted, so user input is never parsed as FTS5 syntax
+    match = ' '.join('"%s"' % term.replace('"', '""') for term in terms)
+    # Joined to the messages (by primary key) before LIMIT, so rows of
+    # deleted messages never take a place on the page
+    messages_table = Message._meta.db_table
+    sql = (
+        f'SELECT {FTS_TABLE}.message_id, snippet({FTS_TABLE}, 0, %s, %s, %s, %s) FROM {FTS_TABLE} '
+        f'JOIN {messages_table} ON {messages_table}.id = {FTS_TABLE}.message_id '
+        f'WHERE {FTS_TABLE} MATCH %s '
+        f'AND {messages_table}.chat_id IN (SELECT chat_id FROM {ChatParticipant._meta.db_table} WHERE user_id = %s)'
+    )
+    params = [MATCH_START, MATCH_STOP, '…', SNIPPET_TOKENS, match, _hex(user.pk)]
+    if chat_id is not None:
+        sql += f' AND {messages_table}.chat_id = %s'
+        params.append(_hex(chat_id))
+    sql += f' ORDER BY rank, {FTS_TABLE}.rowid LIMIT %s OFFSET %s'
+    params += [limit + 1, offset]
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        hits = cursor.fetchall()
+    has_more = len(hits) > limit
+    hits = hits[:limit]
+
+    found = Message.objects.select_related('sender').in_bulk([message_id for message_id, _ in hits])
+    messages = []
+    for message_id, highlight in hits:
+        message = found.get(_uuid(message_id))
+        if message is not None:
+            message.highlight = highlight_html(highlight)
+            messages.append(message)
+    return messages, has_more
+
+
+def _search_postgres(user, terms, chat_id, offset, limit):
+    # Needs psycopg, so only imported on PostgreSQL
+    from django.contrib.postgres.search import SearchHeadline, SearchQuery, SearchRank, SearchVector
+
+    # Same expression as the GIN index, so the index is used
+    vector = SearchVector('content', config=SEARCH_CONFIG)
+    query = SearchQuery(' '.join(terms), config=SEARCH_CONFIG)
+    messages = Message.objects.annotate(search=vector).filter(
+        search=query,
+        chat_id__in=ChatParticipant.objects.filter(user=user).values('chat_id'),
+    )
+    if chat_id is not None:
+        messages = messages.filter(chat_id=chat_id)
+    messages = list(
+        messages.annotate(
+            rank=SearchRank(vector, query),
+            highlight=SearchHeadline(
+                'content', query, config=SEARCH_CONFIG,
+                start_sel=MATCH_START, stop_sel=MATCH_STOP, max_words=SNIPPET_TOKENS * 2,
+            ),
+        ).select_related('sender').order_by('-rank', '-created_at', 'id')[offset:offset + limit + 1]
+    )
+    for message in messages:
+        message.highlight = highlight_html(message.highlight)
+    return messages[:limit], len(messages) > limit
+
+
+def _uuid(value):
+    return Message._meta.pk.to_python(value)
+
+
+def _hex(value):
+    """A UUID (or its string) as SQLite stores it"""
+    return _uuid(value).hex
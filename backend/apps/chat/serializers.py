@@ -9,6 +9,12 @@ class ChatParticipantSerializer(serializers.ModelSerializer):
         model = ChatParticipant
         fields = ['user', 'role']
 
+class SyncParticipantSerializer(ChatParticipantSerializer):
+    chat_id = serializers.UUIDField(read_only=True)
+
+    class Meta(ChatParticipantSerializer.Meta):
+        fields = ['chat_id', 'user', 'role']
+
 class ChatSerializer(serializers.ModelSerializer):
     participants = ChatParticipantSerializer(many=True, read_only=True)
     participant_ids = serializers.ListField(
@@ -19,11 +25,27 @@ class ChatSerializer(serializers.ModelSerializer):
     chat_name = serializers.SerializerMethodField()
     unread_count = serializers.SerializerMethodField()
     other_user_online = serializers.SerializerMethodField()
+    last_message = serializers.SerializerMethodField()
     
     class Meta:
         model = Chat
-        fields = ['id', 'type', 'name', 'chat_name', 'participants', 'participant_ids', 'created_at', 'unread_count', 'other_user_online']
-        read_only_fields = ['id', 'created_at']
+        fields = ['id', 'type', 'name', 'chat_name', 'participants', 'participant_ids', 'created_at',
+                  'unread_count', 'other_user_online', 'last_message', 'last_activity_at', 'last_seq']
+        read_only_fields = ['id', 'created_at', 'last_activity_at', 'last_seq']
+
+    def get_last_message(self, obj):
+        """Preview of the newest message, from the snapshot on the chat row"""
+        if not obj.last_message_id:
+            return None
+        sender = obj.last_message_sender
+        return {
+            'message_id': str(obj.last_message_id),
+            'sender_id': str(obj.last_message_sender_id) if obj.last_message_sender_id else None,
+            'sender_username': sender.username if sender else None,
+            'message_type': obj.last_message_type,
+            'preview': obj.last_message_preview,
+            'timestamp': obj.last_message_at.isoformat() if obj.last_message_at else None,
+        }
     
     def get_unread_count(self, obj):
         """Count unread messages for the current user"""
@@ -31,17 +53,23 @@ class ChatSerializer(serializers.ModelSerializer):
         if not request:
             return 0
         
-        # Count messages where sender is NOT the current user and status is NOT 'read'
-        # Note: This is a simple implementation. For group chats, accurate read receipts need a separate model.
-        # But this works for 1-to-1 and basic group logic.
-        return obj.messages.exclude(sender=request.user).exclude(status='read').count()
+        # Annotated by ChatViewSet.get_queryset; fall back to a query otherwise
+        if hasattr(obj, 'unread_total'):
+            return obj.unread_total
+
+        # Maintained per participant on send / mark_read
+        unread = obj.participants.filter(user=request.user).values_list('unread_count', flat=True).first()
+        return unread or 0
 
     def get_other_user_online(self, obj):
         """Check if other participant is online (for private chats)"""
         request = self.context.get('request')
         if not request or obj.type != 'private':
             return False
-            
+
+        if hasattr(obj, 'other_is_online'):
+            return bool(obj.other_is_online)
+
         other_participant = obj.participants.exclude(user=request.user).first()
         if other_participant:
             return other_participant.user.is_online
@@ -57,6 +85,9 @@ class ChatSerializer(serializers.ModelSerializer):
             return obj.name or 'Chat'
         
         if obj.type == 'private':
+            if hasattr(obj, 'other_username'):
+                return obj.other_username or 'Chat'
+
             # Get the other participant
             other_participant = obj.participants.exclude(user=request.user).first()
             if other_participant:
@@ -85,8 +116,27 @@ class MessageSerializer(serializers.ModelSerializer):
     sender_username = serializers.CharField(source='sender.username', read_only=True)
     message_id = serializers.UUIDField(source='id', read_only=True)
     timestamp = serializers.DateTimeField(source='created_at', read_only=True)
+    receipts = serializers.SerializerMethodField()
     
     class Meta:
         model = Message
-        fields = ['message_id', 'id', 'chat', 'sender', 'sender_id', 'sender_username', 'message_type', 'content', 'status', 'timestamp', 'created_at']
-        read_only_fields = ['id', 'sender', 'status', 'created_at']
+        fields = ['message_id', 'id', 'chat', 'seq', 'sender', 'sender_id', 'sender_username', 'message_type', 'content', 'status', 'receipts', 'timestamp', 'created_at']
+        read_only_fields = ['id', 'seq', 'sender', 'status', 'created_at']
+
+    def get_receipts(self, obj):
+        """Delivered/read counts for the requester's own messages (see receipts.with_receipt_counts)"""
+        if getattr(obj, 'recipient_count', None) is None:
+            return None
+        return {
+            'recipients': obj.recipient_count,
+            'delivered': obj.delivered_count,
+            'read': obj.read_count,
+        }
+
+
+class MessageSearchResultSerializer(MessageSerializer):
+    """A search hit: the message plus a fragment with the matched terms highlighted (see search)"""
+    highlight = serializers.CharField(read_only=True)
+
+    class Meta(MessageSerializer.Meta):
+        fields = MessageSerializer.Meta.fields + ['highlight']
@@ -0,0 +1,245 @@
+from collections import Counter, defaultdict
+from datetime import timedelta
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F
+from django.db.models.functions import Greatest
+from django.utils import timezone
+from . import events, receipts, search
+from .membership import load_chat_members
+from .models import Chat, ChatParticipant, Message, SyncTombstone
+
+
+def message_preview(message):
+    """Short text shown in the inbox for a message."""
+    text = message.content if message.message_type == 'text' else message.file_name
+    return (text or '')[:Chat.PREVIEW_LENGTH]
+
+
+def create_message(**data):
+    """
+    Store a new message, refresh the chat's last-message snapshot and bump the
+    unread counters of everyone else in the chat.
+    """
+    return create_messages([data])[0]
+
+
+def create_messages(items):
+    """
+    Store several messages (dicts of Message fields) in one transaction:
+    one seq/snapshot UPDATE and SELECT per chat, one bulk INSERT (plus the
+    search index, see search) and one unread counter UPDATE per (chat, sender).
+
+    Each message gets the next per-chat sequence number. Incrementing
+    Chat.last_seq locks the chat row, so concurrent sends to the same chat
+    are numbered one after another without gaps. The same UPDATE writes the
+    snapshot, which is safe because it runs under that lock. Chats are
+    locked in id order to avoid deadlocks between concurrent batches.
+    """
+    now = timezone.now()
+    messages = [Message(created_at=now, **data) for data in items]
+    by_chat = defaultdict(list)
+    for message in messages:
+        by_chat[str(message.chat_id)].append(message)
+
+    with transaction.atomic():
+        for chat_id in sorted(by_chat):
+            chat_messages = by_chat[chat_id]
+            last = chat_messages[-1]
+            Chat.objects.filter(pk=chat_id).update(
+                last_seq=F('last_seq') + len(chat_messages),
+                last_message_id=last.id,
+                last_message_sender_id=last.sender_id,
+                last_message_preview=message_preview(last),
+                last_message_type=last.message_type,
+                last_message_at=last.created_at,
+                last_activity_at=last.created_at,
+            )
+            last_seq = Chat.objects.filter(pk=chat_id).values_list('last_seq', flat=True).get()
+            first_seq = last_seq - len(chat_messages) + 1
+            for offset, message in enumerate(chat_messages):
+                message.seq = first_seq + offset
+
+        Message.objects.bulk_create(messages)
+        search.index_messages(messages)
+
+        sent = Counter((str(m.chat_id), str(m.sender_id)) for m in messages)
+        for (chat_id, sender_id), count in sent.items():
+            ChatParticipant.objects.filter(
+                chat_id=chat_id
+            ).exclude(
+                user_id=sender_id
+            ).update(unread_count=F('unread_count') + count)
+    return messages
+
+
+def send_message(sender, chat_id, data):
+    """
+    Store a message sent over the WebSocket if the sender is in the chat and
+    return (message.new event, created), or None if they are not. A message
+    already stored for the same client_request_id is returned with
+    created=False and is not logged for replay again.
+    Runs as one unit of work: membership (cached), insert and replay-log entry.
+    """
+    if str(sender.pk) not in load_chat_members(chat_id):
+        return None
+    try:
+        message = create_message(**data)
+    except IntegrityError:
+        message = find_sent_message(sender.pk, data.get('client_request_id'))
+        if message is None:
+            raise
+        return {'type': 'message.new', 'payload': message_payload(message, sender.username)}, False
+    return events.append(events.chat_stream(chat_id), {
+        'type': 'message.new',
+        'payload': message_payload(message, sender.username)
+    }), True
+
+
+def find_sent_message(sender_id, client_request_id):
+    """The message a user already sent with a request_id, if any"""
+    if not client_request_id:
+        return None
+    return Message.objects.filter(
+        sender_id=sender_id, client_request_id=client_request_id
+    ).first()
+
+
+def message_payload(message, sender_username):
+    """message.new payload for a freshly stored message (no queries needed)"""
+    return {
+        'message_id': str(message.id),
+        'chat_id': str(message.chat_id),
+        'seq': message.seq,
+        'sender_id': str(message.sender_id),
+        'sender_username': sender_username,
+        'message_type': message.message_type,
+        'content': message.content,
+        'file_id': str(message.file_id) if message.file_id else None,
+        'file_name': message.file_name,
+        'file_size': message.file_size,
+        'mime_type': message.mime_type,
+        'status': message.status,
+        'timestamp': message.created_at.isoformat()
+    }
+
+
+def mark_chat_read(participant):
+    """
+    Mark the whole chat as read for the participant (see read_up_to).
+    Returns (newest message, updated count, sender ids), or None if the chat
+    has no messages.
+    """
+    # By seq: a batch of messages shares one created_at
+    latest = Message.objects.filter(
+        chat_id=participant.chat_id
+    ).order_by('-seq').only('id', 'chat_id', 'seq', 'created_at').first()
+
+    if latest is None:
+        return None
+    return (latest, *read_up_to(participant, latest))
+
+
+def read_up_to(participant, mark):
+    """
+    Move the participant's read cursor to `mark`: every message from others
+    in the chat up to it is read by them (see receipts).
+
+    Message statuses follow the slowest recipient, so message rows are only
+    updated when this reader was the last one holding some back, with one
+    conditional UPDATE however many there are; their senders get a
+    messages.status event once that commits. Returns (number of messages
+    newly read by the participant, ids of their senders), so each sender
+    can be told once with a read_receipt().
+    """
+    newly_read = Message.objects.filter(
+        chat_id=participant.chat_id,
+        seq__gt=participant.last_read_seq,
+        seq__lte=mark.seq,
+    ).exclude(sender_id=participant.user_id)
+    per_sender = dict(newly_read.order_by().values_list('sender_id').annotate(count=Count('pk')))
+
+    if advance_read_cursor(participant, mark):
+        receipts.notify_status(receipts.advance_status(participant.chat_id, receipts.READ))
+    return sum(per_sender.values()), list(per_sender)
+
+
+def read_receipt(participant, mark, from_seq):
+    """
+    `messages.read_up_to` frame: the reader has read every message in the
+    chat up to the mark (by seq), having read up to `from_seq` before, so
+    the sender's client can count one more reader on each of its messages
+    in between at once. Message statuses themselves arrive as
+    messages.status events (see receipts).
+    """
+    return {
+        'type': 'messages.read_up_to',
+        'payload': {
+            'chat_id': str(participant.chat_id),
+            'reader_id': str(participant.user_id),
+            'message_id': str(mark.id),
+            'from_seq': from_seq,
+            'seq': mark.seq,
+            'up_to': mark.created_at.isoformat(),
+            'read_at': timezone.now().isoformat(),
+        }
+    }
+
+
+def advance_read_cursor(participant, message):
+    """
+    Move the read cursor forward to `message` (never backwards) and
+    recount what is still unread after it. The recount only covers messages
+    newer than the cursor, so it is normally empty. What was read was also
+    delivered, so the delivery cursor catches up too.
+
+    Reads are ordered by seq, not created_at: a batch of messages shares
+    one timestamp. The UPDATE is conditional on the stored cursor too, so
+    a stale read racing a newer one cannot move it back.
+    """
+    if participant.last_read_seq > message.seq:
+        return False
+    if participant.last_read_seq == message.seq and not participant.unread_count:
+        return False
+
+    unread = Message.objects.filter(
+        chat_id=participant.chat_id,
+        seq__gt=message.seq,
+    ).exclude(sender_id=participant.user_id).count()
+
+    moved = ChatParticipant.objects.filter(pk=participant.pk, last_read_seq__lte=message.seq).update(
+        last_read_message_id=message.id,
+        last_read_at=message.created_at,
+        last_read_seq=message.seq,
+        last_delivered_seq=Greatest('last_delivered_seq', message.seq),
+        unread_count=unread,
+    )
+    if not moved:
+        return False
+    participant.last_read_message_id = message.id
+    participant.last_read_at = message.created_at
+    participant.last_read_seq = message.seq
+    participant.unread_count = unread
+    return True
+
+
+def record_tombstones(kind, chat_id, user_ids, subject_id=None):
+    """
+    Remember a removal for delta sync, once per user that needs to hear about it.
+    Old tombstones are pruned separately (see prune_tombstones).
+    """
+    SyncTombstone.objects.bulk_create([
+        SyncTombstone(user_id=user_id, kind=kind, chat_id=chat_id, subject_id=subject_id)
+        for user_id in user_ids
+    ])
+
+
+def prune_tombstones():
+    """
+    Delete tombstones past the sync retention window, which no sync token
+    can reach any more. Run periodically (manage.py prune_sync_tombstones).
+    Returns the number deleted.
+    """
+    retention = timedelta(days=getattr(settings, 'CHAT_SYNC_RETENTION_DAYS', 30))
+    deleted, _ = SyncTombstone.objects.filter(created_at__lt=timezone.now() - retention).delete()
+    return deleted
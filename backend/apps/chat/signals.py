@@ -0,0 +1,18 @@
+from django.conf import settings
+from django.db.models.signals import post_delete, pre_delete
+from django.dispatch import receiver
+
+from . import search
+from .models import Chat
+
+
+@receiver(post_delete, sender=Chat)
+def unindex_deleted_chat(sender, instance, **kwargs):
+    """Drop the search rows of a deleted chat's messages (they go with it by cascade)."""
+    search.unindex_chat(instance.pk)
+
+
+@receiver(pre_delete, sender=settings.AUTH_USER_MODEL)
+def unindex_deleted_sender(sender, instance, **kwargs):
+    """Same for a deleted user's messages, while they can still be found."""
+    search.unindex_sender(instance.pk)
@@ -0,0 +1,104 @@
+"""
+Delta sync for reconnecting clients.
+
+A sync token is a signed (user, timestamp[, message id]) position. Syncing
+from a token returns only the chats, participants and messages that changed
+after it, plus removals recorded as SyncTombstone rows.
+"""
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.core import signing
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import ChatParticipant, Message, SyncTombstone
+
+TOKEN_SALT = 'apps.chat.sync'
+
+# Rows committed just before a sync may carry a timestamp slightly older than
+# the sync itself, so new tokens start a little in the past. Clients dedupe by id.
+SYNC_OVERLAP = timedelta(seconds=getattr(settings, 'CHAT_SYNC_OVERLAP_SECONDS', 2))
+# Tombstones older than this are pruned; older tokens need a full resync.
+SYNC_RETENTION = timedelta(days=getattr(settings, 'CHAT_SYNC_RETENTION_DAYS', 30))
+SYNC_MAX_MESSAGES = getattr(settings, 'CHAT_SYNC_MAX_MESSAGES', 500)
+
+
+class InvalidSyncToken(Exception):
+    pass
+
+
+def make_sync_token(user, since, after_message_id=None):
+    data = {'u': str(user.pk), 't': since.isoformat()}
+    if after_message_id:
+        data['k'] = str(after_message_id)
+    return signing.dumps(data, salt=TOKEN_SALT, compress=True)
+
+
+def read_sync_token(token, user):
+    """Return (since, after_message_id) or raise InvalidSyncToken."""
+    try:
+        data = signing.loads(token, salt=TOKEN_SALT)
+        if data['u'] != str(user.pk):
+            raise InvalidSyncToken('Token belongs to another user')
+        since = parse_datetime(data['t'])
+        after_message_id = uuid.UUID(data['k']) if 'k' in data else None
+    except (signing.BadSignature, KeyError, TypeError, ValueError):
+        raise InvalidSyncToken('Malformed sync token')
+
+    if since is None or since < timezone.now() - SYNC_RETENTION:
+        raise InvalidSyncToken('Sync token expired')
+    return since, after_message_id
+
+
+def initial_token(user):
+    return make_sync_token(user, timezone.now() - SYNC_OVERLAP)
+
+
+def get_changes(user, chats, since, after_message_id=None):
+    """
+    Collect everything `user` needs to catch up since a sync position.
+    `chats` is the caller's (annotated) queryset of the user's chats.
+    """
+    started = timezone.now()
+    my_chat_ids = ChatParticipant.objects.filter(user=user).values('chat_id')
+    joined = ChatParticipant.objects.filter(user=user, joined_at__gt=since).values('chat_id')
+
+    changed_chats = chats.filter(
+        Q(updated_at__gt=since) | Q(last_activity_at__gt=since) | Q(pk__in=joined)
+    )
+    added_participants = ChatParticipant.objects.filter(
+        chat_id__in=my_chat_ids, joined_at__gt=since
+    ).exclude(user=user).select_related('user')
+    tombstones = list(SyncTombstone.objects.filter(user=user, created_at__gt=since))
+
+    # Messages are keyset-paged on (updated_at, id) so a large backlog, or a
+    # bulk update that stamped many rows with one timestamp, is drained in order.
+    position = Q(updated_at__gt=since)
+    if after_message_id:
+        position = position | Q(updated_at=since, id__gt=after_message_id)
+    messages = list(
+        Message.objects.filter(position, chat_id__in=my_chat_ids)
+        .select_related('sender')
+        .order_by('updated_at', 'id')[:SYNC_MAX_MESSAGES + 1]
+    )
+    has_more = len(messages) > SYNC_MAX_MESSAGES
+    messages = messages[:SYNC_MAX_MESSAGES]
+
+    if has_more:
+        last = messages[-1]
+        token = make_sync_token(user, last.updated_at, last.id)
+    else:
+        token = make_sync_token(user, started - SYNC_OVERLAP)
+
+    return {
+        'token': token,
+        'has_more': has_more,
+        'chats': changed_chats,
+        'participants_added': added_participants,
+        'participants_removed': [t for t in tombstones if t.kind == 'participant.removed'],
+        'deleted_chat_ids': [t.chat_id for t in tombstones if t.kind == 'chat.deleted'],
+        'messages': messages,
+    }
@@ -1,3 +1,1466 @@
-from django.test import TestCase
+import asyncio
+import json
+import threading
+import uuid
+from datetime import timedelta
+from unittest import mock, skipUnless
 
-# Create your tests here.
+try:
+    import msgpack
+except ImportError:
+    # Optional, like in wire
+    msgpack = None
+
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.core.cache import caches
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from apps.accounts.models import User
+from .models import Chat, ChatParticipant, Message, SyncTombstone
+from .broadcast import Broadcast, broadcaster
+from .consumers import ChatConsumer
+from .dedup import recent_sends
+from .ingest import MessageIngestor
+from .outbound import DROPPED, OVERLOADED, QUEUED, OutboundQueue
+from .typing_indicators import TypingTracker
+from .membership import MembershipCache, load_chat_members, membership_cache
+from .presence import presence, write_presence
+from .ratelimit import RateLimiter
+from .services import create_message
+from . import checks, events, ingest, outbound, ratelimit, receipts, search, wire, workers, presence as presence_module, services, sync
+
+
+def clear_caches():
+    for backend in caches.all():
+        backend.clear()
+
+
+def make_user(username):
+    return User.objects.create_user(
+        username=username,
+        email=f'{username}@example.com',
+        phone=f'+1{abs(hash(username)) % 10**9}',
+        password='pass1234',
+    )
+
+
+def make_chat(*users, chat_type='private', name=None):
+    chat = Chat.objects.create(type=chat_type, name=name, created_by=users[0])
+    for i, user in enumerate(users):
+        ChatParticipant.objects.create(chat=chat, user=user, role='admin' if i == 0 else 'member')
+    return chat
+
+
+class MessagePaginationTests(TestCase):
+    def setUp(self):
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+        self.chat = make_chat(self.alice, self.bob)
+        self.messages = [
+            str(create_message(chat=self.chat, sender=self.alice, content=f'm{i}').pk)
+            for i in range(7)
+        ]
+
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+        self.url = f'/api/chat/chats/{self.chat.id}/messages/'
+
+    def test_first_page_is_latest_messages_in_order(self):
+        response = self.client.get(self.url, {'page_size': 3})
+        self.assertEqual(response.status_code, 200)
+        ids = [m['id'] for m in response.data['results']]
+        self.assertEqual(ids, self.messages[-3:])
+        self.assertTrue(response.data['has_older'])
+        self.assertIsNotNone(response.data['before'])
+
+    def test_walk_back_through_history(self):
+        seen = []
+        params = {'page_size': 3}
+        while True:
+            response = self.client.get(self.url, params)
+            seen = [m['id'] for m in response.data['results']] + seen
+            if not response.data['has_older']:
+                break
+            params['before'] = response.data['before']
+        self.assertEqual(seen, self.messages)
+
+    def test_cursor_stable_when_new_messages_arrive(self):
+        first = self.client.get(self.url, {'page_size': 3}).data
+        create_message(chat=self.chat, sender=self.bob, content='new')
+        older = self.client.get(self.url, {'page_size': 3, 'before': first['before']}).data
+        self.assertEqual([m['id'] for m in older['results']], self.messages[1:4])
+
+        newer = self.client.get(self.url, {'after': first['after']}).data
+        self.assertEqual([m['content'] for m in newer['results']], ['new'])
+
+    def test_seq_range(self):
+        response = self.client.get(self.url, {'from_seq': 2, 'to_seq': 4})
+        self.assertEqual([m['seq'] for m in response.data['results']], [2, 3, 4])
+
+    def test_invalid_cursor(self):
+        response = self.client.get(self.url, {'before': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 404)
+
+
+class ChatListQueryTests(TestCase):
+    def setUp(self):
+        self.alice = make_user('alice')
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def add_chats(self, count):
+        for i in range(count):
+            peer = make_user(f'peer{Chat.objects.count()}')
+            chat = make_chat(self.alice, peer)
+            create_message(chat=chat, sender=peer, content='hi')
+            create_message(chat=chat, sender=self.alice, content='hey')
+        group = make_chat(self.alice, make_user(f'member{Chat.objects.count()}'),
+                          chat_type='group', name='Team')
+        create_message(chat=group, sender=self.alice, content='welcome')
+
+    def test_chat_list_query_count_is_constant(self):
+        self.add_chats(3)
+        # One query for chats with annotations, one for the participant roster
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/chat/chats/')
+        self.assertEqual(len(response.data), 4)
+
+        self.add_chats(20)
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/chat/chats/')
+        self.assertEqual(len(response.data), 25)
+
+    def test_chat_list_fields(self):
+        bob = make_user('bob')
+        bob.is_online = True
+        bob.save()
+        chat = make_chat(self.alice, bob)
+        create_message(chat=chat, sender=bob, content='one')
+        create_message(chat=chat, sender=bob, content='two')
+        create_message(chat=chat, sender=self.alice, content='mine')
+
+        data = self.client.get('/api/chat/chats/').data[0]
+        self.assertEqual(data['chat_name'], 'bob')
+        self.assertTrue(data['other_user_online'])
+        self.assertEqual(data['unread_count'], 2)
+        self.assertEqual(len(data['participants']), 2)
+        self.assertEqual(data['last_message']['preview'], 'mine')
+        self.assertEqual(data['last_message']['sender_username'], 'alice')
+
+    def test_chat_list_ordered_by_last_activity(self):
+        bob = make_user('bob')
+        carol = make_user('carol')
+        older = make_chat(self.alice, bob)
+        newer = make_chat(self.alice, carol)
+        create_message(chat=older, sender=bob, content='bump')
+
+        ids = [c['id'] for c in self.client.get('/api/chat/chats/').data]
+        self.assertEqual(ids, [str(older.id), str(newer.id)])
+
+
+class UnreadCounterTests(TestCase):
+    def setUp(self):
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+        self.carol = make_user('carol')
+        self.group = make_chat(self.alice, self.bob, self.carol, chat_type='group', name='Team')
+        self.client = APIClient()
+
+    def unread(self, user):
+        return ChatParticipant.objects.get(chat=self.group, user=user).unread_count
+
+    def test_send_increments_other_participants(self):
+        create_message(chat=self.group, sender=self.alice, content='one')
+        create_message(chat=self.group, sender=self.bob, content='two')
+        self.assertEqual(self.unread(self.alice), 1)
+        self.assertEqual(self.unread(self.bob), 1)
+        self.assertEqual(self.unread(self.carol), 2)
+
+    def test_mark_read_is_per_member(self):
+        create_message(chat=self.group, sender=self.alice, content='one')
+        last = create_message(chat=self.group, sender=self.alice, content='two')
+
+        self.client.force_authenticate(self.bob)
+        response = self.client.post(f'/api/chat/chats/{self.group.id}/mark_read/')
+        self.assertEqual(response.status_code, 200)
+
+        bob = ChatParticipant.objects.get(chat=self.group, user=self.bob)
+        self.assertEqual(bob.unread_count, 0)
+        self.assertEqual(bob.last_read_message_id, last.id)
+        # Carol has not read anything yet
+        self.assertEqual(self.unread(self.carol), 2)
+
+
+class MessageSeqTests(TestCase):
+    def test_seq_is_per_chat_and_gap_free(self):
+        alice = make_user('alice')
+        bob = make_user('bob')
+        first = make_chat(alice, bob)
+        second = make_chat(alice, bob, chat_type='group', name='Team')
+
+        seqs = [create_message(chat=first, sender=alice, content='a').seq for _ in range(3)]
+        self.assertEqual(seqs, [1, 2, 3])
+        self.assertEqual(create_message(chat_id=second.id, sender=bob, content='b').seq, 1)
+
+        first.refresh_from_db()
+        self.assertEqual(first.last_seq, 3)
+
+
+class DeltaSyncTests(TestCase):
+    def setUp(self):
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+        self.carol = make_user('carol')
+        self.chat = make_chat(self.alice, self.bob)
+        self.group = make_chat(self.alice, self.bob, self.carol, chat_type='group', name='Team')
+        self.client = APIClient()
+        self.client.force_authenticate(self.bob)
+        self.url = '/api/chat/chats/sync/'
+
+    def test_without_token_returns_full_state(self):
+        data = self.client.get(self.url).data
+        self.assertTrue(data['full'])
+        self.assertEqual(len(data['chats']), 2)
+        self.assertTrue(data['token'])
+
+    def test_returns_only_changes_since_token(self):
+        old = create_message(chat=self.chat, sender=self.alice, content='old')
+        token = sync.make_sync_token(self.bob, old.updated_at)
+
+        new = create_message(chat=self.group, sender=self.alice, content='new')
+        self.client.force_authenticate(self.alice)
+        self.client.post(f'/api/chat/chats/{self.group.id}/remove_participant/', {'user_id': str(self.carol.id)})
+
+        self.client.force_authenticate(self.bob)
+        data = self.client.get(self.url, {'token': token}).data
+        self.assertFalse(data['full'])
+        self.assertEqual([m['id'] for m in data['messages']], [str(new.id)])
+        self.assertEqual([c['id'] for c in data['chats']], [str(self.group.id)])
+        self.assertEqual(data['participants_removed'],
+                         [{'chat_id': str(self.group.id), 'user_id': str(self.carol.id)}])
+
+        self.client.force_authenticate(self.carol)
+        token = sync.make_sync_token(self.carol, old.updated_at)
+        data = self.client.get(self.url, {'token': token}).data
+        self.assertEqual(data['deleted_chat_ids'], [str(self.group.id)])
+
+    def test_large_backlog_is_paged(self):
+        token = sync.initial_token(self.bob)
+        sent = [str(create_message(chat=self.chat, sender=self.alice, content=str(i)).id)
+                for i in range(5)]
+        received = []
+        with mock.patch.object(sync, 'SYNC_MAX_MESSAGES', 2):
+            while True:
+                data = self.client.get(self.url, {'token': token}).data
+                received += [m['id'] for m in data['messages'] if m['id'] not in received]
+                token = data['token']
+                if not data['has_more']:
+                    break
+        self.assertEqual(received, sent)
+
+    def test_token_of_other_user_forces_full_sync(self):
+        token = sync.initial_token(self.alice)
+        self.assertTrue(self.client.get(self.url, {'token': token}).data['full'])
+
+    def test_prune_keeps_tombstones_within_retention(self):
+        services.record_tombstones('chat.deleted', self.chat.id, [self.alice.id, self.bob.id])
+        SyncTombstone.objects.filter(user=self.alice).update(
+            created_at=timezone.now() - sync.SYNC_RETENTION - timedelta(days=1)
+        )
+        self.assertEqual(services.prune_tombstones(), 1)
+        self.assertEqual(list(SyncTombstone.objects.values_list('user_id', flat=True)), [self.bob.id])
+
+
+def connect(user, query='', subprotocols=None):
+    communicator = WebsocketCommunicator(
+        ChatConsumer.as_asgi(), f'/ws/chat/?{query}', subprotocols=subprotocols
+    )
+    communicator.scope['user'] = user
+    return communicator
+
+
+class EventReplayTests(TransactionTestCase):
+    def setUp(self):
+        clear_caches()
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+        self.chat = make_chat(self.alice, self.bob)
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def test_cache_must_hold_a_replay_log(self):
+        def problems():
+            found = checks.check_event_log_cache(None) + checks.check_shared_cache(None)
+            return [problem.id for problem in found]
+
+        # The sized local cache only needs sharing for production
+        self.assertEqual(problems(), ['chat.W001'])
+        with override_settings(CACHES={'default': {'BACKEND': checks.LOCAL_MEMORY_CACHE}}):
+            self.assertEqual(problems(), ['chat.E001', 'chat.W001'])
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.redis.RedisCache'}}):
+            self.assertEqual(problems(), [])
+
+    def test_ring_buffer(self):
+        stream = events.user_stream(self.bob.id)
+        for i in range(3):
+            events.append(stream, {'type': 'chat.updated', 'payload': {'n': i}})
+        self.assertEqual([e['payload']['n'] for e in events.replay(stream, 1)], [1, 2])
+        self.assertEqual(events.replay(stream, 3), [])
+
+        with mock.patch.object(events, 'EVENT_LOG_SIZE', 2):
+            self.assertIsNone(events.replay(stream, 0))
+
+    def test_reconnect_replays_missed_events(self):
+        async def scenario():
+            communicator = connect(self.bob, 'last_event_id=0')
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            await communicator.disconnect()
+
+            # While bob is offline
+            await self.rename('First')
+            await self.rename('Second')
+
+            communicator = connect(self.bob, 'last_event_id=1')
+            await communicator.connect()
+            replayed = await communicator.receive_json_from()
+            self.assertEqual(replayed['event_id'], 2)
+            self.assertEqual(replayed['payload']['name'], 'Second')
+            self.assertTrue(await communicator.receive_nothing())
+            await communicator.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_gap_larger_than_buffer_requires_resync(self):
+        async def scenario():
+            await self.rename('First')
+            communicator = connect(self.bob, 'last_event_id=5')
+            await communicator.connect()
+            frame = await communicator.receive_json_from()
+            self.assertEqual(frame, {'type': 'sync.required', 'payload': {'last_event_id': 1}})
+            await communicator.disconnect()
+
+        async_to_sync(scenario)()
+
+    async def rename(self, name):
+        url = f'/api/chat/chats/{self.chat.id}/'
+        await sync_to_async(self.client.patch)(url, {'name': name}, format='json')
+
+
+class MembershipCacheTests(TestCase):
+    def setUp(self):
+        membership_cache.clear()
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+        self.group = make_chat(self.alice, self.bob, chat_type='group', name='Team')
+
+    def test_lru_and_ttl(self):
+        members = MembershipCache(max_size=2, ttl=60)
+        members.set('a', ['1'])
+        members.set('b', ['2'])
+        members.get('a')
+        members.set('c', ['3'])
+        self.assertIsNone(members.get('b'))
+        self.assertEqual(members.get('a'), frozenset(['1']))
+
+        with mock.patch('apps.chat.lru.time.monotonic', return_value=10**9):
+            self.assertIsNone(members.get('a'))
+
+    def test_cached_after_first_load(self):
+        load_chat_members(self.group.id)
+        with self.assertNumQueries(0):
+            members = load_chat_members(self.group.id)
+        self.assertEqual(members, {str(self.alice.id), str(self.bob.id)})
+
+    def test_views_invalidate_on_membership_change(self):
+        carol = make_user('carol')
+        load_chat_members(self.group.id)
+        client = APIClient()
+        client.force_authenticate(self.alice)
+
+        client.post(f'/api/chat/chats/{self.group.id}/add_participants/', {'user_ids': [str(carol.id)]}, format='json')
+        self.assertIn(str(carol.id), load_chat_members(self.group.id))
+
+        client.post(f'/api/chat/chats/{self.group.id}/remove_participant/', {'user_id': str(carol.id)})
+        self.assertNotIn(str(carol.id), load_chat_members(self.group.id))
+
+        client.force_authenticate(self.bob)
+        client.post(f'/api/chat/chats/{self.group.id}/leave/')
+        self.assertEqual(load_chat_members(self.group.id), {str(self.alice.id)})
+
+
+class RangeReadReceiptTests(TransactionTestCase):
+    def setUp(self):
+        clear_caches()
+        membership_cache.clear()
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+        self.chat = make_chat(self.alice, self.bob)
+        # Deliveries are only written when flushed explicitly
+        self.delivery = receipts.DeliveryTracker(flush_interval=60)
+        patcher = mock.patch.object(receipts, 'delivery', self.delivery)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        if self.delivery._worker:
+            self.delivery._worker.cancel()
+
+    def test_mark_read_is_one_update_and_one_receipt(self):
+        for i in range(50):
+            create_message(chat=self.chat, sender=self.alice, content=str(i))
+        participant = ChatParticipant.objects.get(chat=self.chat, user=self.bob)
+
+        with CaptureQueriesContext(connection) as queries:
+            latest, updated, sender_ids = services.mark_chat_read(participant)
+        updates = [q['sql'] for q in queries if q['sql'].startswith('UPDATE "messages"')]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(updated, 50)
+        self.assertEqual(sender_ids, [self.alice.id])
+        self.assertFalse(Message.objects.exclude(status='read').exists())
+
+        # Nothing left to read: no UPDATE at all
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(services.mark_chat_read(participant)[1:], (0, []))
+        self.assertFalse([q for q in queries if q['sql'].startswith('UPDATE "messages"')])
+
+    def test_batched_messages_are_read_by_seq(self):
+        # One batch shares one created_at
+        sent = services.create_messages(
+            [{'chat': self.chat, 'sender': self.alice, 'content': str(i)} for i in range(10)]
+        )
+        participant = ChatParticipant.objects.get(chat=self.chat, user=self.bob)
+        latest, updated, _ = services.mark_chat_read(participant)
+        self.assertEqual((latest.seq, updated), (10, 10))
+        self.assertFalse(Message.objects.exclude(status='read').exists())
+
+        # A stale read arriving late does not move the cursor back
+        self.assertEqual(services.read_up_to(participant, sent[5]), (0, []))
+        participant.refresh_from_db()
+        self.assertEqual((participant.last_read_seq, participant.unread_count), (10, 0))
+        stale = ChatParticipant.objects.get(pk=participant.pk)
+        stale.last_read_seq = 5
+        self.assertFalse(services.advance_read_cursor(stale, sent[5]))
+        participant.refresh_from_db()
+        self.assertEqual(participant.last_read_seq, 10)
+
+    def test_websocket_read_up_to(self):
+        sent = [create_message(chat=self.chat, sender=self.alice, content=str(i)) for i in range(3)]
+
+        async def scenario():
+            alice, bob = connect(self.alice), connect(self.bob)
+            await alice.connect()
+            await bob.connect()
+
+            await bob.send_json_to({'type': 'message.read', 'payload': {
+                'chat_id': str(self.chat.id), 'message_id': str(sent[1].id)}})
+            # The range receipt, and the status change since bob was the last to read
+            frames = {f['type']: f for f in [await alice.receive_json_from() for _ in range(2)]}
+            receipt = frames['messages.read_up_to']
+            self.assertEqual(receipt['payload']['reader_id'], str(self.bob.id))
+            self.assertEqual(receipt['payload']['from_seq'], 0)
+            self.assertEqual(receipt['payload']['seq'], sent[1].seq)
+            self.assertEqual(frames['messages.status']['payload']['status'], 'read')
+            self.assertEqual(frames['messages.status']['payload']['up_to_seq'], sent[1].seq)
+            self.assertTrue(await alice.receive_nothing())
+
+            # Someone else's chat is ignored
+            carol = await sync_to_async(make_user)('carol')
+            other = await sync_to_async(make_chat)(self.alice, carol)
+            await bob.send_json_to({'type': 'message.read', 'payload': {
+                'chat_id': str(other.id), 'message_id': str(sent[2].id)}})
+            self.assertTrue(await alice.receive_nothing())
+
+            await alice.disconnect()
+            await bob.disconnect()
+
+        async_to_sync(scenario)()
+        statuses = list(Message.objects.order_by('seq').values_list('status', flat=True))
+        self.assertEqual(statuses, ['read', 'read', 'sent'])
+
+
+class ReceiptTests(TransactionTestCase):
+    def setUp(self):
+        clear_caches()
+        membership_cache.clear()
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+        self.carol = make_user('carol')
+        self.group = make_chat(self.alice, self.bob, self.carol, chat_type='group', name='Team')
+        self.sent = [create_message(chat=self.group, sender=self.alice, content=str(i)) for i in range(3)]
+        self.delivery = receipts.DeliveryTracker(flush_interval=60)
+        patcher = mock.patch.object(receipts, 'delivery', self.delivery)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # Presence frames would interleave with the receipts
+        patcher = mock.patch('apps.chat.consumers.announce_presence', new=mock.AsyncMock())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        if self.delivery._worker:
+            self.delivery._worker.cancel()
+
+    def participant(self, user):
+        return ChatParticipant.objects.get(chat=self.group, user=user)
+
+    def statuses(self):
+        return list(Message.objects.order_by('seq').values_list('status', flat=True))
+
+    def counts(self, user):
+        messages = receipts.with_receipt_counts(Message.objects.filter(chat=self.group), user)
+        return list(messages.order_by('seq').values_list('delivered_count', 'read_count'))
+
+    def test_status_follows_slowest_recipient(self):
+        services.read_up_to(self.participant(self.bob), self.sent[2])
+        self.assertEqual(self.statuses(), ['sent'] * 3)
+        self.assertEqual(self.counts(self.alice), [(1, 1)] * 3)
+        # Counts are only for the requester's own messages
+        self.assertEqual(self.counts(self.bob), [(None, None)] * 3)
+
+        with CaptureQueriesContext(connection) as queries:
+            services.read_up_to(self.participant(self.carol), self.sent[1])
+        updates = [q['sql'] for q in queries if q['sql'].startswith('UPDATE "messages"')]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(self.statuses(), ['read', 'read', 'sent'])
+        self.assertEqual(self.counts(self.alice), [(2, 2), (2, 2), (1, 1)])
+
+    def test_status_scan_starts_at_watermark(self):
+        services.read_up_to(self.participant(self.bob), self.sent[2])
+        services.read_up_to(self.participant(self.carol), self.sent[0])
+        # Alice is the slowest reader (of her own messages), so only carol
+        # holds them back: the next advance starts after the first message
+        with CaptureQueriesContext(connection) as queries:
+            services.read_up_to(self.participant(self.carol), self.sent[2])
+        updates = [q['sql'] for q in queries if q['sql'].startswith('UPDATE "messages"')]
+        self.assertEqual(len(updates), 1)
+        self.assertIn('"messages"."seq" > 1', updates[0])
+        self.assertEqual(self.statuses(), ['read'] * 3)
+
+        # Carol's messages are held back by alice, who has read nothing
+        reply = create_message(chat=self.group, sender=self.carol, content='hi')
+        services.read_up_to(self.participant(self.bob), reply)
+        self.assertEqual(Message.objects.get(pk=reply.pk).status, 'sent')
+        services.read_up_to(self.participant(self.alice), reply)
+        self.assertEqual(Message.objects.get(pk=reply.pk).status, 'read')
+        self.group.refresh_from_db()
+        self.assertEqual(self.group.read_low_seq, 3)
+
+    def test_deliveries_are_written_in_bulk(self):
+        chat_id = str(self.group.id)
+        deliveries = {(chat_id, str(self.bob.id)): 2, (chat_id, str(self.carol.id)): 2}
+        with CaptureQueriesContext(connection) as queries:
+            frames = receipts.write_deliveries(deliveries, set())
+        cursor_updates = [q['sql'] for q in queries if q['sql'].startswith('UPDATE "chat_participants"')]
+        self.assertEqual(len(cursor_updates), 1)
+        self.assertEqual(self.statuses(), ['delivered', 'delivered', 'sent'])
+        self.assertEqual(frames, [(self.alice.id, {'type': 'messages.status', 'payload': {
+            'chat_id': chat_id, 'status': 'delivered', 'up_to_seq': 2}})])
+
+        # Reconnecting catches the cursors up to the newest message
+        receipts.write_deliveries({}, {str(self.bob.id), str(self.carol.id)})
+        self.assertEqual(self.statuses(), ['delivered'] * 3)
+        # Older cursors never move back
+        self.assertEqual(receipts.write_deliveries(deliveries, set()), [])
+        self.assertEqual(self.participant(self.bob).last_delivered_seq, 3)
+
+    def test_counts_in_message_history(self):
+        services.read_up_to(self.participant(self.bob), self.sent[0])
+        client = APIClient()
+        client.force_authenticate(self.alice)
+        response = client.get(f'/api/chat/chats/{self.group.id}/messages/')
+        self.assertEqual(
+            [m['receipts'] for m in response.data['results']],
+            [{'recipients': 2, 'delivered': 1, 'read': 1}] + [{'recipients': 2, 'delivered': 0, 'read': 0}] * 2,
+        )
+
+    def test_fan_out_marks_recipients_delivered(self):
+        async def scenario():
+            alice, bob, carol = connect(self.alice), connect(self.bob), connect(self.carol)
+            for communicator in (alice, bob, carol):
+                await communicator.connect()
+            await self.delivery.flush()
+            frame = await alice.receive_json_from()
+            self.assertEqual(frame['type'], 'messages.status')
+            self.assertEqual(frame['payload'], {
+                'chat_id': str(self.group.id), 'status': 'delivered', 'up_to_seq': 3})
+
+            await alice.send_json_to({'type': 'message.send', 'payload': {
+                'chat_id': str(self.group.id), 'content': 'hello'}})
+            await bob.receive_json_from()
+            await carol.receive_json_from()
+            await alice.receive_json_from()
+            await alice.receive_json_from()
+            await self.delivery.flush()
+            frame = await alice.receive_json_from()
+            self.assertEqual(frame['payload']['up_to_seq'], 4)
+
+            for communicator in (alice, bob, carol):
+                await communicator.disconnect()
+
+        async_to_sync(scenario)()
+        self.assertEqual(self.statuses(), ['delivered'] * 4)
+
+
+class MessageSearchTests(TestCase):
+    def setUp(self):
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+        self.carol = make_user('carol')
+        self.chat = make_chat(self.alice, self.bob)
+        self.group = make_chat(self.alice, self.bob, self.carol, chat_type='group', name='Team')
+        self.elsewhere = make_chat(self.bob, self.carol)
+
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def search(self, **params):
+        return self.client.get('/api/chat/chats/search/', params)
+
+    def test_ranked_highlighted_and_scoped(self):
+        once = create_message(chat=self.chat, sender=self.bob, content='Dinner at the café?')
+        twice = create_message(chat=self.group, sender=self.carol, content='cafe or cafe, you pick')
+        create_message(chat=self.chat, sender=self.bob, content='something else')
+        create_message(chat=self.elsewhere, sender=self.bob, content='secret cafe plans')
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.search(q='cafe')
+        self.assertEqual(response.status_code, 200)
+        # The match and one query to load the page's messages
+        self.assertEqual(len([q for q in queries if q['sql'].startswith('SELECT')]), 2)
+        results = response.data['results']
+        self.assertEqual([r['id'] for r in results], [str(twice.id), str(once.id)])
+        self.assertEqual(results[1]['highlight'], 'Dinner at the <mark>café</mark>?')
+        self.assertEqual(results[1]['sender_username'], 'bob')
+        self.assertFalse(response.data['has_more'])
+
+        response = self.search(q='cafe', chat_id=str(self.chat.id))
+        self.assertEqual([r['id'] for r in response.data['results']], [str(once.id)])
+
+        # Every word has to match
+        self.assertEqual(self.search(q='cafe dinner').data['results'][0]['id'], str(once.id))
+        self.assertEqual(self.search(q='"cafe" OR pick').status_code, 200)
+        self.assertEqual(self.search(q=' ?! ').status_code, 400)
+
+    def test_highlight_escapes_content(self):
+        create_message(chat=self.chat, sender=self.bob, content='<img src=x onerror=alert(1)> cafe & <mark>')
+        highlight = self.search(q='cafe').data['results'][0]['highlight']
+        self.assertEqual(highlight, '&lt;img src=x onerror=alert(1)&gt; <mark>cafe</mark> &amp; &lt;mark&gt;')
+
+    def test_paged_with_cursor(self):
+        sent = {str(create_message(chat=self.group, sender=self.bob, content=f'standup {i}').id)
+                for i in range(5)}
+        seen = []
+        params = {'q': 'standup', 'page_size': 2}
+        while True:
+            response = self.search(**params)
+            seen += [r['id'] for r in response.data['results']]
+            if not response.data['has_more']:
+                break
+            params['cursor'] = response.data['next']
+        self.assertEqual(len(seen), 5)
+        self.assertEqual(set(seen), sent)
+        self.assertEqual(self.search(q='standup', cursor='bogus').status_code, 404)
+
+    def index_size(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT count(*) FROM {search.FTS_TABLE}')
+            return cursor.fetchone()[0]
+
+    def test_deleted_messages_leave_the_index(self):
+        kept = [create_message(chat=self.group, sender=self.bob, content=f'standup {i}') for i in range(3)]
+        create_message(chat=self.group, sender=self.carol, content='standup from carol')
+        create_message(chat=self.chat, sender=self.bob, content='standup in private')
+        self.assertEqual(self.index_size(), 5)
+
+        self.carol.delete()
+        self.chat.delete()
+        self.assertEqual(self.index_size(), 3)
+
+        # Rows whose message is gone anyway do not shorten a page
+        Message.objects.filter(pk=kept[0].pk).delete()
+        response = self.search(q='standup', page_size=1)
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertTrue(response.data['has_more'])
+        response = self.search(q='standup', page_size=2)
+        self.assertEqual(len(response.data['results']), 2)
+        self.assertFalse(response.data['has_more'])
+
+
+class ChatGroupTests(TransactionTestCase):
+    def setUp(self):
+        clear_caches()
+        membership_cache.clear()
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+        self.carol = make_user('carol')
+        self.group = make_chat(self.alice, self.bob, chat_type='group', name='Team')
+
+    def test_message_and_typing_reach_chat_members(self):
+        async def scenario():
+            alice, bob = connect(self.alice), connect(self.bob)
+            await alice.connect()
+            await bob.connect()
+
+            await alice.send_json_to({'type': 'typing.start', 'payload': {'chat_id': str(self.group.id)}})
+            typing = await bob.receive_json_from()
+            self.assertEqual(typing['type'], 'typing.update')
+            self.assertEqual(typing['payload']['typing'], [str(self.alice.id)])
+            # Typing is not echoed back to the typer
+            self.assertTrue(await alice.receive_nothing())
+
+            await alice.send_json_to({'type': 'message.send', 'payload': {
+                'chat_id': str(self.group.id), 'content': 'hello'}})
+            frame = await bob.receive_json_from()
+            self.assertEqual(frame['type'], 'message.new')
+            self.assertEqual(frame['stream'], f'chat_{self.group.id}')
+            # The sender gets the broadcast too, plus an ack for its request
+            frames = {f['type']: f for f in [await alice.receive_json_from() for _ in range(2)]}
+            self.assertEqual(frames['message.ack']['payload']['message_id'],
+                             frames['message.new']['payload']['message_id'])
+
+            await alice.disconnect()
+            await bob.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_connection_follows_membership_changes(self):
+        async def scenario():
+            carol = connect(self.carol)
+            await carol.connect()
+
+            client = APIClient()
+            client.force_authenticate(self.alice)
+            await sync_to_async(client.post)(
+                f'/api/chat/chats/{self.group.id}/add_participants/',
+                {'user_ids': [str(self.carol.id)]}, format='json'
+            )
+            self.assertEqual((await carol.receive_json_from())['type'], 'chat.new')
+
+            alice = connect(self.alice)
+            await alice.connect()
+            await alice.send_json_to({'type': 'message.send', 'payload': {
+                'chat_id': str(self.group.id), 'content': 'welcome'}})
+            frame = await carol.receive_json_from()
+            self.assertEqual(frame['payload']['content'], 'welcome')
+
+            await alice.disconnect()
+            await carol.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_send_refused_after_removal_in_another_process(self):
+        async def scenario():
+            bob = connect(self.bob)
+            await bob.connect()
+            # Warm this process's membership cache
+            self.assertIn(str(self.bob.id), await sync_to_async(load_chat_members)(self.group.id))
+
+            # Another process removes bob: only its membership event reaches this one
+            await sync_to_async(ChatParticipant.objects.filter(chat=self.group, user=self.bob).delete)()
+            await get_channel_layer().group_send(f'user_{self.bob.id}', {
+                'type': 'chat_membership', 'chat_id': str(self.group.id), 'joined': False,
+            })
+            self.assertTrue(await bob.receive_nothing())
+
+            await bob.send_json_to({'type': 'message.send', 'payload': {
+                'chat_id': str(self.group.id), 'content': 'still here?'}})
+            frame = await bob.receive_json_from()
+            self.assertEqual(frame['type'], 'error')
+            self.assertEqual(frame['payload']['message'], 'Not a participant in this chat')
+            self.assertFalse(await sync_to_async(Message.objects.filter(chat=self.group).exists)())
+
+            await bob.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_resume_chat_stream(self):
+        async def scenario():
+            alice = connect(self.alice)
+            await alice.connect()
+            for text in ('one', 'two', 'three'):
+                await alice.send_json_to({'type': 'message.send', 'payload': {
+                    'chat_id': str(self.group.id), 'content': text}})
+                await alice.receive_json_from()
+                await alice.receive_json_from()
+
+            bob = connect(self.bob)
+            await bob.connect()
+            await bob.send_json_to({'type': 'resume', 'payload': {
+                'streams': {f'chat_{self.group.id}': 1}}})
+            replayed = [await bob.receive_json_from() for _ in range(2)]
+            self.assertEqual([f['payload']['content'] for f in replayed], ['two', 'three'])
+
+            await alice.disconnect()
+            await bob.disconnect()
+
+        async_to_sync(scenario)()
+
+
+class MessageSendQueryTests(TestCase):
+    def test_send_is_one_unit_of_work(self):
+        membership_cache.clear()
+        alice, bob = make_user('alice'), make_user('bob')
+        chat = make_chat(alice, bob)
+        load_chat_members(chat.id)
+
+        data = {'chat_id': str(chat.id), 'sender_id': str(alice.id), 'content': 'hi'}
+
+        # What the single database_sync_to_async hop in handle_message_send runs
+        with CaptureQueriesContext(connection) as queries:
+            event, created = services.send_message(alice, str(chat.id), data)
+
+        self.assertTrue(created)
+        self.assertEqual(event['payload']['sender_username'], 'alice')
+        statements = [q['sql'].split()[0] for q in queries.captured_queries]
+        # Chat seq + snapshot, read seq, insert, search index, unread counters;
+        # no membership or sender lookups
+        self.assertEqual([s for s in statements if s not in ('SAVEPOINT', 'RELEASE')],
+                         ['UPDATE', 'SELECT', 'INSERT', 'INSERT', 'UPDATE'])
+
+
+class BatchedIngestTests(TransactionTestCase):
+    def test_concurrent_sends_share_a_batch(self):
+        alice, bob = make_user('alice'), make_user('bob')
+        chat = make_chat(alice, bob)
+        ingestor = MessageIngestor(flush_ms=50, max_batch=10)
+
+        async def scenario():
+            return await asyncio.gather(*[
+                ingestor.submit({'chat_id': str(chat.id), 'sender_id': alice.id, 'content': str(i)})
+                for i in range(5)
+            ])
+
+        with mock.patch.object(services, 'create_messages', wraps=services.create_messages) as batch:
+            messages = async_to_sync(scenario)()
+        self.assertEqual(batch.call_count, 1)
+        self.assertEqual(sorted(m.seq for m in messages), [1, 2, 3, 4, 5])
+        self.assertEqual(ChatParticipant.objects.get(chat=chat, user=bob).unread_count, 5)
+
+    def test_bad_message_does_not_fail_the_batch(self):
+        alice, bob = make_user('alice'), make_user('bob')
+        chat = make_chat(alice, bob)
+        ingestor = MessageIngestor(flush_ms=50, max_batch=10)
+
+        async def scenario():
+            return await asyncio.gather(
+                ingestor.submit({'chat_id': str(chat.id), 'sender_id': alice.id, 'content': 'ok'}),
+                ingestor.submit({'chat_id': str(chat.id), 'sender_id': alice.id, 'bogus': 1}),
+                return_exceptions=True,
+            )
+
+        ok, failed = async_to_sync(scenario)()
+        self.assertEqual(ok.content, 'ok')
+        self.assertIsInstance(failed, Exception)
+
+
+class IdempotentSendTests(TransactionTestCase):
+    def setUp(self):
+        clear_caches()
+        membership_cache.clear()
+        recent_sends.clear()
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+        self.chat = make_chat(self.alice, self.bob)
+
+    def send_twice(self, forget_between=False):
+        frame = {'type': 'message.send', 'request_id': 'req-1', 'payload': {
+            'chat_id': str(self.chat.id), 'content': 'hello'}}
+
+        async def scenario():
+            alice, bob = connect(self.alice), connect(self.bob)
+            await alice.connect()
+            await bob.connect()
+
+            await alice.send_json_to(frame)
+            first = {f['type']: f for f in [await alice.receive_json_from() for _ in range(2)]}
+            self.assertEqual((await bob.receive_json_from())['type'], 'message.new')
+
+            if forget_between:
+                recent_sends.clear()
+            await alice.send_json_to(frame)
+            second = await alice.receive_json_from()
+            # A resend is only acked: no new row and no second broadcast
+            self.assertTrue(await bob.receive_nothing())
+
+            await alice.disconnect()
+            await bob.disconnect()
+            return first['message.ack'], second
+
+        first, second = async_to_sync(scenario)()
+        self.assertEqual(second['type'], 'message.ack')
+        self.assertEqual(second['request_id'], 'req-1')
+        self.assertEqual(second['payload'], first['payload'])
+        self.assertEqual(Message.objects.filter(chat=self.chat).count(), 1)
+        self.assertEqual(ChatParticipant.objects.get(chat=self.chat, user=self.bob).unread_count, 1)
+
+    def test_resend_is_acked_from_cache(self):
+        self.send_twice()
+
+    def test_resend_after_cache_miss_hits_unique_index(self):
+        self.send_twice(forget_between=True)
+
+    def test_resend_with_batched_ingest(self):
+        with mock.patch.object(ingest, 'BATCHING_ENABLED', True):
+            self.send_twice(forget_between=True)
+
+    def test_request_ids_are_per_sender(self):
+        create_message(chat=self.chat, sender=self.alice, content='a', client_request_id='req-1')
+        create_message(chat=self.chat, sender=self.bob, content='b', client_request_id='req-1')
+        self.assertEqual(Message.objects.filter(client_request_id='req-1').count(), 2)
+
+
+class RecordingLayer:
+    def __init__(self):
+        self.sent = []
+
+    async def group_send(self, group, event):
+        self.sent.append((group, json.loads(event['text'])['payload']))
+
+
+class TypingTrackerTests(TestCase):
+    def setUp(self):
+        self.layer = RecordingLayer()
+        self.now = 0
+        # Long interval: updates are flushed explicitly
+        self.tracker = TypingTracker(interval=60, refresh=3, timeout=6, clock=lambda: self.now)
+
+    def run_async(self, *steps):
+        async def scenario():
+            for step in steps:
+                result = step()
+                if asyncio.iscoroutine(result):
+                    await result
+            if self.tracker._worker:
+                self.tracker._worker.cancel()
+        async_to_sync(scenario)()
+
+    def start(self, user_id):
+        return lambda: self.tracker.start(self.layer, 'c1', user_id)
+
+    def test_keystrokes_coalesce_into_one_update(self):
+        self.run_async(*[self.start('alice')] * 20, self.start('bob'), self.tracker.flush)
+        self.assertEqual(self.layer.sent, [('chat_c1', {
+            'chat_id': 'c1', 'typing': ['alice', 'bob'], 'stopped': [], 'expires_in': 6})])
+
+    def test_repeat_start_suppressed_until_refresh(self):
+        def at(now):
+            return lambda: setattr(self, 'now', now)
+
+        self.run_async(self.start('alice'), self.tracker.flush,
+                       at(1), self.start('alice'), self.tracker.flush,
+                       at(4), self.start('alice'), self.tracker.flush)
+        self.assertEqual(len(self.layer.sent), 2)
+
+    def test_stop_and_expiry(self):
+        self.run_async(
+            self.start('alice'), self.start('bob'), self.tracker.flush,
+            lambda: self.tracker.stop(self.layer, 'c1', 'alice'), self.tracker.flush,
+            # bob never sends typing.stop and times out
+            lambda: setattr(self, 'now', 7), self.tracker.flush,
+        )
+        self.assertEqual([(p['typing'], p['stopped']) for _, p in self.layer.sent], [
+            (['alice', 'bob'], []), ([], ['alice']), ([], ['bob'])])
+        self.assertEqual(self.tracker.typing('c1'), set())
+        self.assertNotIn('c1', self.tracker._chats)
+
+
+class PresenceTests(TransactionTestCase):
+    def setUp(self):
+        clear_caches()
+        self.alice = make_user('alice')
+
+    def test_online_until_last_connection_closes(self):
+        async def scenario():
+            phone, laptop = connect(self.alice), connect(self.alice)
+            await phone.connect()
+            await laptop.connect()
+            self.assertEqual(await sync_to_async(presence_module.connection_count)(self.alice.id), 2)
+            await presence.flush()
+            await sync_to_async(self.alice.refresh_from_db)()
+            self.assertTrue(self.alice.is_online)
+
+            await phone.disconnect()
+            await presence.flush()
+            await sync_to_async(self.alice.refresh_from_db)()
+            self.assertTrue(self.alice.is_online)
+
+            await laptop.disconnect()
+            await presence.flush()
+
+        async_to_sync(scenario)()
+        self.alice.refresh_from_db()
+        self.assertFalse(self.alice.is_online)
+        self.assertIsNotNone(self.alice.last_seen_at)
+        self.assertFalse(presence_module.is_online(self.alice.id))
+
+    @mock.patch('apps.chat.consumers.PRESENCE_DEBOUNCE', 0.2)
+    def test_changes_pushed_to_contacts_debounced(self):
+        bob, carol = make_user('bob'), make_user('carol')
+        make_chat(self.alice, bob)
+
+        async def scenario():
+            bob_ws, carol_ws = connect(bob), connect(carol)
+            await bob_ws.connect()
+            await carol_ws.connect()
+
+            # Flapping: online, offline, online again within one window
+            for _ in range(2):
+                alice_ws = connect(self.alice)
+                await alice_ws.connect()
+                await alice_ws.disconnect()
+            alice_ws = connect(self.alice)
+            await alice_ws.connect()
+
+            frame = await bob_ws.receive_json_from(timeout=2)
+            self.assertEqual(frame['type'], 'presence.update')
+            self.assertEqual(frame['payload']['users'], [
+                {'user_id': str(self.alice.id), 'is_online': True, 'last_seen_at': None}])
+            self.assertTrue(await bob_ws.receive_nothing(timeout=0.5))
+            # carol shares no chat with alice
+            self.assertTrue(await carol_ws.receive_nothing(timeout=0.5))
+
+            await alice_ws.disconnect()
+            frame = await bob_ws.receive_json_from(timeout=2)
+            self.assertFalse(frame['payload']['users'][0]['is_online'])
+
+            await bob_ws.disconnect()
+            await carol_ws.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_batched_write_touches_only_presence_columns(self):
+        bob, carol = make_user('bob'), make_user('carol')
+        updated_at = self.alice.updated_at
+        seen = timezone.now()
+
+        with CaptureQueriesContext(connection) as queries:
+            write_presence({str(self.alice.id): None, str(bob.id): seen, str(carol.id): seen})
+        self.assertEqual(len(queries.captured_queries), 2)
+        for query in queries.captured_queries:
+            self.assertNotIn('password', query['sql'])
+            self.assertNotIn('updated_at', query['sql'])
+
+        self.alice.refresh_from_db()
+        bob.refresh_from_db()
+        self.assertTrue(self.alice.is_online)
+        self.assertEqual(self.alice.updated_at, updated_at)
+        self.assertFalse(bob.is_online)
+        self.assertEqual(bob.last_seen_at, seen)
+
+    def test_sweep_marks_expired_counters_offline(self):
+        bob = make_user('bob')
+        User.objects.filter(pk__in=[self.alice.pk, bob.pk]).update(is_online=True)
+        presence_module._add_connection(str(bob.id))
+        # Alice's server process died: her counter expired without a disconnect
+        self.assertEqual(presence_module.sweep_expired(batch_size=1), 1)
+        self.alice.refresh_from_db()
+        bob.refresh_from_db()
+        self.assertFalse(self.alice.is_online)
+        self.assertIsNotNone(self.alice.last_seen_at)
+        self.assertTrue(bob.is_online)
+        presence_module._remove_connection(str(bob.id))
+
+    def test_counters_survive_a_full_default_cache(self):
+        User.objects.filter(pk=self.alice.pk).update(is_online=True)
+        presence_module._add_connection(str(self.alice.id))
+        # Replay logs fill the default cache; counters are kept elsewhere
+        for i in range(400):
+            events.append(events.user_stream(f'filler{i}'), {'type': 'noop'})
+        self.assertEqual(presence_module.connection_count(self.alice.id), 1)
+        self.assertEqual(presence_module.sweep_expired(), 0)
+        presence_module._remove_connection(str(self.alice.id))
+
+
+@skipUnless(msgpack, 'msgpack is not installed')
+class MsgpackProtocolTests(TransactionTestCase):
+    def test_codec_compacts_uuids_and_timestamps(self):
+        user_id = str(uuid.uuid4())
+        message = {'type': 'presence.update', 'payload': {'users': [
+            {'user_id': user_id, 'is_online': False, 'last_seen_at': '2024-01-01T00:00:01.500000+00:00'}]}}
+        frame = wire.MSGPACK.encode(message)['bytes_data']
+        self.assertLess(len(frame), len(json.dumps(message)))
+
+        decoded = wire.MSGPACK.decode(bytes_data=frame)
+        user = decoded['payload']['users'][0]
+        self.assertEqual(user['user_id'], user_id)
+        self.assertEqual(user['last_seen_at'], 1704067201500)
+
+    def test_negotiated_msgpack_session(self):
+        alice, bob = make_user('alice'), make_user('bob')
+        chat = make_chat(alice, bob)
+
+        async def scenario():
+            alice_ws = connect(alice, subprotocols=[wire.MSGPACK_SUBPROTOCOL])
+            connected, subprotocol = await alice_ws.connect()
+            self.assertEqual(subprotocol, wire.MSGPACK_SUBPROTOCOL)
+            bob_ws = connect(bob)
+            await bob_ws.connect()
+
+            await alice_ws.send_to(bytes_data=msgpack.packb({
+                'type': 'message.send', 'request_id': 'r1',
+                'payload': {'chat_id': msgpack.ExtType(wire.UUID_EXT_TYPE, chat.id.bytes), 'content': 'hi'},
+            }))
+            frames = [wire.MSGPACK.decode(bytes_data=await alice_ws.receive_from()) for _ in range(2)]
+            # The JSON client gets the same event as JSON text
+            as_json = await bob_ws.receive_json_from()
+
+            await alice_ws.disconnect()
+            await bob_ws.disconnect()
+            return {f['type']: f for f in frames}, as_json
+
+        frames, as_json = async_to_sync(scenario)()
+        new = frames['message.new']['payload']
+        self.assertEqual(new['chat_id'], str(chat.id))
+        self.assertEqual(new['message_id'], as_json['payload']['message_id'])
+        self.assertIsInstance(new['timestamp'], int)
+        self.assertEqual(frames['message.ack']['request_id'], 'r1')
+
+
+class OutboundBatchingTests(TransactionTestCase):
+    def setUp(self):
+        clear_caches()
+        membership_cache.clear()
+        recent_sends.clear()
+        self.alice, self.bob = make_user('alice'), make_user('bob')
+        self.chat = make_chat(self.alice, self.bob)
+
+    def burst(self, bob_ws, decode):
+        async def scenario():
+            alice_ws = connect(self.alice)
+            await alice_ws.connect()
+            await bob_ws.connect()
+            for text in ('one', 'two', 'three'):
+                await alice_ws.send_json_to({'type': 'message.send', 'payload': {
+                    'chat_id': str(self.chat.id), 'content': text}})
+            frame = decode(await bob_ws.receive_from(timeout=3))
+            self.assertTrue(await bob_ws.receive_nothing(timeout=0.3))
+            await alice_ws.disconnect()
+            await bob_ws.disconnect()
+            return frame
+
+        with mock.patch('apps.chat.consumers.OUTBOUND_BATCH_WINDOW', 0.5):
+            frame = async_to_sync(scenario)()
+        self.assertEqual(frame['type'], 'batch')
+        self.assertEqual([e['payload']['content'] for e in frame['events']], ['one', 'two', 'three'])
+
+    def test_events_within_window_arrive_as_one_batch(self):
+        self.burst(connect(self.bob, 'batch=1'), json.loads)
+
+    @skipUnless(msgpack, 'msgpack is not installed')
+    def test_msgpack_batch(self):
+        self.burst(
+            connect(self.bob, 'batch=1', subprotocols=[wire.MSGPACK_SUBPROTOCOL]),
+            lambda frame: wire.MSGPACK.decode(bytes_data=frame),
+        )
+
+
+class OutboundQueueTests(TestCase):
+    def setUp(self):
+        self.now = 0
+        self.queue = OutboundQueue(high_water=3, overload_seconds=5, clock=lambda: self.now)
+
+    def test_ephemeral_frames_shed_first(self):
+        self.queue.push('typing', ephemeral=True)
+        self.queue.push('m1')
+        self.queue.push('m2')
+        self.assertEqual(self.queue.push('presence', ephemeral=True), DROPPED)
+        # Over the mark a real frame evicts the queued ephemeral one
+        self.assertEqual(self.queue.push('m3'), QUEUED)
+        self.assertEqual(self.queue.pop(10), ['m1', 'm2', 'm3'])
+
+    def test_overloaded_when_over_the_mark_too_long(self):
+        for i in range(4):
+            self.assertEqual(self.queue.push(i), QUEUED)
+        self.now = 6
+        self.assertEqual(self.queue.push(4), OVERLOADED)
+
+    def test_overloaded_at_twice_the_mark(self):
+        results = [self.queue.push(i) for i in range(7)]
+        self.assertEqual(results[-1], OVERLOADED)
+
+    def test_unacked_frames_count_as_backlog(self):
+        queue = OutboundQueue(high_water=3, overload_seconds=5, acks=True, clock=lambda: self.now)
+        for i in range(3):
+            queue.push(i)
+            queue.pop(1)
+            queue.sent()
+        # Written, but the client has not said it got them
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(queue.backlog(), 3)
+        self.assertFalse(queue.has_room())
+        self.assertEqual(queue.push('typing', ephemeral=True), DROPPED)
+
+        queue.ack(2)
+        self.assertEqual(queue.backlog(), 1)
+        # Acks never go back, nor past what was written
+        queue.ack(1)
+        queue.ack(10)
+        self.assertEqual(queue.backlog(), 0)
+
+    def test_metrics_snapshot(self):
+        for i in range(3):
+            self.queue.push(i)
+        snapshot = outbound.metrics.snapshot()
+        self.assertGreaterEqual(snapshot['depth']['1-9'], 1)
+        self.assertGreaterEqual(snapshot['over_high_water'], 1)
+
+        admin = User.objects.create_superuser('root', 'root@example.com', 'pass1234', phone='+10')
+        client = APIClient()
+        client.force_authenticate(admin)
+        response = client.get('/api/chat/metrics/outbound/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('dropped_ephemeral', response.data)
+
+
+class BackpressureTests(TransactionTestCase):
+    def setUp(self):
+        clear_caches()
+        membership_cache.clear()
+        self.alice, self.bob = make_user('alice'), make_user('bob')
+        self.chat = make_chat(self.alice, self.bob)
+
+    def send_messages(self, bob_query, count, bob_acks):
+        async def scenario():
+            alice_ws, bob_ws = connect(self.alice), connect(self.bob, bob_query)
+            await alice_ws.connect()
+            await bob_ws.connect()
+            received = 0
+            for i in range(count):
+                await alice_ws.send_json_to({'type': 'message.send', 'payload': {
+                    'chat_id': str(self.chat.id), 'content': str(i)}})
+                await alice_ws.receive_json_from()
+                await alice_ws.receive_json_from()
+                if bob_acks:
+                    await bob_ws.receive_json_from()
+                    received += 1
+                    await bob_ws.send_json_to({'type': 'ack', 'payload': {'received': received}})
+            # Bob's output up to the close, if any
+            closed = None
+            while closed is None and not await bob_ws.receive_nothing():
+                output = await bob_ws.receive_output()
+                if output['type'] == 'websocket.close':
+                    closed = output
+            await alice_ws.disconnect()
+            await bob_ws.disconnect()
+            return closed
+
+        with mock.patch.object(outbound, 'OUTBOUND_HIGH_WATER', 3):
+            return async_to_sync(scenario)()
+
+    def test_client_that_stops_acking_is_closed_for_resync(self):
+        # Frames reach the server's buffer at once; only missing acks show the backlog
+        closed = self.send_messages('ack=1', 8, bob_acks=False)
+        self.assertEqual(closed, {'type': 'websocket.close', 'code': outbound.RESYNC_CLOSE_CODE})
+
+    def test_acking_client_stays_connected(self):
+        self.assertIsNone(self.send_messages('ack=1', 8, bob_acks=True))
+        # Without acks only the queue is bounded, and the writer keeps it empty
+        self.assertIsNone(self.send_messages('', 8, bob_acks=False))
+
+
+class LoopWorkerTests(TestCase):
+    def test_failed_flush_is_logged_and_retried(self):
+        pending = ['change']
+        calls = []
+
+        async def flush():
+            calls.append(len(calls))
+            if len(calls) == 1:
+                raise RuntimeError('database is locked')
+            pending.clear()
+
+        async def scenario():
+            worker = workers.LoopWorker(lambda: workers.flush_periodically(0, lambda: pending, flush, 'Test'))
+            worker.ensure()
+            first = worker.task
+            # Already running on this loop: not started twice
+            worker.ensure()
+            self.assertIs(worker.task, first)
+            await first
+
+        with self.assertLogs('apps.chat.workers', 'ERROR') as logs:
+            async_to_sync(scenario)()
+        self.assertEqual(calls, [0, 1])
+        self.assertIn('Test flush failed', logs.output[0])
+
+
+class RateLimitTests(TestCase):
+    def setUp(self):
+        self.now = 0
+        self.limiter = RateLimiter({
+            'message.send': {'connection': (1, 2), 'user': (1, 3)},
+            '*': {'connection': (10, 10)},
+        }, abuse_limit=2, abuse_window=10, clock=lambda: self.now)
+
+    def test_connection_bucket(self):
+        conn = self.limiter.attach('u1')
+        self.assertEqual([self.limiter.check(conn, 'message.send') for _ in range(3)], [0, 0, 1])
+        self.now = 1
+        self.assertEqual(self.limiter.check(conn, 'message.send'), 0)
+        # Other event types have their own buckets
+        self.assertEqual(self.limiter.check(conn, 'ping'), 0)
+
+    def test_user_bucket_is_shared_by_connections(self):
+        phone, laptop = self.limiter.attach('u1'), self.limiter.attach('u1')
+        results = [self.limiter.check(c, 'message.send') for c in (phone, phone, laptop, laptop)]
+        self.assertEqual(results[:3], [0, 0, 0])
+        self.assertGreater(results[3], 0)
+
+        self.limiter.detach(phone)
+        self.limiter.detach(laptop)
+        self.assertEqual(self.limiter._users, {})
+
+    def test_sustained_rejections_disconnect(self):
+        conn = self.limiter.attach('u1')
+        self.assertEqual([self.limiter.reject(conn) for _ in range(3)], [True, True, False])
+
+
+class RateLimitConsumerTests(TransactionTestCase):
+    def test_over_limit_frames_get_retry_after_then_disconnect(self):
+        alice = make_user('alice')
+        limiter = RateLimiter({
+            ratelimit.FRAME: {'connection': (100, 100)},
+            '*': {'connection': (0.5, 2)},
+        }, abuse_limit=2, abuse_window=60)
+
+        async def scenario():
+            ws = connect(alice)
+            await ws.connect()
+            frames = []
+            for _ in range(4):
+                await ws.send_json_to({'type': 'ping', 'request_id': 'p'})
+                frames.append(await ws.receive_json_from())
+            await ws.send_json_to({'type': 'ping'})
+            frames.append(await ws.receive_json_from())
+            closed = await ws.receive_output()
+            return frames, closed
+
+        with mock.patch('apps.chat.consumers.rate_limiter', limiter):
+            frames, closed = async_to_sync(scenario)()
+        self.assertEqual([f['type'] for f in frames], ['pong', 'pong', 'error', 'error', 'error'])
+        error = frames[2]
+        self.assertEqual(error['request_id'], 'p')
+        self.assertEqual(error['payload']['code'], 'rate_limited')
+        self.assertGreater(error['payload']['retry_after'], 0)
+        self.assertEqual(closed, {'type': 'websocket.close', 'code': 4029})
+
+    def test_undecodable_frames_are_limited(self):
+        alice = make_user('alice')
+        limiter = RateLimiter({'*': {'connection': (0.5, 3)}}, abuse_limit=2, abuse_window=60)
+
+        async def scenario():
+            ws = connect(alice)
+            await ws.connect()
+            frames = []
+            for garbage in ('{not json', '[1, 2]', '"text"'):
+                await ws.send_to(text_data=garbage)
+                frames.append(await ws.receive_json_from())
+            closed = await ws.receive_output()
+            return frames, closed
+
+        with mock.patch('apps.chat.consumers.rate_limiter', limiter):
+            frames, closed = async_to_sync(scenario)()
+        # Generic replies, and the third one empties the abuse bucket
+        self.assertEqual([f['payload'] for f in frames], [
+            {'message': 'Invalid frame', 'code': 'invalid_frame'},
+            {'message': 'Invalid frame', 'code': 'invalid_frame'},
+            {'message': 'Too many invalid frames', 'code': 'invalid_frame'},
+        ])
+        self.assertEqual(closed, {'type': 'websocket.close', 'code': 4029})
+
+        # Frames are charged before they are decoded
+        conn = limiter.attach(str(alice.id))
+        self.assertEqual([limiter.check_frame(conn) > 0 for _ in range(4)], [False, False, False, True])
+
+
+class GatedLayer:
+    """Channel layer whose sends wait until the gate is opened."""
+
+    def __init__(self):
+        self.gate = threading.Event()
+        self.sent = []
+
+    async def group_send(self, group, event):
+        while not self.gate.is_set():
+            await asyncio.sleep(0.01)
+        self.sent.append((group, event))
+
+
+class BroadcastTests(TestCase):
+    def setUp(self):
+        clear_caches()
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+        self.carol = make_user('carol')
+        self.group = make_chat(self.alice, self.bob, self.carol, chat_type='group', name='Team')
+
+    def test_mark_read_does_not_wait_for_fan_out(self):
+        sent = {self.bob.id: [], self.carol.id: []}
+        for i in range(10):
+            for sender in (self.bob, self.carol):
+                sent[sender.id].append(str(create_message(chat=self.group, sender=sender, content=str(i)).id))
+
+        layer = GatedLayer()
+        client = APIClient()
+        client.force_authenticate(self.alice)
+        with mock.patch('apps.chat.broadcast.get_channel_layer', return_value=layer):
+            with self.captureOnCommitCallbacks(execute=True):
+                response = client.post(f'/api/chat/chats/{self.group.id}/mark_read/')
+            self.assertEqual(response.data['updated_count'], 20)
+            self.assertEqual(layer.sent, [])
+
+            layer.gate.set()
+            broadcaster.drain(timeout=5)
+
+        # One range receipt per sender
+        for sender in (self.bob, self.carol):
+            frames = [json.loads(event['text']) for group, event in layer.sent
+                      if group == events.user_stream(sender.id)]
+            self.assertEqual([f['type'] for f in frames], ['messages.read_up_to'])
+            self.assertEqual(frames[0]['payload']['message_id'], sent[self.carol.id][-1])
+
+    def test_recipient_gets_broadcasts_in_order(self):
+        class SlowFirstLayer:
+            def __init__(self):
+                self.sent = []
+
+            async def group_send(self, group, event):
+                if not self.sent and not getattr(self, 'delayed', False):
+                    self.delayed = True
+                    await asyncio.sleep(0.2)
+                self.sent.append(json.loads(event['text'])['payload']['n'])
+
+        layer = SlowFirstLayer()
+        with mock.patch('apps.chat.broadcast.get_channel_layer', return_value=layer):
+            for n in range(3):
+                broadcaster.submit([(str(self.bob.id), 'chat_message', {'type': 'chat.updated', 'payload': {'n': n}}, True)])
+            broadcaster.drain(timeout=5)
+        self.assertEqual(layer.sent, [0, 1, 2])
+
+    def test_sent_once_committed(self):
+        with mock.patch.object(broadcaster, 'submit') as submit:
+            with self.captureOnCommitCallbacks(execute=True):
+                try:
+                    with transaction.atomic():
+                        broadcast = Broadcast()
+                        broadcast.to_user(self.bob.id, 'chat_message', {'type': 'chat.updated'})
+                        broadcast.send()
+                        raise RuntimeError
+                except RuntimeError:
+                    pass
+
+                broadcast = Broadcast()
+                broadcast.chat_groups([self.bob.id], self.group.id, joined=True)
+                broadcast.to_user(self.bob.id, 'chat_message', {'type': 'chat.new'})
+                broadcast.send()
+                submit.assert_not_called()
+
+        submit.assert_called_once()
+        self.assertEqual([item[1] for item in submit.call_args[0][0]], ['chat_membership', 'chat_message'])
@@ -0,0 +1,121 @@
+"""
+Typing indicators, coalesced per chat.
+
+Clients send typing.start on keystrokes and typing.stop when they pause, so
+forwarding each frame as-is multiplies keystrokes by chat members. Instead
+the consumer records them here and, at most once per TYPING_INTERVAL, each
+chat with changes gets a single `typing.update` event:
+
+    {'chat_id': ..., 'typing': [user ids], 'stopped': [user ids], 'expires_in': seconds}
+
+`typing` lists users who started typing, or are still typing and due for a
+refresh; `stopped` lists users who stopped or went quiet. Repeat starts
+within TYPING_REFRESH of the last announcement are dropped, and a typer who
+sends nothing for TYPING_TIMEOUT seconds is reported as stopped without
+needing a typing.stop. Clients should drop a typer `expires_in` seconds after
+it was last listed.
+
+State is kept per process, and updates are deltas, so chats whose members
+are connected to different server processes still merge correctly.
+"""
+import time
+
+from django.conf import settings
+
+from . import events
+from .workers import LoopWorker, flush_periodically
+
+TYPING_INTERVAL = getattr(settings, 'CHAT_TYPING_INTERVAL_MS', 500) / 1000
+TYPING_REFRESH = getattr(settings, 'CHAT_TYPING_REFRESH_SECONDS', 3)
+TYPING_TIMEOUT = getattr(settings, 'CHAT_TYPING_TIMEOUT_SECONDS', 6)
+
+
+class _ChatTyping:
+    def __init__(self, channel_layer):
+        self.channel_layer = channel_layer
+        self.typers = {}  # user id -> [expires_at, announced_at]
+        self.started = set()
+        self.stopped = set()
+
+
+class TypingTracker:
+    """
+    In-memory typing state for the chats of this process. start() and stop()
+    only update state; a worker task on the event loop sends the coalesced
+    updates and expires stale typers, and exits once no one is typing.
+    """
+
+    def __init__(self, interval, refresh, timeout, clock=time.monotonic):
+        self.interval = interval
+        self.refresh = refresh
+        self.timeout = timeout
+        self.clock = clock
+        self._chats = {}
+        self._worker = LoopWorker(lambda: flush_periodically(
+            self.interval, lambda: self._chats, self.flush, 'Typing',
+        ))
+
+    def start(self, channel_layer, chat_id, user_id):
+        now = self.clock()
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = _ChatTyping(channel_layer)
+
+        entry = chat.typers.get(user_id)
+        if entry is not None and now - entry[1] < self.refresh:
+            entry[0] = now + self.timeout
+            return
+        chat.typers[user_id] = [now + self.timeout, now]
+        chat.started.add(user_id)
+        chat.stopped.discard(user_id)
+        self._worker.ensure()
+
+    def stop(self, channel_layer, chat_id, user_id):
+        chat = self._chats.get(chat_id)
+        if chat is None or chat.typers.pop(user_id, None) is None:
+            return
+        chat.started.discard(user_id)
+        chat.stopped.add(user_id)
+        self._worker.ensure()
+
+    def typing(self, chat_id):
+        """User ids currently typing in a chat, as seen by this process."""
+        chat = self._chats.get(chat_id)
+        return set(chat.typers) if chat else set()
+
+    async def flush(self):
+        """Expire stale typers and send one update per chat that changed."""
+        now = self.clock()
+        for chat_id, chat in list(self._chats.items()):
+            for user_id, (expires_at, _announced_at) in list(chat.typers.items()):
+                if expires_at <= now:
+                    del chat.typers[user_id]
+                    chat.started.discard(user_id)
+                    chat.stopped.add(user_id)
+
+            if chat.started or chat.stopped:
+                message = {
+                    'type': 'typing.update',
+                    'payload': {
+                        'chat_id': chat_id,
+                        'typing': sorted(chat.started),
+                        'stopped': sorted(chat.stopped),
+                        'expires_in': self.timeout,
+                    }
+                }
+                users = sorted(chat.started | chat.stopped)
+                chat.started, chat.stopped = set(), set()
+                # `users` lets the typers' own connections spot themselves without decoding
+                await events.asend_to_chat(
+                    chat.channel_layer, chat_id, 'typing_indicator', message, log=False, users=users
+                )
+
+            if not (chat.typers or chat.started or chat.stopped):
+                self._chats.pop(chat_id, None)
+
+
+tracker = TypingTracker(
+    interval=TYPING_INTERVAL,
+    refresh=TYPING_REFRESH,
+    timeout=TYPING_TIMEOUT,
+)
@@ -1,10 +1,11 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import ChatViewSet
+from .views import ChatViewSet, outbound_metrics
 
 router = DefaultRouter()
 router.register(r'chats', ChatViewSet, basename='chat')
 
 urlpatterns = [
+    path('metrics/outbound/', outbound_metrics, name='outbound-metrics'),
     path('', include(router.urls)),
 ]
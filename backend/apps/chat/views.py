@@ -1,10 +1,20 @@
+import uuid
+
 from rest_framework import viewsets, status
-from rest_framework.decorators import action
+from rest_framework.decorators import action, api_view, permission_classes
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated
-from django.db.models import Q
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
+from django.db.models import Q, OuterRef, Prefetch, Subquery
+from django.db.models.functions import Coalesce
 from .models import Chat, ChatParticipant, Message
-from .serializers import ChatSerializer, MessageSerializer
+from .serializers import ChatSerializer, MessageSearchResultSerializer, MessageSerializer, SyncParticipantSerializer
+from .pagination import MessageCursorPagination, MessageSearchPagination
+from .services import mark_chat_read, read_receipt, record_tombstones
+from . import search, sync
+from .broadcast import Broadcast
+from .receipts import with_receipt_counts
+from .membership import membership_cache
+from . import outbound
 
 class ChatViewSet(viewsets.ModelViewSet):
     """
@@ -15,9 +25,28 @@ class ChatViewSet(viewsets.ModelViewSet):
     
     def get_queryset(self):
         # Get chats where current user is a participant
+        user = self.request.user
+        my_chats = ChatParticipant.objects.filter(user=user).values('chat_id')
+
+        # Everything the serializer needs per chat is computed in the same query
+        # (unread count, other participant) or one prefetch (the roster).
+        membership = ChatParticipant.objects.filter(chat=OuterRef('pk'), user=user)
+
+        other = ChatParticipant.objects.filter(
+            chat=OuterRef('pk')
+        ).exclude(user=user).order_by('joined_at')
+
         return Chat.objects.filter(
-            participants__user=self.request.user
-        ).distinct().order_by('-created_at')
+            pk__in=my_chats
+        ).annotate(
+            unread_total=Coalesce(Subquery(membership.values('unread_count')[:1]), 0),
+            other_username=Subquery(other.values('user__username')[:1]),
+            other_is_online=Subquery(other.values('user__is_online')[:1]),
+        ).select_related(
+            'last_message_sender'
+        ).prefetch_related(
+            Prefetch('participants', queryset=ChatParticipant.objects.select_related('user'))
+        ).order_by('-last_activity_at')
     
     def create(self, request, *args, **kwargs):
         """
@@ -54,9 +83,6 @@ class ChatViewSet(viewsets.ModelViewSet):
         return super().create(request, *args, **kwargs)
     
     def perform_create(self, serializer):
-        from channels.layers import get_channel_layer
-        from asgiref.sync import async_to_sync
-        
         # Create chat and add current user as participant and creator
         # Added created_by=self.request.user
         chat = serializer.save(created_by=self.request.user)
@@ -67,31 +93,23 @@ class ChatViewSet(viewsets.ModelViewSet):
         )
         
         # Broadcast chat.new
-        channel_layer = get_channel_layer()
-        participant_ids = chat.participants.values_list('user_id', flat=True)
-        
-        for p_id in participant_ids:
-            if str(p_id) == str(self.request.user.id): continue
-            
-            async_to_sync(channel_layer.group_send)(
-                f"user_{p_id}",
-                {
-                    'type': 'chat_message',
-                    'message': {
-                        'type': 'chat.new',
-                        'payload': {
-                            'chat_id': str(chat.id),
-                            'name': chat.name,
-                            'type': chat.type
-                        }
-                    }
+        broadcast = Broadcast()
+        participant_ids = list(chat.participants.values_list('user_id', flat=True))
+        broadcast.chat_groups(participant_ids, chat.id, joined=True)
+        broadcast.to_users(
+            [p_id for p_id in participant_ids if str(p_id) != str(self.request.user.id)],
+            'chat_message', {
+                'type': 'chat.new',
+                'payload': {
+                    'chat_id': str(chat.id),
+                    'name': chat.name,
+                    'type': chat.type
                 }
-            )
+            }
+        )
+        broadcast.send()
 
     def perform_update(self, serializer):
-        from channels.layers import get_channel_layer
-        from asgiref.sync import async_to_sync
-        
         chat = self.get_object()
         
         # Check permissions: Only admin can update group info
@@ -104,23 +122,18 @@ class ChatViewSet(viewsets.ModelViewSet):
         updated_chat = serializer.save()
         
         # Broadcast update
-        channel_layer = get_channel_layer()
-        participant_ids = chat.participants.values_list('user_id', flat=True)
-        
-        for p_id in participant_ids:
-            async_to_sync(channel_layer.group_send)(
-                f"user_{p_id}",
-                {
-                    'type': 'chat_message',
-                    'message': {
-                        'type': 'chat.updated',
-                        'payload': {
-                            'chat_id': str(updated_chat.id),
-                            'name': updated_chat.name
-                        }
-                    }
+        broadcast = Broadcast()
+        broadcast.to_users(
+            chat.participants.values_list('user_id', flat=True),
+            'chat_message', {
+                'type': 'chat.updated',
+                'payload': {
+                    'chat_id': str(updated_chat.id),
+                    'name': updated_chat.name
                 }
-            )
+            }
+        )
+        broadcast.send()
 
     def destroy(self, request, *args, **kwargs):
         """
@@ -128,9 +141,6 @@ class ChatViewSet(viewsets.ModelViewSet):
         - Private: Any participant can delete (for everyone - simplified).
         - Group: Only admin can delete.
         """
-        from channels.layers import get_channel_layer
-        from asgiref.sync import async_to_sync
-        
         instance = self.get_object()
         
         # Check permissions
@@ -150,78 +160,131 @@ class ChatViewSet(viewsets.ModelViewSet):
         chat_id = str(instance.id)
         
         self.perform_destroy(instance)
+        membership_cache.invalidate(chat_id)
+        record_tombstones('chat.deleted', chat_id, participant_ids)
         
         # Broadcast deleted event
-        channel_layer = get_channel_layer()
-        for p_id in participant_ids:
-            async_to_sync(channel_layer.group_send)(
-                f"user_{p_id}",
-                {
-                    'type': 'chat_message',
-                    'message': {
-                        'type': 'chat.deleted',
-                        'payload': { 'chat_id': chat_id }
-                    }
-                }
-            )
+        broadcast = Broadcast()
+        broadcast.chat_groups(participant_ids, chat_id, joined=False)
+        broadcast.to_users(participant_ids, 'chat_message', {
+            'type': 'chat.deleted',
+            'payload': { 'chat_id': chat_id }
+        })
+        broadcast.send()
         return Response(status=status.HTTP_204_NO_CONTENT)
     
     @action(detail=True, methods=['get'])
     def messages(self, request, pk=None):
-        """Get messages for a specific chat."""
+        """
+        Get messages for a specific chat, one page at a time.
+        Pass `before` / `after` cursors from a previous page to move through history,
+        or `from_seq` / `to_seq` to fetch an exact range (e.g. to fill a gap).
+        """
         chat = self.get_object()
-        messages = Message.objects.filter(chat=chat).order_by('created_at')
-        serializer = MessageSerializer(messages, many=True)
-        return Response(serializer.data)
+        messages = with_receipt_counts(
+            Message.objects.filter(chat=chat).select_related('sender'), request.user
+        )
+
+        try:
+            from_seq = request.query_params.get('from_seq')
+            to_seq = request.query_params.get('to_seq')
+            if from_seq is not None:
+                messages = messages.filter(seq__gte=int(from_seq))
+            if to_seq is not None:
+                messages = messages.filter(seq__lte=int(to_seq))
+        except ValueError:
+            return Response({'error': 'from_seq and to_seq must be integers'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        paginator = MessageCursorPagination()
+        page = paginator.paginate_queryset(messages, request, view=self)
+        serializer = MessageSerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
+
+    @action(detail=False, methods=['get'])
+    def search(self, request):
+        """
+        Full-text search over the messages of the user's chats, best matches first.
+        Pass the search text as `q` and optionally `chat_id` to search one chat;
+        page with the `next` cursor of the previous page.
+        """
+        text = request.query_params.get('q', '')
+        if not search.search_terms(text):
+            return Response({'error': 'q must contain at least one word'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        chat_id = request.query_params.get('chat_id')
+        if chat_id is not None:
+            try:
+                chat_id = uuid.UUID(chat_id)
+            except ValueError:
+                return Response({'error': 'chat_id must be a UUID'},
+                                status=status.HTTP_400_BAD_REQUEST)
+
+        paginator = MessageSearchPagination()
+        page = paginator.paginate_search(
+            lambda offset, limit: search.search_messages(request.user, text, chat_id, offset, limit),
+            request,
+        )
+        serializer = MessageSearchResultSerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
+
+    @action(detail=False, methods=['get'])
+    def sync(self, request):
+        """
+        Delta sync for reconnecting clients.
+        Pass the `token` from the previous sync to get only what changed since then.
+        Without a (valid) token the full chat list is returned with `full: true`.
+        """
+        token = request.query_params.get('token')
+        context = self.get_serializer_context()
+        try:
+            since, after_message_id = sync.read_sync_token(token, request.user) if token else (None, None)
+        except sync.InvalidSyncToken:
+            since = None
+
+        if since is None:
+            return Response({
+                'token': sync.initial_token(request.user),
+                'full': True,
+                'has_more': False,
+                'chats': ChatSerializer(self.get_queryset(), many=True, context=context).data,
+                'participants_added': [],
+                'participants_removed': [],
+                'deleted_chat_ids': [],
+                'messages': [],
+            })
+
+        changes = sync.get_changes(request.user, self.get_queryset(), since, after_message_id)
+        return Response({
+            'token': changes['token'],
+            'full': False,
+            'has_more': changes['has_more'],
+            'chats': ChatSerializer(changes['chats'], many=True, context=context).data,
+            'participants_added': SyncParticipantSerializer(changes['participants_added'], many=True).data,
+            'participants_removed': [
+                {'chat_id': str(t.chat_id), 'user_id': str(t.subject_id)}
+                for t in changes['participants_removed']
+            ],
+            'deleted_chat_ids': [str(chat_id) for chat_id in changes['deleted_chat_ids']],
+            'messages': MessageSerializer(changes['messages'], many=True).data,
+        })
 
     @action(detail=True, methods=['post'])
     def mark_read(self, request, pk=None):
         """Mark all messages in chat as read."""
-        from django.utils import timezone
-        from channels.layers import get_channel_layer
-        from asgiref.sync import async_to_sync
-        
         chat = self.get_object()
-        
-        # Get messages that will be updated to notify senders
-        # Filter messages from others that are not read
-        messages_to_update = Message.objects.filter(
-            chat=chat
-        ).exclude(
-            sender=request.user
-        ).exclude(
-            status='read'
-        )
-        
-        # We need the IDs and senders before updating
-        updates = list(messages_to_update.values('id', 'sender_id'))
-        
-        # Mark messages from others as read
-        updated_count = messages_to_update.update(
-            status='read',
-            read_at=timezone.now()
-        )
-        
-        # Broadcast read status to senders via WebSocket
-        channel_layer = get_channel_layer()
-        current_time_iso = timezone.now().isoformat()
-        
-        for msg in updates:
-            sender_group = f"user_{msg['sender_id']}"
-            async_to_sync(channel_layer.group_send)(
-                sender_group,
-                {
-                    'type': 'message_status',
-                    'message': {
-                        'type': 'message.read',
-                        'payload': {
-                            'message_id': str(msg['id']),
-                            'chat_id': str(chat.id),
-                            'read_at': current_time_iso
-                        }
-                    }
-                }
-            )
+        participant = ChatParticipant.objects.get(chat=chat, user=request.user)
+
+        # One UPDATE for the whole unread range, and the read cursor (one row)
+        from_seq = participant.last_read_seq
+        read = mark_chat_read(participant)
+        if not read:
+            return Response({'status': 'success', 'updated_count': 0})
+        latest, updated_count, sender_ids = read
+
+        # One range receipt per sender whose messages were read
+        broadcast = Broadcast()
+        broadcast.to_users(sender_ids, 'message_status', read_receipt(participant, latest, from_seq))
+        broadcast.send()
         
         return Response({
             'status': 'success',
@@ -231,9 +294,6 @@ class ChatViewSet(viewsets.ModelViewSet):
     @action(detail=True, methods=['post'])
     def leave(self, request, pk=None):
         """Leave a group chat."""
-        from channels.layers import get_channel_layer
-        from asgiref.sync import async_to_sync
-        
         chat = self.get_object()
         if chat.type == 'private':
             return Response({'error': 'Cannot leave private chat'}, status=status.HTTP_400_BAD_REQUEST)
@@ -250,29 +310,24 @@ class ChatViewSet(viewsets.ModelViewSet):
             pass
 
         participant.delete()
+        membership_cache.invalidate(chat.id)
         
         # Broadcast
-        channel_layer = get_channel_layer()
-        other_participants = chat.participants.values_list('user_id', flat=True)
-        for p_id in other_participants:
-            async_to_sync(channel_layer.group_send)(
-                f"user_{p_id}",
-                {
-                    'type': 'chat_message',
-                    'message': {
-                        'type': 'participant.left',
-                        'payload': { 'chat_id': str(chat.id), 'user_id': str(request.user.id) }
-                    }
-                }
-            )
+        other_participants = list(chat.participants.values_list('user_id', flat=True))
+        record_tombstones('participant.removed', chat.id, other_participants, subject_id=request.user.id)
+        record_tombstones('chat.deleted', chat.id, [request.user.id])
+        broadcast = Broadcast()
+        broadcast.chat_groups([request.user.id], chat.id, joined=False)
+        broadcast.to_users(other_participants, 'chat_message', {
+            'type': 'participant.left',
+            'payload': { 'chat_id': str(chat.id), 'user_id': str(request.user.id) }
+        })
+        broadcast.send()
         return Response({'status': 'left'})
 
     @action(detail=True, methods=['post'])
     def add_participants(self, request, pk=None):
         """Add users to group (Admin only)."""
-        from channels.layers import get_channel_layer
-        from asgiref.sync import async_to_sync
-        
         chat = self.get_object()
         if chat.type != 'group':
             return Response({'error': 'Not a group chat'}, status=status.HTTP_400_BAD_REQUEST)
@@ -287,13 +342,20 @@ class ChatViewSet(viewsets.ModelViewSet):
         for uid in user_ids:
             # Check if already in
             if not ChatParticipant.objects.filter(chat=chat, user_id=uid).exists():
-                ChatParticipant.objects.create(chat=chat, user_id=uid, role='member')
+                # Receipts only count from here on (see receipts)
+                ChatParticipant.objects.create(
+                    chat=chat, user_id=uid, role='member',
+                    last_delivered_seq=chat.last_seq, last_read_seq=chat.last_seq,
+                )
                 added_users.append(uid)
+        if added_users:
+            membership_cache.invalidate(chat.id)
         
         # Broadcast to ALL (including new) - New users need chat.new equivalent?
         # Ideally new user gets "chat.new". Old users get "participant.added".
         
-        channel_layer = get_channel_layer()
+        broadcast = Broadcast()
+        broadcast.chat_groups(added_users, chat.id, joined=True)
         all_participants = chat.participants.values_list('user_id', flat=True)
         
         for p_id in all_participants:
@@ -305,25 +367,19 @@ class ChatViewSet(viewsets.ModelViewSet):
             else:
                 payload.update({'added_user_ids': added_users})
             
-            async_to_sync(channel_layer.group_send)(
-                f"user_{p_id}",
-                {
-                    'type': 'chat_message',
-                    'message': {
-                        'type': msg_type,
-                        'payload': payload
-                    }
+            broadcast.to_user(
+                p_id, 'chat_message', {
+                    'type': msg_type,
+                    'payload': payload
                 }
             )
+        broadcast.send()
             
         return Response({'status': 'added', 'count': len(added_users)})
 
     @action(detail=True, methods=['post'])
     def remove_participant(self, request, pk=None):
         """Remove user from group (Admin only)."""
-        from channels.layers import get_channel_layer
-        from asgiref.sync import async_to_sync
-        
         chat = self.get_object()
         if chat.type != 'group':
              return Response({'error': 'Not a group chat'}, status=status.HTTP_400_BAD_REQUEST)
@@ -343,34 +399,38 @@ class ChatViewSet(viewsets.ModelViewSet):
         participant = ChatParticipant.objects.filter(chat=chat, user_id=user_id).first()
         if participant:
             participant.delete()
+            membership_cache.invalidate(chat.id)
+            remaining = list(chat.participants.values_list('user_id', flat=True))
+            record_tombstones('participant.removed', chat.id, remaining, subject_id=participant.user_id)
+            record_tombstones('chat.deleted', chat.id, [participant.user_id])
             
             # Broadcast to removed user (chat.deleted/removed) and others (participant.removed)
-            channel_layer = get_channel_layer()
+            broadcast = Broadcast()
+            broadcast.chat_groups([user_id], chat.id, joined=False)
             
             # Notify removed user
-            async_to_sync(channel_layer.group_send)(
-                f"user_{user_id}",
-                {
-                    'type': 'chat_message',
-                    'message': {
-                        'type': 'chat.deleted', # Effectively deleted for them
-                        'payload': { 'chat_id': str(chat.id) }
-                    }
+            broadcast.to_user(
+                user_id, 'chat_message', {
+                    'type': 'chat.deleted', # Effectively deleted for them
+                    'payload': { 'chat_id': str(chat.id) }
                 }
             )
             
             # Notify remaining
-            remaining = chat.participants.values_list('user_id', flat=True)
-            for p_id in remaining:
-                async_to_sync(channel_layer.group_send)(
-                    f"user_{p_id}",
-                    {
-                        'type': 'chat_message',
-                        'message': {
-                            'type': 'participant.removed',
-                            'payload': { 'chat_id': str(chat.id), 'user_id': user_id }
-                        }
-                    }
-                )
+            broadcast.to_users(remaining, 'chat_message', {
+                'type': 'participant.removed',
+                'payload': { 'chat_id': str(chat.id), 'user_id': user_id }
+            })
+            broadcast.send()
 
         return Response({'status': 'removed'})
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def outbound_metrics(request):
+    """
+    WebSocket outbound queue depths and shedding counters of the server
+    process handling this request.
+    """
+    return Response(outbound.metrics.snapshot())
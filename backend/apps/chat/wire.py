@@ -0,0 +1,145 @@
+"""
+Wire formats for the chat WebSocket.
+
+JSON text frames are the default. Clients that offer the `chat.msgpack.v1`
+subprotocol get MessagePack binary frames instead, with the same structure
+except that:
+
+- canonical UUID strings are sent as extension type 1 (16 raw bytes), in
+  any position, and are accepted that way from clients;
+- ISO 8601 values of `timestamp` and `*_at` keys are sent as integer
+  milliseconds since the epoch.
+
+Connections that opt into batching may also get `{"type": "batch",
+"events": [...]}` frames; each event is a complete frame on its own.
+
+Frames arrive at consumers already JSON-encoded (see events.encode), so the
+MessagePack form of a frame is derived from its JSON text once per process
+and shared by every MessagePack connection receiving it.
+
+MessagePack support needs the `msgpack` package (installed with
+channels-redis); without it only JSON is offered.
+"""
+import json
+import uuid
+from datetime import datetime
+from functools import lru_cache
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+MSGPACK_SUBPROTOCOL = 'chat.msgpack.v1'
+UUID_EXT_TYPE = 1
+
+
+class InvalidFrame(ValueError):
+    pass
+
+
+def _is_timestamp_key(key):
+    return key == 'timestamp' or key.endswith('_at')
+
+
+def _compact(value, key=''):
+    """Swap UUID strings for UUID extensions and ISO timestamps for epoch ms."""
+    if isinstance(value, dict):
+        return {k: _compact(v, k) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_compact(v, key) for v in value]
+    if isinstance(value, str):
+        if len(value) == 36 and value[8] == value[13] == value[18] == value[23] == '-':
+            try:
+                parsed = uuid.UUID(value)
+            except ValueError:
+                pass
+            else:
+                # Only the canonical form, so decoding gives back the same string
+                if str(parsed) == value:
+                    return msgpack.ExtType(UUID_EXT_TYPE, parsed.bytes)
+        if _is_timestamp_key(key):
+            try:
+                return int(datetime.fromisoformat(value).timestamp() * 1000)
+            except ValueError:
+                pass
+    return value
+
+
+def _ext_hook(code, data):
+    if code == UUID_EXT_TYPE and len(data) == 16:
+        return str(uuid.UUID(bytes=data))
+    return msgpack.ExtType(code, data)
+
+
+class JsonCodec:
+    subprotocol = None
+
+    def encode(self, message):
+        """Keyword arguments for consumer.send() carrying a message."""
+        return {'text_data': json.dumps(message)}
+
+    def forward(self, text):
+        """Keyword arguments for consumer.send() carrying a frame encoded as JSON."""
+        return {'text_data': text}
+
+    def batch(self, frames):
+        """One `batch` frame holding several encoded frames, without re-encoding them."""
+        return {'text_data': '{"type": "batch", "events": [%s]}' % ', '.join(
+            frame['text_data'] for frame in frames
+        )}
+
+    def decode(self, text_data=None, bytes_data=None):
+        try:
+            return json.loads(text_data if text_data is not None else bytes_data)
+        except (TypeError, ValueError):
+            raise InvalidFrame('Invalid JSON')
+
+
+class MsgpackCodec:
+    subprotocol = MSGPACK_SUBPROTOCOL
+
+    def encode(self, message):
+        return {'bytes_data': pack(message)}
+
+    def forward(self, text):
+        return {'bytes_data': pack_json(text)}
+
+    def batch(self, frames):
+        # A map {'type': 'batch', 'events': [...]} with the packed frames appended as-is
+        packer = msgpack.Packer(use_bin_type=True)
+        return {'bytes_data': b''.join([
+            packer.pack_map_header(2),
+            packer.pack('type'), packer.pack('batch'),
+            packer.pack('events'), packer.pack_array_header(len(frames)),
+            *[frame['bytes_data'] for frame in frames],
+        ])}
+
+    def decode(self, text_data=None, bytes_data=None):
+        if bytes_data is None:
+            raise InvalidFrame('Expected a binary MessagePack frame')
+        try:
+            return msgpack.unpackb(bytes_data, ext_hook=_ext_hook, raw=False)
+        except (TypeError, ValueError, msgpack.UnpackException):
+            raise InvalidFrame('Invalid MessagePack')
+
+
+def pack(message):
+    return msgpack.packb(_compact(message), use_bin_type=True)
+
+
+@lru_cache(maxsize=256)
+def pack_json(text):
+    """MessagePack form of a JSON-encoded frame, converted once per process."""
+    return pack(json.loads(text))
+
+
+JSON = JsonCodec()
+MSGPACK = MsgpackCodec() if msgpack is not None else None
+
+
+def negotiate(subprotocols):
+    """Codec for the subprotocols a client offered: MessagePack if offered and available."""
+    if MSGPACK is not None and MSGPACK_SUBPROTOCOL in (subprotocols or ()):
+        return MSGPACK
+    return JSON
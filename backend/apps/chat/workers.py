@@ -0,0 +1,51 @@
+"""
+Event-loop worker tasks for the write-behind services (delivery cursors,
+presence, typing indicators, message ingestion).
+
+A service keeps a LoopWorker and calls ensure() whenever it queues work:
+a task is started on the running event loop unless one is still running
+there, and it exits once there is nothing left to do. The next piece of
+work starts a new one.
+"""
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class LoopWorker:
+    def __init__(self, run, setup=None):
+        # `run` is the task's coroutine function; `setup`, if given, is called
+        # before each new task, e.g. to create queues bound to the new loop
+        self.run = run
+        self.setup = setup
+        self.loop = None
+        self.task = None
+
+    def ensure(self):
+        """Start the worker on the running loop unless it is already running there."""
+        loop = asyncio.get_running_loop()
+        if self.loop is loop and not self.task.done():
+            return
+        self.loop = loop
+        if self.setup is not None:
+            self.setup()
+        self.task = loop.create_task(self.run())
+
+    def cancel(self):
+        if self.task is not None:
+            self.task.cancel()
+
+
+async def flush_periodically(interval, has_pending, flush, name):
+    """
+    Worker body: flush every `interval` seconds while `has_pending()`.
+    A failed flush is logged and the worker carries on; flushes that keep
+    their work queued when they fail are thereby retried.
+    """
+    while has_pending():
+        await asyncio.sleep(interval)
+        try:
+            await flush()
+        except Exception:
+            logger.exception('%s flush failed', name)
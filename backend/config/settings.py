@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -217,3 +218,102 @@ MEDIA_ROOT = BASE_DIR / 'media'
 FILE_UPLOAD_MAX_MEMORY_SIZE = 10485760  # 10MB
 DATA_UPLOAD_MAX_MEMORY_SIZE = 10485760  # 10MB
 
+# Chat Settings
+CHAT_MESSAGES_PAGE_SIZE = 50
+CHAT_MESSAGES_MAX_PAGE_SIZE = 200
+CHAT_SYNC_OVERLAP_SECONDS = 2
+CHAT_SYNC_RETENTION_DAYS = 30
+CHAT_SYNC_MAX_MESSAGES = 500
+
+# WebSocket replay log (per-user ring buffer in the default cache)
+CHAT_EVENT_LOG_SIZE = 500
+CHAT_EVENT_LOG_TTL = 300  # seconds
+
+# Caches. Replay logs, auth snapshots and presence counters are shared state,
+# so with more than one server process set REDIS_URL. Redis must run with
+# maxmemory-policy noeviction: an evicted presence counter reads as offline.
+# Without it each process keeps its own local-memory caches (one process only):
+# the default one sized for CHAT_LOCAL_CACHE_STREAMS full replay logs plus other
+# entries, and presence counters in a separate one that is never culled.
+REDIS_URL = os.environ.get('REDIS_URL')
+CHAT_LOCAL_CACHE_STREAMS = 1000
+CHAT_PRESENCE_CACHE = 'presence'
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        },
+        'presence': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        },
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'default',
+            'OPTIONS': {'MAX_ENTRIES': CHAT_LOCAL_CACHE_STREAMS * (CHAT_EVENT_LOG_SIZE + 1) + 100000},
+        },
+        'presence': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'presence',
+            # One counter per connected user; culling would mark users offline
+            'OPTIONS': {'MAX_ENTRIES': 2 ** 62},
+        },
+    }
+
+# Per-process cache of chat memberships used by the WebSocket consumer
+CHAT_MEMBERSHIP_CACHE_SIZE = 10000
+CHAT_MEMBERSHIP_CACHE_TTL = 60  # seconds
+
+# Write-behind message ingestion: batch WebSocket sends into one transaction
+CHAT_INGEST_BATCHING = False
+CHAT_INGEST_FLUSH_MS = 5
+CHAT_INGEST_MAX_BATCH = 100
+
+# Per-process cache of recent WebSocket sends by (sender, request_id), so
+# frames resent after a reconnect are acked again instead of stored twice
+CHAT_SEND_DEDUP_CACHE_SIZE = 10000
+CHAT_SEND_DEDUP_CACHE_TTL = 300  # seconds
+
+# Typing indicators: one coalesced update per chat per interval; repeat starts
+# within the refresh window are dropped and silent typers expire after the timeout
+CHAT_TYPING_INTERVAL_MS = 500
+CHAT_TYPING_REFRESH_SECONDS = 3
+CHAT_TYPING_TIMEOUT_SECONDS = 6
+
+# Presence: connection counters live in the cache (expiring PRESENCE_TTL after
+# the last heartbeat); is_online/last_seen_at are written to the DB in batches
+CHAT_PRESENCE_FLUSH_SECONDS = 5
+CHAT_PRESENCE_TTL_SECONDS = 120
+# Presence changes pushed to contacts are debounced per receiving connection
+CHAT_PRESENCE_DEBOUNCE_MS = 1000
+
+# Opt-in (?batch=1) outbound batching: frames for one connection are held for
+# up to the window and sent as a single `batch` frame
+CHAT_OUTBOUND_BATCH_MS = 10
+CHAT_OUTBOUND_BATCH_MAX = 50
+
+# Per-connection outbound backlog (queued frames, plus frames not yet acked by
+# clients that connect with ?ack=1): past the high-water mark typing/presence
+# frames are dropped, and a connection that stays over it is closed (code 4009)
+# to resync
+CHAT_OUTBOUND_HIGH_WATER = 200
+CHAT_OUTBOUND_OVERLOAD_SECONDS = 5
+
+# Inbound WebSocket token buckets: set CHAT_WS_RATE_LIMITS to override the
+# defaults in apps.chat.ratelimit.DEFAULT_RATE_LIMITS (event type ('*' = any
+# other) -> scope -> (tokens per second, burst)). Clients that keep hitting
+# them are disconnected.
+CHAT_WS_ABUSE_LIMIT = 50
+CHAT_WS_ABUSE_WINDOW_SECONDS = 10
+
+# WebSocket auth: verified access tokens are cached until they expire and user
+# snapshots (invalidated on save/delete) for this long, so reconnects skip the DB
+ACCOUNTS_USER_SNAPSHOT_TTL = 300  # seconds
+
+# REST views send their WebSocket events after commit, off the request thread,
+# to at most this many recipients at a time
+CHAT_BROADCAST_CONCURRENCY = 100
@@ -10,6 +10,7 @@ export default function ChatListScreen({ navigation }) {
     const [unreadCounts, setUnreadCounts] = useState({}); // Track unread per chat
     const [currentUserId, setCurrentUserId] = useState(null); // Track current user
     const [menuVisible, setMenuVisible] = useState(false);
+    const syncStateRef = React.useRef({ running: false, again: false });
 
     // Logic to update state when a new message arrives
     const handleNewMessage = React.useCallback((message) => {
@@ -86,13 +87,56 @@ export default function ChatListScreen({ navigation }) {
             loadChats();
         };
 
+        // Contacts' presence changes, pushed instead of re-fetching the list
+        const handlePresence = ({ users }) => {
+            const online = {};
+            users.forEach(u => { online[u.user_id] = u.is_online; });
+            setChats(prev => prev.map(chat => {
+                if (chat.type !== 'private') return chat;
+                const other = (chat.participants || []).find(p => online[String(p.user.id)] !== undefined);
+                return other ? { ...chat, other_user_online: online[String(other.user.id)] } : chat;
+            }));
+        };
+
+        // Catch up over REST after a reconnect, or when the server could not
+        // replay what we missed; a request during a sync runs it once more
+        const handleResync = async () => {
+            const state = syncStateRef.current;
+            if (state.running) {
+                state.again = true;
+                return;
+            }
+            state.running = true;
+            try {
+                do {
+                    state.again = false;
+                    const changes = await apiService.syncSinceLastSync();
+                    applySync(changes);
+                    if (changes.messages.length > 0) {
+                        // REST messages carry `chat`; socket payloads carry `chat_id`
+                        webSocketService.emit('sync.messages', changes.messages.map(m => ({ ...m, chat_id: String(m.chat) })));
+                    }
+                } while (state.again);
+            } catch (error) {
+                console.error('Failed to sync changes:', error);
+            } finally {
+                state.running = false;
+            }
+        };
+
         console.log('🔌 Setting up WebSocket listener with user ID:', currentUserId);
         webSocketService.on('message.new', handleNewMessage);
         webSocketService.on('chat.new', handleNewChat);
+        webSocketService.on('presence.update', handlePresence);
+        webSocketService.on('connected', handleResync);
+        webSocketService.on('sync.required', handleResync);
 
         return () => {
             webSocketService.off('message.new', handleNewMessage);
             webSocketService.off('chat.new', handleNewChat);
+            webSocketService.off('presence.update', handlePresence);
+            webSocketService.off('connected', handleResync);
+            webSocketService.off('sync.required', handleResync);
         };
     }, [handleNewMessage, currentUserId]);
 
@@ -154,6 +198,27 @@ export default function ChatListScreen({ navigation }) {
         }
     };
 
+    // Merge a delta sync into the list; changed chats come back whole, with
+    // their unread counts
+    const applySync = (changes) => {
+        const left = new Set(changes.participants_removed
+            .filter(p => String(p.user_id) === String(currentUserId))
+            .map(p => p.chat_id));
+        const gone = new Set([...changes.deleted_chat_ids, ...left]);
+        const changed = new Map(changes.chats.map(chat => [chat.id, chat]));
+
+        setChats(prev => [
+            ...changed.values(),
+            ...(changes.full ? [] : prev.filter(chat => !changed.has(chat.id) && !gone.has(chat.id))),
+        ]);
+        setUnreadCounts(prev => {
+            const counts = changes.full ? {} : { ...prev };
+            gone.forEach(chatId => { delete counts[chatId]; });
+            changed.forEach(chat => { counts[chat.id] = chat.unread_count || 0; });
+            return counts;
+        });
+    };
+
     const onRefresh = () => {
         setRefreshing(true);
         loadChats();
@@ -21,6 +21,10 @@ export default function ChatScreen({ route, navigation }) {
     const [otherUserOnline, setOtherUserOnline] = useState(true); // Default to true for now
     const flatListRef = useRef(null);
     const typingTimeoutRef = useRef(null);
+    const typersRef = useRef({}); // user_id -> expiry timer for others typing here
+    const currentUserIdRef = useRef(null); // for the socket handlers, registered once per chat
+    const olderCursorRef = useRef(null); // `before` cursor of the oldest loaded page, null once at the start
+    const loadingOlderRef = useRef(false);
 
     // Set up navigation header with online status
     useEffect(() => {
@@ -61,6 +65,7 @@ export default function ChatScreen({ route, navigation }) {
                     // Decode JWT to get user ID (simple decode, not validation)
                     const payload = JSON.parse(atob(token.split('.')[1]));
                     setCurrentUserId(payload.user_id);
+                    currentUserIdRef.current = payload.user_id;
 
                     // Ensure WebSocket is connected
                     if (!webSocketService.isConnected) {
@@ -80,7 +85,9 @@ export default function ChatScreen({ route, navigation }) {
         const loadMessages = async () => {
             try {
                 // 1. Fetch messages first (before marking read) to know which were unread
-                const messageHistory = await apiService.getChatMessages(chatId);
+                const page = await apiService.getChatMessages(chatId);
+                const messageHistory = page.results;
+                olderCursorRef.current = page.has_older ? page.before : null;
                 console.log('📜 Loaded message history, count:', messageHistory.length);
 
                 // 2. Find the first unread message from OTHERS
@@ -123,37 +130,105 @@ export default function ChatScreen({ route, navigation }) {
 
         // Listen for messages
         webSocketService.on('message.new', handleNewMessage);
-        webSocketService.on('typing.start', handleTypingStart);
-        webSocketService.on('typing.stop', handleTypingStop);
-        webSocketService.on('message.read', handleMessageRead);
+        webSocketService.on('typing.update', handleTypingUpdate);
+        webSocketService.on('messages.read_up_to', handleMessagesRead);
+        webSocketService.on('messages.status', handleMessagesStatus);
+        webSocketService.on('sync.messages', handleSyncedMessages);
 
         return () => {
             webSocketService.off('message.new', handleNewMessage);
-            webSocketService.off('typing.start', handleTypingStart);
-            webSocketService.off('typing.stop', handleTypingStop);
-            webSocketService.off('message.read', handleMessageRead);
+            webSocketService.off('typing.update', handleTypingUpdate);
+            Object.values(typersRef.current).forEach(clearTimeout);
+            typersRef.current = {};
+            webSocketService.off('messages.read_up_to', handleMessagesRead);
+            webSocketService.off('messages.status', handleMessagesStatus);
+            webSocketService.off('sync.messages', handleSyncedMessages);
         };
     }, [chatId]);
 
-    const handleMessageRead = (payload) => {
-        console.log('✅ Message read receipt received:', payload);
-        const { message_id } = payload;
+    // Scrolled to the top: prepend the page before the oldest loaded message
+    const loadOlderMessages = async () => {
+        if (!olderCursorRef.current || loadingOlderRef.current) return;
+        loadingOlderRef.current = true;
+        try {
+            const page = await apiService.getChatMessages(chatId, { before: olderCursorRef.current });
+            olderCursorRef.current = page.has_older ? page.before : null;
+            setMessages(prev => {
+                const loaded = new Set(prev.map(msg => msg.message_id));
+                return [...page.results.filter(msg => !loaded.has(msg.message_id)), ...prev];
+            });
+        } catch (error) {
+            console.error('Failed to load older messages:', error);
+        } finally {
+            loadingOlderRef.current = false;
+        }
+    };
+
+    // Messages new or changed while the socket could not deliver them:
+    // replace the ones on screen, append the rest in send order
+    const handleSyncedMessages = (synced) => {
+        const mine = synced.filter(msg => msg.chat_id === chatId);
+        if (mine.length === 0) return;
+
+        setMessages(prev => {
+            const byId = new Map(mine.map(msg => [String(msg.message_id), msg]));
+            const merged = prev.map(msg => {
+                const update = byId.get(String(msg.message_id));
+                if (update === undefined) return msg;
+                byId.delete(String(msg.message_id));
+                return { ...msg, ...update };
+            });
+            return [...merged, ...[...byId.values()].sort((a, b) => a.seq - b.seq)];
+        });
+    };
+
+    // Range receipt from one reader: each of my messages in (from_seq, seq]
+    // has one more reader. Statuses only change with messages.status, once
+    // every recipient got there.
+    const handleMessagesRead = (payload) => {
+        if (payload.chat_id !== chatId) return;
 
         setMessages(prev => prev.map(msg => {
-            if (msg.message_id === message_id || msg.id === message_id) {
-                return { ...msg, status: 'read' };
-            }
-            return msg;
+            if (!msg.receipts || !(msg.seq > payload.from_seq && msg.seq <= payload.seq)) return msg;
+            const read = Math.min(msg.receipts.read + 1, msg.receipts.recipients);
+            const delivered = Math.max(msg.receipts.delivered, read);
+            return { ...msg, receipts: { ...msg.receipts, read, delivered } };
         }));
     };
 
-    const handleTypingStart = () => {
-        setIsTyping(true);
-        setOtherUserOnline(true); // If typing, they're online
+    // Every recipient has my messages up to `up_to_seq` in `status`
+    const STATUS_ORDER = ['sent', 'delivered', 'read'];
+    const handleMessagesStatus = (payload) => {
+        if (payload.chat_id !== chatId) return;
+        const rank = STATUS_ORDER.indexOf(payload.status);
+
+        setMessages(prev => prev.map(msg => {
+            if (!(msg.seq <= payload.up_to_seq) || STATUS_ORDER.indexOf(msg.status) >= rank) return msg;
+            if (msg.sender_id?.toString() !== currentUserIdRef.current?.toString()) return msg;
+            return { ...msg, status: payload.status };
+        }));
     };
 
-    const handleTypingStop = () => {
-        setIsTyping(false);
+    // Coalesced typing changes for a chat; a typer who is not listed again
+    // within `expires_in` seconds has stopped
+    const handleTypingUpdate = (payload) => {
+        if (payload.chat_id !== chatId) return;
+        const typers = typersRef.current;
+        const refresh = () => setIsTyping(Object.keys(typers).length > 0);
+
+        payload.stopped.forEach((userId) => {
+            clearTimeout(typers[userId]);
+            delete typers[userId];
+        });
+        payload.typing.forEach((userId) => {
+            clearTimeout(typers[userId]);
+            typers[userId] = setTimeout(() => {
+                delete typers[userId];
+                refresh();
+            }, payload.expires_in * 1000);
+        });
+        refresh();
+        if (payload.typing.length > 0) setOtherUserOnline(true); // If typing, they're online
     };
 
     const handleNewMessage = (message) => {
@@ -284,6 +359,7 @@ export default function ChatScreen({ route, navigation }) {
                             {item.status === 'read' && '✓✓'}
                             {item.status === 'delivered' && '✓✓'}
                             {item.status === 'sent' && '✓'}
+                            {item.receipts?.recipients > 1 && ` ${item.receipts.read}/${item.receipts.recipients}`}
                         </Text>
                     )}
                 </View>
@@ -302,6 +378,10 @@ export default function ChatScreen({ route, navigation }) {
                 renderItem={renderMessage}
                 keyExtractor={(item, index) => item.message_id?.toString() || index.toString()}
                 contentContainerStyle={styles.messageList}
+                onStartReached={loadOlderMessages}
+                onStartReachedThreshold={0.5}
+                // Keep the visible messages in place when older ones are prepended
+                maintainVisibleContentPosition={{ minIndexForVisible: 0 }}
                 onScrollToIndexFailed={info => {
                     const wait = new Promise(resolve => setTimeout(resolve, 500));
                     wait.then(() => {
@@ -87,6 +87,7 @@ class APIService {
     async logout() {
         await SecureStore.deleteItemAsync('accessToken');
         await SecureStore.deleteItemAsync('refreshToken');
+        await SecureStore.deleteItemAsync('syncToken');
     }
 
     async getToken() {
@@ -108,11 +109,40 @@ class APIService {
         return response.data;
     }
 
-    async getChatMessages(chatId) {
-        const response = await this.axios.get(`/chat/chats/${chatId}/messages/`);
+    async getChatMessages(chatId, params = {}) {
+        // Paginated: { results, before, after, has_older, has_newer }
+        const response = await this.axios.get(`/chat/chats/${chatId}/messages/`, { params });
         return response.data;
     }
 
+    async syncChanges(token = null) {
+        // Delta sync: pass the token from the previous call to get only what changed
+        const response = await this.axios.get('/chat/chats/sync/', {
+            params: token ? { token } : {},
+        });
+        return response.data;
+    }
+
+    async syncSinceLastSync() {
+        // Delta sync from the stored token, following `has_more` pages; the
+        // first sync (no token yet) returns the full chat list with `full: true`
+        let token = await SecureStore.getItemAsync('syncToken');
+        const changes = {
+            full: false, chats: [], participants_added: [], participants_removed: [],
+            deleted_chat_ids: [], messages: [],
+        };
+        let page;
+        do {
+            page = await this.syncChanges(token);
+            changes.full = changes.full || page.full;
+            ['chats', 'participants_added', 'participants_removed', 'deleted_chat_ids', 'messages']
+                .forEach(key => changes[key].push(...page[key]));
+            token = page.token;
+        } while (page.has_more);
+        await SecureStore.setItemAsync('syncToken', token);
+        return changes;
+    }
+
     async markChatRead(chatId) {
         const response = await this.axios.post(`/chat/chats/${chatId}/mark_read/`);
         return response.data;
@@ -151,8 +181,9 @@ class APIService {
         return response.data;
     }
 
-    async getChatMessages(chatId) {
-        const response = await this.axios.get(`/chat/chats/${chatId}/messages/`);
+    async getChatMessages(chatId, params = {}) {
+        // Paginated: { results, before, after, has_older, has_newer }
+        const response = await this.axios.get(`/chat/chats/${chatId}/messages/`, { params });
         return response.data;
     }
 }
@@ -1,4 +1,7 @@
 // WebSocket Service for Expo
+const ACK_EVERY = 20; // frames; well under the server's outbound high-water mark
+const ACK_IDLE_MS = 500;
+
 class WebSocketService {
     constructor() {
         this.ws = null;
@@ -8,12 +11,31 @@ class WebSocketService {
         this.reconnectDelay = 1000;
         this.messageQueue = [];
         this.isConnected = false;
+        this.lastEventId = null;
+        this.streamPositions = {}; // chat_<id> -> last event id seen
+        this.requestCounter = 0;
+        this.framesReceived = 0; // on the current connection, acked to the server
+        this.framesAcked = 0;
+        this.ackTimer = null;
+    }
+
+    // Unique per frame: the server dedupes message.send by (sender, request_id),
+    // so a frame resent after a reconnect is stored only once
+    nextRequestId() {
+        this.requestCounter += 1;
+        return `req-${Date.now().toString(36)}-${Math.random().toString(36).slice(2, 10)}-${this.requestCounter}`;
     }
 
     connect(token, serverUrl = '192.168.29.91:8003') {
         // For Expo Go, use your computer's actual IP address
         // Find it with: ipconfig (Windows) or ifconfig (Mac/Linux)
-        const wsUrl = `ws://${serverUrl}/ws/chat/?token=${token}`;
+        // Pass the last event we saw so the server replays anything missed
+        const resume = this.lastEventId !== null ? `&last_event_id=${this.lastEventId}` : '';
+        // batch=1: bursts of events arrive as one `batch` frame
+        // ack=1: we report frames received, so the server sees when we fall behind
+        const wsUrl = `ws://${serverUrl}/ws/chat/?token=${token}&batch=1&ack=1${resume}`;
+        this.framesReceived = 0;
+        this.framesAcked = 0;
 
         this.ws = new WebSocket(wsUrl);
 
@@ -21,14 +43,23 @@ class WebSocketService {
             console.log('✅ WebSocket connected');
             this.isConnected = true;
             this.reconnectAttempts = 0;
+            if (Object.keys(this.streamPositions).length > 0) {
+                this.ws.send(JSON.stringify({ type: 'resume', payload: { streams: this.streamPositions } }));
+            }
             this.flushMessageQueue();
             this.emit('connected', {});
             this.startHeartbeat();
         };
 
-        this.ws.onclose = () => {
+        this.ws.onclose = (event) => {
             console.log('🔌 WebSocket disconnected');
             this.isConnected = false;
+            if (event.code === 4009) {
+                // Server dropped events for us: positions are stale, resync over REST
+                this.lastEventId = null;
+                this.streamPositions = {};
+                this.emit('sync.required', {});
+            }
             this.emit('disconnected', {});
             this.attemptReconnect(token, serverUrl);
         };
@@ -39,6 +70,7 @@ class WebSocketService {
         };
 
         this.ws.onmessage = (event) => {
+            this.countFrame();
             try {
                 const data = JSON.parse(event.data);
                 this.handleMessage(data);
@@ -61,7 +93,7 @@ class WebSocketService {
         const message = {
             type,
             payload,
-            request_id: requestId || `req-${Date.now()}`,
+            request_id: requestId || this.nextRequestId(),
         };
 
         if (this.isConnected && this.ws.readyState === WebSocket.OPEN) {
@@ -92,10 +124,38 @@ class WebSocketService {
     }
 
     handleMessage(data) {
+        if (data.type === 'batch') {
+            data.events.forEach((event) => this.handleMessage(event));
+            return;
+        }
         const { type, payload } = data;
+        const isChatStream = (stream) => stream && stream.startsWith('chat_');
+        if (data.event_id !== undefined) {
+            if (isChatStream(data.stream)) this.streamPositions[data.stream] = data.event_id;
+            else this.lastEventId = data.event_id;
+        }
+        if (type === 'sync.required') {
+            if (isChatStream(payload.stream)) this.streamPositions[payload.stream] = payload.last_event_id;
+            else this.lastEventId = payload.last_event_id;
+        }
         this.emit(type, payload);
     }
 
+    // Ack every ACK_EVERY frames, and once frames stop arriving
+    countFrame() {
+        this.framesReceived += 1;
+        clearTimeout(this.ackTimer);
+        if (this.framesReceived - this.framesAcked >= ACK_EVERY) this.sendAck();
+        else this.ackTimer = setTimeout(() => this.sendAck(), ACK_IDLE_MS);
+    }
+
+    sendAck() {
+        if (!this.isConnected || this.ws?.readyState !== WebSocket.OPEN) return;
+        this.framesAcked = this.framesReceived;
+        // Not queued: a count for a closed connection means nothing to the next one
+        this.ws.send(JSON.stringify({ type: 'ack', payload: { received: this.framesReceived } }));
+    }
+
     startHeartbeat() {
         this.heartbeatInterval = setInterval(() => {
             if (this.isConnected) this.send('ping', {});